@@ -0,0 +1,68 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# eqcatalogueTool is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# eqcatalogueTool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with eqcatalogueTool. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the import of an ISF bulletin, measuring the decoding of
+the lines separately from the storage of the data into an in-memory
+catalogue.
+
+Usage: python benchmarks/isf.py <bulletin> [<repeat>]
+"""
+
+import sys
+import time
+
+from eqcatalogue.importers import isf_decoder, V1
+from eqcatalogue.models import CatalogueDatabase
+
+
+def bench_decode(filename, repeat):
+    """
+    Returns the number of lines decoded per second
+    """
+    lines = 0
+    start = time.time()
+    for _ in xrange(repeat):
+        with open(filename) as stream:
+            for line_num, _, _ in isf_decoder.decode(stream):
+                pass
+        lines += line_num
+    return lines / (time.time() - start)
+
+
+def bench_store(filename, **kwargs):
+    """
+    Returns the number of lines imported per second by
+    :meth:`eqcatalogue.importers.isf_bulletin.V1.store` called with
+    `kwargs`
+    """
+    cat = CatalogueDatabase(memory=True, drop=True)
+    cat.recreate()
+    with open(filename) as stream:
+        lines = sum(1 for _ in stream)
+        stream.seek(0)
+        start = time.time()
+        V1(stream, cat).store(**kwargs)
+    return lines / (time.time() - start)
+
+
+def main(filename, repeat=10):
+    print "decode: %.0f lines/s" % bench_decode(filename, int(repeat))
+    print "store: %.0f lines/s" % bench_store(filename)
+    print "bulk store: %.0f lines/s" % bench_store(filename, bulk=True)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
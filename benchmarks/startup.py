@@ -0,0 +1,79 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# eqcatalogueTool is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# eqcatalogueTool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with eqcatalogueTool. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the startup of the catalogue tool: the import of its
+modules, each one in a new interpreter, and the construction of a
+:class:`eqcatalogue.models.CatalogueDatabase`, in memory, on a new
+file and on an existing file.
+
+Usage: python benchmarks/startup.py [<repeat>]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from eqcatalogue.models import CatalogueDatabase
+
+MODULES = ('eqcatalogue.models', 'eqcatalogue.filtering',
+           'eqcatalogue.grouping', 'eqcatalogue.importers')
+
+
+def bench_import(module, repeat):
+    """
+    Returns the mean seconds taken by a new interpreter to import
+    `module`
+    """
+    start = time.time()
+    for _ in xrange(repeat):
+        subprocess.check_call([sys.executable, '-c', 'import %s' % module])
+    return (time.time() - start) / repeat
+
+
+def bench_open(repeat, **kwargs):
+    """
+    Returns the mean seconds taken to construct a catalogue with
+    `kwargs`
+    """
+    start = time.time()
+    for _ in xrange(repeat):
+        CatalogueDatabase.reset_singleton()
+        CatalogueDatabase(**kwargs)._engine.close()
+    return (time.time() - start) / repeat
+
+
+def main(repeat=10):
+    repeat = int(repeat)
+    for module in MODULES:
+        print "import %s: %.3f s" % (module, bench_import(module, repeat))
+
+    print "open memory: %.3f s" % bench_open(repeat, memory=True)
+    filename = tempfile.mktemp(suffix='.db')
+    try:
+        print "open new file: %.3f s" % bench_open(
+            repeat, filename=filename, drop=True)
+        print "open existing file: %.3f s" % bench_open(
+            repeat, filename=filename)
+    finally:
+        for suffix in '', '-wal', '-shm':
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,786 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# eqcataloguetool is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# EqCatalogueTool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with eqcataloguetool. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory engine for eqcatalogue tool, that keeps each table as a
+numpy array per column, with integer foreign keys. The criteria of
+:mod:`eqcatalogue.filtering` select the measures by vectorised masks
+instead of sql queries, e.g.::
+
+  cat = CatalogueDatabase(engine='eqcatalogue.datastores.columnar',
+                          filename='isc.db')
+  measures = C(scale='mb', agency__in=['ISC', 'NEIC']).all()
+
+The data are loaded from a catalogue file of the spatialite engine,
+from a snapshot (see :func:`save_snapshot`) or stored by
+:meth:`Engine.bulk_insert`. Measures, origins, events
+and agencies are returned as plain records with the attributes of
+the models.
+"""
+
+import re
+from contextlib import contextmanager
+
+import numpy as np
+
+from eqcatalogue.models import (EventSource, Agency, Event, Origin,
+                                MagnitudeMeasure, MeasureMetadata,
+                                ConvertedMeasure)
+
+# The mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+
+# The columns of each table, with their types. The position of an
+# origin is given by the coordinates of its point.
+COLUMNS = {
+    EventSource: (('id', np.int64), ('name', object)),
+    Agency: (('id', np.int64), ('source_key', object),
+             ('eventsource_id', np.int64)),
+    Event: (('id', np.int64), ('source_key', object), ('name', object),
+            ('eventsource_id', np.int64)),
+    Origin: (('id', np.int64), ('source_key', object),
+             ('eventsource_id', np.int64), ('time', 'datetime64[us]'),
+             ('time_error', np.float64), ('time_rms', np.float64),
+             ('position_x', np.float64), ('position_y', np.float64),
+             ('semi_minor_90error', np.float64),
+             ('semi_major_90error', np.float64),
+             ('depth', np.float64), ('depth_error', np.float64)),
+    MagnitudeMeasure: (('id', np.int64), ('event_id', np.int64),
+                       ('agency_id', np.int64), ('origin_id', np.int64),
+                       ('scale', object), ('value', np.float64),
+                       ('standard_error', np.float64)),
+    MeasureMetadata: (('id', np.int64), ('magnitudemeasure_id', np.int64),
+                      ('name', object), ('value', np.float64))}
+
+# The tables of a spatialite catalogue the columns are loaded from
+TABLE_NAMES = {
+    EventSource: 'catalogue_eventsource',
+    Agency: 'catalogue_agency',
+    Event: 'catalogue_event',
+    Origin: 'catalogue_origin',
+    MagnitudeMeasure: 'catalogue_magnitudemeasure',
+    MeasureMetadata: 'catalogue_measuremetadata'}
+
+# The version of the format of the snapshots
+SNAPSHOT_VERSION = 1
+
+# The columns of the denormalised table of the measures, with a row
+# per measure (see
+# :meth:`eqcatalogue.datastores.spatialite.Engine.refresh_measure_rows`)
+MEASURE_ROW_COLUMNS = ('id', 'event_id', 'origin_id', 'event_key',
+                       'eventsource', 'agency_key', 'scale', 'value',
+                       'standard_error', 'epoch', 'latitude', 'longitude',
+                       'depth')
+
+# The columns of the denormalised table of the measures that hold
+# strings
+MEASURE_ROW_STRINGS = ('event_key', 'eventsource', 'agency_key', 'scale')
+
+# The sql expressions of the columns that are not stored as they are
+SQL_COLUMNS = {'position_x': 'X(position)', 'position_y': 'Y(position)'}
+
+NUMBER = r'[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?'
+
+POINT_REGEXP = re.compile(
+    r'^\s*POINT\s*\(\s*(%s)\s+(%s)\s*\)\s*$' % (NUMBER, NUMBER),
+    re.IGNORECASE)
+RING_REGEXP = re.compile(r'\(\s*\(([^)]*)\)')
+
+
+def parse_point(point):
+    """
+    Returns the coordinates of a point in wkt format
+    """
+    match = POINT_REGEXP.match(point)
+    if match is None:
+        raise ValueError("Invalid point %s" % point)
+    return float(match.group(1)), float(match.group(2))
+
+
+def parse_polygon(polygon):
+    """
+    Returns the list of the vertices of the exterior ring of a
+    polygon in wkt format
+    """
+    match = RING_REGEXP.search(polygon)
+    if match is None:
+        raise ValueError("Invalid polygon %s" % polygon)
+    return [tuple(float(c) for c in vertex.split())
+            for vertex in match.group(1).split(',')]
+
+
+def within_polygon(xs, ys, polygon):
+    """
+    Returns a boolean array telling which of the points with
+    coordinates `xs` and `ys` are inside `polygon`, by casting a ray
+    from each point across all the edges at once
+    """
+    vertices = parse_polygon(polygon)
+    inside = np.zeros(len(xs), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for (x1, y1), (x2, y2) in zip(vertices,
+                                      vertices[1:] + vertices[:1]):
+            crosses = (y1 > ys) != (y2 > ys)
+            x_cross = (x2 - x1) * (ys - y1) / (y2 - y1) + x1
+            inside ^= crosses & (xs < x_cross)
+    return inside
+
+
+def distances(xs, ys, point):
+    """
+    Returns the great circle distances in meters between `point` and
+    the points with longitudes `xs` and latitudes `ys`, as computed by
+    the spatialite function PtDistWithin for the srid 4326
+    """
+    longitude, latitude = np.radians(parse_point(point))
+    xs, ys = np.radians(xs), np.radians(ys)
+    a = (np.sin((ys - latitude) / 2) ** 2 +
+         np.cos(latitude) * np.cos(ys) * np.sin((xs - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class Table(object):
+    """
+    The rows of a model, kept sorted by id, as a numpy array per
+    column. The rows appended are joined to the columns only when
+    they are read, so that a bulk load copies the columns once rather
+    than at each batch.
+    """
+
+    def __init__(self, columns):
+        self._dtypes = columns
+        self._columns = dict((name, np.array([], dtype=dtype))
+                             for name, dtype in columns)
+        # the columns of the batches of rows appended since the last
+        # read
+        self._appended = []
+
+    @property
+    def columns(self):
+        """
+        The dictionary that maps the names of the columns to their
+        arrays
+        """
+        if self._appended:
+            self._join()
+        return self._columns
+
+    def __len__(self):
+        return len(self._columns['id']) + sum(
+            len(columns['id']) for columns in self._appended)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def append(self, rows):
+        """
+        Append `rows`, a list of dictionaries that map the column
+        names to the values. Missing values are stored as None, nan
+        or NaT.
+        """
+        self.append_columns(dict(
+                (name, np.array([row.get(name) for row in rows], dtype=dtype))
+                for name, dtype in self._dtypes))
+
+    def append_columns(self, columns):
+        """
+        Append the rows given by `columns`, a dictionary that maps
+        each column name to an array of values
+        """
+        self._appended.append(dict(
+                (name, np.asarray(columns[name], dtype=dtype))
+                for name, dtype in self._dtypes))
+
+    def _join(self):
+        """
+        Join the batches of rows appended to the columns, with a
+        single copy of each column, and sort the rows by id
+        """
+        appended, self._appended = self._appended, []
+        for name, _ in self._dtypes:
+            self._columns[name] = np.concatenate(
+                [self._columns[name]] + [columns[name]
+                                         for columns in appended])
+        ids = self._columns['id']
+        if len(ids) and (np.diff(ids) < 0).any():
+            order = np.argsort(ids, kind='mergesort')
+            for name in self._columns:
+                self._columns[name] = self._columns[name][order]
+
+    def rows(self, start=0, stop=None):
+        """
+        Returns the list of the rows from `start` to `stop` (by
+        default all of them), as dictionaries that map the column
+        names to python values (None if missing)
+        """
+        names = [name for name, _ in self._dtypes]
+        return [dict(zip(names, values)) for values in zip(
+                *[_python_values(self.columns[name][start:stop])
+                  for name in names])]
+
+    def rows_of(self, ids):
+        """
+        Returns the indices of the rows with the given `ids`. Raises
+        KeyError if some of them are not in the table.
+        """
+        table_ids = self.columns['id']
+        rows = np.searchsorted(table_ids, ids)
+        if len(table_ids):
+            absent = np.asarray(
+                table_ids[np.minimum(rows, len(table_ids) - 1)] != ids)
+        else:
+            absent = np.ones(np.shape(ids), dtype=bool)
+        if absent.any():
+            raise KeyError(np.asarray(ids)[absent].tolist())
+        return rows
+
+    def value(self, name, row):
+        """
+        Returns the value of the column `name` in `row` as a python
+        object, None if missing
+        """
+        column = self.columns[name]
+        if column.dtype.kind == 'f':
+            value = column[row]
+            return None if np.isnan(value) else float(value)
+        elif column.dtype.kind == 'i':
+            return int(column[row])
+        elif column.dtype.kind == 'M':
+            return column[row:row + 1].tolist()[0]
+        return column[row]
+
+
+def _python_values(column):
+    """
+    Returns the values of `column` as a list of python objects, with
+    None in place of nan and NaT
+    """
+    if column.dtype.kind == 'f':
+        return [None if value != value else value
+                for value in column.tolist()]
+    return column.tolist()
+
+
+def _epochs(times):
+    """
+    Returns the seconds since the epoch of the array of datetimes
+    `times`, nan for NaT
+    """
+    microseconds = times.astype('datetime64[us]').astype(np.int64)
+    epochs = microseconds / 1e6
+    epochs[microseconds == np.iinfo(np.int64).min] = np.nan
+    return epochs
+
+
+def encode(column):
+    """
+    Returns the distinct strings of the object array `column`, sorted,
+    and the array of the index among them of each of its elements,
+    -1 for None
+    """
+    present = np.not_equal(column, None)
+    values, codes = np.unique(column[present].astype(unicode),
+                              return_inverse=True)
+    indices = np.where(present, 0, -1).astype(np.int32)
+    indices[present] = codes
+    return values, indices
+
+
+def measure_arrays(columns):
+    """
+    Returns the columns of the denormalised table of the measures
+    given by the dictionary `columns` of sequences, as a dictionary of
+    numpy arrays. The identifiers are integers, the other numbers
+    floats with nan for None. The strings of a column `<name>` (see
+    :data:`MEASURE_ROW_STRINGS`) are stored once in the array
+    `<name>.values`, and `<name>` holds their indices (see
+    :func:`encode`).
+    """
+    arrays = {}
+    for name, column in columns.items():
+        if name in MEASURE_ROW_STRINGS:
+            arrays[name + '.values'], arrays[name] = encode(
+                np.array(column, dtype=object))
+        elif name == 'id' or name.endswith('_id'):
+            arrays[name] = np.array(column, dtype=np.int64)
+        else:
+            arrays[name] = np.array(column, dtype=np.float64)
+    return arrays
+
+
+def read_tables(session):
+    """
+    Returns the tables of a catalogue of the spatialite engine read
+    by `session`, as a dictionary of :class:`Table` keyed by model
+    """
+    tables = {}
+    for class_object, columns in COLUMNS.items():
+        names = [name for name, _ in columns]
+        rows = session.execute("SELECT %s FROM %s ORDER BY id" % (
+                ", ".join(SQL_COLUMNS.get(name, name) for name in names),
+                TABLE_NAMES[class_object]))
+        tables[class_object] = Table(columns)
+        tables[class_object].append([dict(zip(names, row)) for row in rows])
+    return tables
+
+
+def save_snapshot(tables, filename, compress=True):
+    """
+    Save `tables` (see :func:`read_tables`) to the .npz file
+    `filename`, as an array per column. The strings of a column are
+    stored once, in the array `<table>.<column>.values`, and referred
+    by their index in `<table>.<column>.codes`, -1 for None.
+    """
+    arrays = {'version': np.array(SNAPSHOT_VERSION)}
+    for class_object, table in tables.items():
+        for name, column in table.columns.items():
+            key = '%s.%s' % (TABLE_NAMES[class_object], name)
+            if column.dtype == object:
+                arrays[key + '.values'], arrays[key + '.codes'] = encode(
+                    column)
+            else:
+                arrays[key] = column
+    if compress:
+        np.savez_compressed(filename, **arrays)
+    else:
+        np.savez(filename, **arrays)
+
+
+def load_snapshot(filename):
+    """
+    Returns the tables saved by :func:`save_snapshot` in `filename`
+    """
+    snapshot = np.load(filename)
+    try:
+        if int(snapshot['version']) != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version %s" %
+                             snapshot['version'])
+        tables = {}
+        for class_object, columns in COLUMNS.items():
+            arrays = {}
+            for name, dtype in columns:
+                key = '%s.%s' % (TABLE_NAMES[class_object], name)
+                if dtype is object:
+                    # the last value is the one of the code -1
+                    values = np.array(
+                        snapshot[key + '.values'].tolist() + [None],
+                        dtype=object)
+                    arrays[name] = values[snapshot[key + '.codes']]
+                else:
+                    arrays[name] = snapshot[key]
+            tables[class_object] = Table(columns)
+            tables[class_object].append_columns(arrays)
+        return tables
+    finally:
+        snapshot.close()
+
+
+class Record(object):
+    """
+    A row of a columnar catalogue, with the attributes of the
+    corresponding model object
+    """
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return "%s %s" % (self.__class__.__name__, self.__dict__.get(
+                'source_key', self.__dict__.get('name')))
+
+
+class EventRecord(Record):
+    """
+    An event of a columnar catalogue. Its measures are looked up
+    when accessed.
+    """
+
+    @property
+    def measures(self):
+        return self._engine.measures_of_event(self.id)
+
+
+class Measure(object):
+    """
+    A magnitude measure of a columnar catalogue, with the interface
+    of :class:`~eqcatalogue.models.MagnitudeMeasure`
+    """
+
+    def __init__(self, agency, event, origin, scale, value,
+                 standard_error=None, id=None):
+        self.id = id
+        self.agency = agency
+        self.event = event
+        self.origin = origin
+        self.scale = scale
+        self.value = value
+        self.standard_error = standard_error
+
+    def __repr__(self):
+        return "measure of %s at %s by %s: %s %s (sigma=%s)" % (
+            self.event, self.origin, self.agency, self.value, self.scale,
+            self.standard_error)
+
+    def convert(self, new_value, formula, standard_error):
+        """
+        Convert the measure to a ConvertedMeasure with `new_value`
+        through `formula`
+        """
+        return ConvertedMeasure(self.agency, self.event, self.origin,
+                   formula.target_scale, new_value, standard_error,
+                   self, [formula])
+
+
+class Columns(object):
+    """
+    The columns of the measures of a :class:`Selection`, joined with
+    the time and the position of their origin and the name of their
+    agency. Each column is gathered only when first accessed.
+    """
+
+    def __init__(self, columns, indices):
+        self._columns = columns
+        self._indices = indices
+        self._gathered = {}
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, name):
+        if not name in self._gathered:
+            self._gathered[name] = self._columns[name][self._indices]
+        return self._gathered[name]
+
+
+class Selection(object):
+    """
+    A set of measures of a columnar catalogue. It provides the part
+    of the interface of a sqlalchemy query used by
+    :class:`~eqcatalogue.filtering.Criteria`.
+
+    :param indices: the indices of the measures in the measure table.
+      If None, all the measures of the catalogue.
+    """
+
+    def __init__(self, engine, indices=None):
+        self._engine = engine
+        self._indices = indices
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            return np.arange(len(self._engine.tables[MagnitudeMeasure]))
+        return self._indices
+
+    @property
+    def columns(self):
+        return Columns(self._engine.measure_columns(), self.indices)
+
+    def restrict(self, mask):
+        """
+        Returns the selection of the measures for which the function
+        `mask`, given the :class:`Columns` of the measures, returns
+        True
+        """
+        indices = self.indices
+        return Selection(self._engine, indices[mask(self.columns)])
+
+    def union(self, selection):
+        return Selection(self._engine,
+                         np.union1d(self.indices, selection.indices))
+
+    def count(self):
+        return len(self.indices)
+
+    def all(self):
+        return self._engine.measures(self.indices)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __contains__(self, measure):
+        """
+        Tells if `measure` is one of the selected measures, by its id,
+        as the measures are built again on each access
+        """
+        measure_id = getattr(measure, 'id', None)
+        if measure_id is None:
+            return False
+        ids = self._engine.tables[MagnitudeMeasure]['id'][self.indices]
+        return bool((ids == measure_id).any())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._engine.measures(self.indices[item])
+        return self._engine.measures([self.indices[item]])[0]
+
+    def stream(self, batch_size):
+        """
+        Returns an iterator on the measures, built `batch_size` at a
+        time
+        """
+        indices = self.indices
+        for start in range(0, len(indices), batch_size):
+            for measure in self._engine.measures(
+                indices[start:start + batch_size]):
+                yield measure
+
+    def rows(self, names):
+        """
+        Returns the values of the columns `names` of the measures, as
+        a list of tuples sorted by measure id
+        """
+        columns = self.columns
+        return zip(*[_python_values(columns[name]) for name in names])
+
+    def events(self):
+        """
+        Returns the distinct events of the measures
+        """
+        event_ids = np.unique(
+            self._engine.tables[MagnitudeMeasure]['event_id'][self.indices])
+        records = {}
+        return [self._engine.record(Event, event_id, records)
+                for event_id in event_ids]
+
+
+class Engine(object):
+    """
+    Keep a catalogue in memory as numpy arrays.
+
+    :param filename: the filename of a catalogue of the spatialite
+      engine to load.
+
+    :param snapshot: the filename of a snapshot of a catalogue to
+      load (see :meth:`save_snapshot`).
+
+    If neither is given, the catalogue is empty.
+    """
+
+    def __init__(self, filename=None, snapshot=None):
+        # there is no session, as the data are not accessed by the orm
+        self.session = None
+        # nor statements
+        self.statement_count = 0
+        # nor shards
+        self.sharded = False
+        self.generation = 0
+        self.recreate()
+        if filename:
+            self.load(filename)
+        if snapshot:
+            self.load_snapshot(snapshot)
+
+    def recreate(self):
+        self.tables = dict((class_object, Table(columns))
+                           for class_object, columns in COLUMNS.items())
+        self._invalidate()
+
+    def _invalidate(self):
+        self._measure_columns = None
+        self._event_index = None
+        self.bump_generation()
+
+    def bump_generation(self):
+        """
+        Mark the data of the catalogue as changed
+        """
+        self.generation += 1
+
+    def load(self, filename):
+        """
+        Append all the data of the catalogue file `filename` of the
+        spatialite engine
+        """
+        from eqcatalogue.datastores import spatialite
+
+        engine = spatialite.Engine(filename=filename)
+        try:
+            self._append_tables(read_tables(engine.session))
+        finally:
+            engine.close()
+
+    def _append_tables(self, tables):
+        for class_object, table in tables.items():
+            self.tables[class_object].append_columns(table.columns)
+        self._invalidate()
+
+    def save_snapshot(self, filename):
+        """
+        Save the catalogue to the snapshot `filename` (see
+        :func:`save_snapshot`)
+        """
+        save_snapshot(self.tables, filename)
+
+    def load_snapshot(self, filename):
+        """
+        Append the data of the snapshot `filename`
+        """
+        self._append_tables(load_snapshot(filename))
+
+    @staticmethod
+    def position_from_latlng(latitude, longitude):
+        return 'POINT(%s %s)' % (latitude, longitude)
+
+    def bulk_insert(self, class_object, rows):
+        """
+        Append `rows` (a list of dictionaries) to the table of
+        `class_object`. Origin rows give their position by the
+        `latitude` and `longitude` keys.
+        """
+        if class_object is Origin:
+            rows = [_position_columns(row) for row in rows]
+        self.tables[class_object].append(rows)
+        self._invalidate()
+
+    @contextmanager
+    def deferred_indexes(self):
+        """
+        A columnar catalogue has no indexes to defer
+        """
+        yield
+
+    def remove_session(self):
+        pass
+
+    def refresh_measure_rows(self, full=False):
+        """
+        The columns of the measures are always up to date (see
+        :meth:`measure_columns`)
+        """
+
+    def measure_columns(self):
+        """
+        Returns a dictionary with the columns of the measures, plus the
+        `time`, `position_x` and `position_y` of their origin and the
+        source key of their agency, named `agency`. The columns of the
+        denormalised table of the measures of the spatialite engine
+        (see :data:`MEASURE_ROW_COLUMNS`) are given too.
+        """
+        if self._measure_columns is None:
+            measures = self.tables[MagnitudeMeasure]
+            origins = self.tables[Origin]
+            agencies = self.tables[Agency]
+            events = self.tables[Event]
+            eventsources = self.tables[EventSource]
+            columns = dict(measures.columns)
+            origin_rows = origins.rows_of(measures['origin_id'])
+            for name in ('time', 'position_x', 'position_y', 'depth'):
+                columns[name] = origins[name][origin_rows]
+            columns['agency'] = agencies['source_key'][
+                agencies.rows_of(measures['agency_id'])]
+
+            event_rows = events.rows_of(measures['event_id'])
+            columns['event_key'] = events['source_key'][event_rows]
+            columns['eventsource'] = eventsources['name'][
+                eventsources.rows_of(events['eventsource_id'][event_rows])]
+            columns['agency_key'] = columns['agency']
+            columns['epoch'] = _epochs(columns['time'])
+            columns['latitude'] = columns['position_x']
+            columns['longitude'] = columns['position_y']
+            self._measure_columns = columns
+        return self._measure_columns
+
+    def selection(self):
+        """
+        Returns the selection of all the measures
+        """
+        return Selection(self)
+
+    def record(self, class_object, object_id, records=None):
+        """
+        Returns the record of the object of type `class_object` with
+        id `object_id`. Records are not kept by the engine, so that
+        memory use does not grow with the objects read, e.g. by a
+        stream. The records built together share the ones kept by the
+        dictionary `records`, if given, so that e.g. the measures of
+        the same event refer to the same event record.
+        """
+        key = (class_object, object_id)
+        if records is not None and key in records:
+            return records[key]
+        table = self.tables[class_object]
+        row = table.rows_of(object_id)
+        attributes = dict((name, table.value(name, row))
+                          for name, _ in COLUMNS[class_object])
+        if 'eventsource_id' in attributes:
+            attributes['eventsource'] = self.record(
+                EventSource, attributes['eventsource_id'], records)
+        if class_object is Origin:
+            attributes['position'] = self.position_from_latlng(
+                attributes.pop('position_x'), attributes.pop('position_y'))
+        if class_object is Event:
+            record = EventRecord(_engine=self, **attributes)
+        else:
+            record = Record(**attributes)
+        if records is not None:
+            records[key] = record
+        return record
+
+    def measures(self, indices):
+        """
+        Returns the list of the measures with the given indices in the
+        measure table. The measures share the records of their events,
+        agencies and origins.
+        """
+        table = self.tables[MagnitudeMeasure]
+        records = {}
+        return [Measure(id=table.value('id', row),
+                        agency=self.record(Agency,
+                                           table.value('agency_id', row),
+                                           records),
+                        event=self.record(Event,
+                                          table.value('event_id', row),
+                                          records),
+                        origin=self.record(Origin,
+                                           table.value('origin_id', row),
+                                           records),
+                        scale=table.value('scale', row),
+                        value=table.value('value', row),
+                        standard_error=table.value('standard_error', row))
+                for row in indices]
+
+    def event_index(self):
+        """
+        Returns the indices of the measures sorted by event id (in the
+        order of the measure table for the same event) and their
+        sorted event ids
+        """
+        if self._event_index is None:
+            event_ids = self.tables[MagnitudeMeasure]['event_id']
+            order = np.argsort(event_ids, kind='mergesort')
+            self._event_index = order, event_ids[order]
+        return self._event_index
+
+    def measures_of_event(self, event_id):
+        """
+        Returns the list of the measures of the event `event_id`
+        """
+        order, event_ids = self.event_index()
+        start = np.searchsorted(event_ids, event_id, side='left')
+        stop = np.searchsorted(event_ids, event_id, side='right')
+        return self.measures(order[start:stop])
+
+
+def _position_columns(row):
+    """
+    Returns a copy of an origin `row` where latitude and longitude
+    are given as the coordinates of the point built by
+    `Engine.position_from_latlng`
+    """
+    row = dict(row)
+    row['position_x'] = row.pop('latitude')
+    row['position_y'] = row.pop('longitude')
+    return row
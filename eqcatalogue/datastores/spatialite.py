@@ -18,25 +18,132 @@ Engine for eqcatalogue tool using spatialite database and geoalchemy
 as ORM wrapper
 """
 
+import calendar
+import glob
+import os
+import warnings
+from contextlib import contextmanager
 from datetime import datetime
 from pysqlite2 import dbapi2 as sqlite
 import sqlalchemy
 from sqlalchemy import orm
 from sqlalchemy.events import event as sqlevent
 import geoalchemy
+from eqcatalogue.datastores import columnar
 from eqcatalogue.models import (EventSource, Event, MagnitudeMeasure, Agency,
-                                SCALES, Origin, MeasureMetadata, METADATA_TYPES
+                                SCALES, Origin, MeasureMetadata,
+                                METADATA_TYPES, ImportCheckpoint
     )
 
 DLL_LIBRARY = "libspatialite.dll"
 DYLIB_LIBRARY = "libspatialite.dylib"
 SO_LIBRARY = "libspatialite.so"
 
+# The spatialite library loaded by the first connection, the only one
+# tried by the next connections
+_loaded_library = None
+
+
+# The version of the schema, see Engine._migrate
+SCHEMA_VERSION = 4
+
+# The pragmas set on each connection, by profile. The page size only
+# applies to new databases.
+PROFILES = {
+    # the defaults of sqlite: durable at each commit
+    'safe': (('page_size', 4096),
+             ('journal_mode', 'DELETE'),
+             ('synchronous', 'FULL'),
+             ('cache_size', -2000),
+             ('temp_store', 'DEFAULT'),
+             ('mmap_size', 0)),
+    # fast imports: a crash may lose the last transactions, which are
+    # imported again from the checkpoint of the import
+    'bulk_load': (('page_size', 8192),
+                  ('journal_mode', 'WAL'),
+                  ('synchronous', 'OFF'),
+                  ('cache_size', -262144),
+                  ('temp_store', 'MEMORY'),
+                  ('mmap_size', 0)),
+    # fast queries: readers do not block on writers and the database
+    # is read through memory mapping
+    'analytics': (('page_size', 8192),
+                  ('journal_mode', 'WAL'),
+                  ('synchronous', 'NORMAL'),
+                  ('cache_size', -262144),
+                  ('temp_store', 'MEMORY'),
+                  ('mmap_size', 1073741824))}
+
+DEFAULT_PROFILE = 'safe'
+
+# The number of connections kept open to a catalogue file
+DEFAULT_POOL_SIZE = 5
+
+# The number of years of the periods a catalogue file can be sharded by
+SHARD_PERIODS = {'year': 1, 'decade': 10}
+
+# The tables stored in the shards of a catalogue, with a row per
+# origin or per measure of an origin
+SHARDED_TABLES = ('catalogue_origin', 'catalogue_magnitudemeasure',
+                  'catalogue_measuremetadata', 'catalogue_measurerow',
+                  'idx_catalogue_origin_position')
+
+# The models of the sharded tables, that are written by bulk inserts only
+SHARDED_MODELS = (Origin, MagnitudeMeasure, MeasureMetadata)
+
+# The first and the last years of the period of the rows stored in the
+# catalogue file of a sharded catalogue, i.e. any year
+MAIN_SHARD_YEARS = (0, 9999)
+
+# The sql expression of the seconds since the epoch of a time. The
+# fraction of the seconds is added apart, as the arithmetic on the
+# julian day is not exact, and is read from the text of the time, as
+# strftime keeps only the milliseconds. The times are stored as
+# 'YYYY-MM-DD HH:MM:SS.ffffff', with the fraction from the 20th
+# character on, if any.
+EPOCH_SQL = ("(strftime('%%s', %(time)s) + "
+             "CAST(substr(%(time)s, 20) AS REAL))")
+
+# The triggers that keep the coordinates and the epoch of the origins
+# in sync with their position and time, unless they are given
+ORIGIN_TRIGGER_NAMES = ('catalogue_origin_coordinates_insert',
+                        'catalogue_origin_coordinates_update')
+ORIGIN_TRIGGERS = ("""
+CREATE TRIGGER IF NOT EXISTS main.catalogue_origin_coordinates_insert
+AFTER INSERT ON catalogue_origin
+WHEN NEW.latitude IS NULL OR NEW.longitude IS NULL OR NEW.epoch IS NULL
+BEGIN
+  UPDATE catalogue_origin SET latitude = X(NEW.position),
+    longitude = Y(NEW.position), epoch = %s
+  WHERE id = NEW.id;
+END""" % (EPOCH_SQL % {'time': "NEW.time"}), """
+CREATE TRIGGER IF NOT EXISTS main.catalogue_origin_coordinates_update
+AFTER UPDATE OF position, time ON catalogue_origin
+BEGIN
+  UPDATE catalogue_origin SET latitude = X(NEW.position),
+    longitude = Y(NEW.position), epoch = %s
+  WHERE id = NEW.id;
+END""" % (EPOCH_SQL % {'time': "NEW.time"}))
+
+# The tables of a snapshot, in the order they are stored, such that the
+# rows referred by a foreign key are stored first
+SNAPSHOT_TABLES = (EventSource, Event, Agency, Origin, MagnitudeMeasure,
+                   MeasureMetadata)
+
+# The number of rows of a snapshot stored at a time
+SNAPSHOT_BATCH_SIZE = 10000
+
 
 class Engine(object):
     DEFAULT_FILENAME = "eqcatalogue.db"
 
-    def __init__(self, memory=False, filename=None, drop=False):
+    # The tables of the models, not bound to a database, as the
+    # mappers are set up once and shared by all the engines
+    _metadata = None
+
+    def __init__(self, memory=False, filename=None, drop=False,
+                 profile=DEFAULT_PROFILE, pool_size=DEFAULT_POOL_SIZE,
+                 shard_by=None):
         """Setup a sqlalchemy connection to spatialite with the proper
         metadata.
 
@@ -48,31 +155,343 @@ class Engine(object):
 
         :param drop: if True, drop the catalogue and rebuild the
         schema
+
+        :param profile: the name of the settings of the connections
+        (see :data:`PROFILES`)
+
+        :param pool_size: the number of connections kept open to a
+        file database, to be shared by the threads that query the
+        catalogue. Each thread has its own session (see
+        :meth:`remove_session`). An in-memory database has only one
+        connection, shared by all the threads.
+
+        :param shard_by: if given, the period (`year` or `decade`, see
+        :data:`SHARD_PERIODS`) the catalogue file is sharded by. The
+        origins, and their measures, of each period are stored into
+        a file of their own, e.g. `isc.1990.db` for the decade
+        starting in 1990 of the catalogue `isc.db`. The other tables
+        are stored into the catalogue file. The shards are attached
+        to each connection, and the tables they store are queried
+        through temporary views that join the rows of all the shards
+        (see :data:`SHARDED_TABLES`). The criteria join the rows of
+        the same shard only, and look up only the shards of their
+        time bounds (see :meth:`shard_clause`). Sharded catalogues
+        are written by bulk inserts only (see :meth:`bulk_insert`),
+        that store each row into its shard: the session rejects the
+        objects of the sharded tables. As sqlite attaches up to 10
+        databases by default, a catalogue spanning more than a
+        century should be sharded by decade.
         """
+        _check_profile(profile)
+        self._profile = profile
+        if shard_by is not None:
+            if not shard_by in SHARD_PERIODS:
+                raise ValueError("Unknown shard period %s. Valid periods "
+                                 "are: %s" % (shard_by, ", ".join(
+                            sorted(SHARD_PERIODS))))
+            if memory:
+                raise ValueError("Only a catalogue file can be sharded")
+        self._shard_by = shard_by
+        self._filename = filename or self.DEFAULT_FILENAME
+        if shard_by and drop:
+            self._remove_shards()
+        self._shards = self._find_shards()
+        for year in self._shards:
+            # shards created by a previous version of the schema are
+            # upgraded on their own, before they are attached
+            shard = self._shard_filename(year)
+            if _file_schema_version(shard) < SCHEMA_VERSION:
+                Engine(filename=shard, pool_size=1).close()
+        self._shard_tables = {}
+        # True inside deferred_indexes
+        self._deferred = False
 
         if memory:
-            self._engine = sqlalchemy.create_engine('sqlite://', module=sqlite)
+            self._engine = sqlalchemy.create_engine(
+                'sqlite://',
+                module=sqlite,
+                poolclass=sqlalchemy.pool.StaticPool,
+                connect_args={'check_same_thread': False})
         else:
             filename = filename or self.DEFAULT_FILENAME
             self._engine = sqlalchemy.create_engine(
                 'sqlite:///%s' % filename,
                 module=sqlite,
                 poolclass=sqlalchemy.pool.QueuePool,
-                pool_size=1,
+                pool_size=pool_size,
+                connect_args={'check_same_thread': False},
                 )
         sqlevent.listen(self._engine,
-                        "first_connect",
-                        _connect)
-        self.session = orm.sessionmaker(bind=self._engine)()
-        self._metadata = sqlalchemy.MetaData(self._engine)
+                        "connect",
+                        self._on_connect)
+        self.statement_count = 0
+        sqlevent.listen(self._engine,
+                        "before_cursor_execute",
+                        self._on_execute)
+        sqlevent.listen(self._engine,
+                        "checkout",
+                        self._on_checkout)
+        # bumped whenever the data of the catalogue change, such that
+        # the results computed from them can be discarded
+        self.generation = 0
+        session_factory = orm.sessionmaker(bind=self._engine)
+        sqlevent.listen(session_factory,
+                        "after_flush",
+                        self._on_flush)
+        if shard_by:
+            sqlevent.listen(session_factory,
+                            "before_flush",
+                            self._on_sharded_flush)
+        self.session = orm.scoped_session(session_factory)
         self._create_schema()
+        # the shared tables are not bound to the engine: the schema is
+        # built through the engine or a connection given explicitly,
+        # and the spatial functions of geoalchemy are compiled for the
+        # dialect of the session running the query
         if drop:
-            self._metadata.drop_all()
-        self._metadata.create_all(self._engine)
+            self._metadata.drop_all(self._engine)
+        # the tables of a catalogue with the current schema version
+        # are not checked one by one
+        if drop or self._schema_version() < SCHEMA_VERSION:
+            self._metadata.create_all(self._engine)
+            self._migrate()
+        self._ensure_indexes()
+        self._ensure_spatial_indexes()
 
     def recreate(self):
-        self._metadata.drop_all()
+        if self._shard_by:
+            # the shards are detached by closing all the connections
+            self.close()
+            self._remove_shards()
+            self._shards = []
+        self._metadata.drop_all(self._engine)
         self._metadata.create_all(self._engine)
+        self.bump_generation()
+
+    def bump_generation(self):
+        """
+        Mark the data of the catalogue as changed
+        """
+        self.generation += 1
+
+    def _shard_filename(self, year):
+        """
+        Returns the filename of the shard of the period starting in
+        `year`
+        """
+        root, ext = os.path.splitext(self._filename)
+        return '%s.%d%s' % (root, year, ext)
+
+    def _find_shards(self):
+        """
+        Returns the sorted starting years of the periods of the shard
+        files of the catalogue
+        """
+        if not self._shard_by:
+            return []
+        root, ext = os.path.splitext(self._filename)
+        years = []
+        for filename in glob.glob('%s.*%s' % (root, ext)):
+            year = filename[len(root) + 1:len(filename) - len(ext)]
+            if year.isdigit():
+                years.append(int(year))
+        return sorted(years)
+
+    def _remove_shards(self):
+        for year in self._find_shards():
+            for suffix in '', '-wal', '-shm':
+                if os.path.exists(self._shard_filename(year) + suffix):
+                    os.remove(self._shard_filename(year) + suffix)
+
+    def _shard_of_time(self, time):
+        """
+        Returns the starting year of the period of `time`
+        """
+        years = SHARD_PERIODS[self._shard_by]
+        return time.year - time.year % years
+
+    def _schemas(self):
+        """
+        Returns the names of the databases holding the sharded tables
+        """
+        return [_schema(year) for year in [None] + self._shards]
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        """Set the pragmas of the profile on a pooled connection opened
+        with another profile (see :meth:`set_profile`), and attach the
+        shards missing in the connection, e.g. the ones created after
+        the connection was opened. Event handler triggered by
+        sqlalchemy"""
+        if connection_record.info.get('profile') != self._profile:
+            _set_pragmas(dbapi_connection, self._profile)
+            connection_record.info['profile'] = self._profile
+        if self._shard_by:
+            self._attach_shards(dbapi_connection, connection_record.info)
+
+    def _attach_shards(self, dbapi_connection, info):
+        """
+        Attach the shards not yet attached to a dbapi connection, whose
+        attached shards are kept in `info`, and create the temporary
+        views of the sharded tables. Databases can not be attached
+        inside a transaction, so the pending one is committed.
+        """
+        attached = info.setdefault('shards', [])
+        if attached == self._shards:
+            return
+        dbapi_connection.commit()
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        try:
+            cursor = dbapi_connection.cursor()
+            for year in self._shards:
+                if not year in attached:
+                    cursor.execute("ATTACH DATABASE ? AS shard_%d" % year,
+                                   (self._shard_filename(year),))
+            for table in SHARDED_TABLES:
+                cursor.execute("DROP VIEW IF EXISTS temp.%s" % table)
+                cursor.execute("CREATE TEMP VIEW %s AS %s" % (
+                        table, " UNION ALL ".join(
+                            self._shard_selects(table))))
+            cursor.close()
+        finally:
+            dbapi_connection.isolation_level = isolation_level
+        info['shards'] = list(self._shards)
+
+    def _shard_selects(self, table):
+        """
+        Returns the queries of the rows of `table` in each database.
+        Each query adds the first and the last years of the period of
+        its database as the constant columns `shard_start` and
+        `shard_end`, that the criteria compare to keep the joined rows
+        within the same database and to skip the databases out of their
+        time bounds (see :meth:`shard_clause`).
+        """
+        # the columns are listed, as the ones added by a migration
+        # follow the geometry columns
+        if table in self._metadata.tables:
+            columns = ", ".join(
+                column.name for column in self._metadata.tables[table].c)
+        else:
+            columns = "*"
+        years = SHARD_PERIODS[self._shard_by]
+        periods = [('main', MAIN_SHARD_YEARS)] + [
+            ('shard_%d' % year, (year, year + years - 1))
+            for year in self._shards]
+        return ["SELECT %s, %d AS shard_start, %d AS shard_end FROM %s.%s" % (
+                columns, start, end, schema, table)
+                for schema, (start, end) in periods]
+
+    @property
+    def indexes_deferred(self):
+        """
+        True inside :meth:`deferred_indexes`, while the spatial indexes
+        are missing or empty
+        """
+        return self._deferred
+
+    @property
+    def sharded(self):
+        """
+        True if the catalogue file is sharded (see :meth:`__init__`)
+        """
+        return self._shard_by is not None
+
+    def shard_clause(self, tables=('catalogue_origin',), bounds=(None, None)):
+        """
+        Returns the sql condition that joins the measures of a sharded
+        catalogue with the rows of `tables` of the same shard, and
+        skips the shards out of `bounds`, a (lower, upper) pair of the
+        datetimes the origins of a query are within (None if
+        unbounded). As the shard columns are constant in each part of
+        the views of the sharded tables, the query planner drops the
+        parts joining different shards, or out of the bounds, before
+        scanning them. Returns None for a catalogue not sharded.
+        """
+        if not self._shard_by:
+            return None
+        measure = "catalogue_magnitudemeasure"
+        conditions = ["%s.shard_start = %s.shard_start" % (table, measure)
+                      for table in tables]
+        lower, upper = bounds
+        if lower is not None:
+            conditions.append("%s.shard_end >= %d" % (measure, lower.year))
+        if upper is not None:
+            conditions.append("%s.shard_start <= %d" % (measure, upper.year))
+        return sqlalchemy.text(" AND ".join(conditions))
+
+    def _ensure_shard(self, year):
+        """
+        Create the shard of the period starting in `year`, if missing,
+        and attach it to the connection of the session. Pending
+        changes are committed.
+        """
+        if year in self._shards:
+            return
+        self.session.commit()
+        # a shard is a catalogue file on its own
+        Engine(filename=self._shard_filename(year), pool_size=1).close()
+        if self._deferred:
+            self._build_spatial_indexes(year, False)
+        self._shards = sorted(self._shards + [year])
+        connection = self.session.connection().connection
+        self._attach_shards(connection.connection, connection.info)
+        if self._deferred:
+            self._drop_indexes(year)
+
+    def _shard_table(self, table, year):
+        """
+        Returns a copy of the sqlalchemy `table` in the shard of the
+        period starting in `year`, or in the catalogue file if `year`
+        is None
+        """
+        schema = _schema(year)
+        key = (table.name, schema)
+        if not key in self._shard_tables:
+            self._shard_tables[key] = table.tometadata(
+                sqlalchemy.MetaData(), schema=schema)
+        return self._shard_tables[key]
+
+    def _route(self, class_object, rows):
+        """
+        Returns a dictionary that maps the starting years of the shards
+        to the `rows` of `class_object` they store. Origins are stored
+        into the shard of their time, measures and metadata into the
+        shard of their origin. Rows referring to an origin or a measure
+        not in any shard are stored in the catalogue file (key None).
+        """
+        if class_object is Origin:
+            keys = [self._shard_of_time(row['time']) for row in rows]
+        else:
+            if class_object is MagnitudeMeasure:
+                table, column = 'catalogue_origin', 'origin_id'
+            else:
+                table, column = 'catalogue_magnitudemeasure', \
+                    'magnitudemeasure_id'
+            shards = self._shards_of(table, set(row[column] for row in rows))
+            keys = [shards.get(row[column]) for row in rows]
+        routes = {}
+        for key, row in zip(keys, rows):
+            routes.setdefault(key, []).append(row)
+        return routes
+
+    def _shards_of(self, table, ids):
+        """
+        Returns a dictionary that maps the `ids` of rows of `table`
+        to the starting year of the shard storing them
+        """
+        ids = list(ids)
+        shards = {}
+        for year in self._shards:
+            # the number of the parameters of a statement is limited
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                for row in self.session.execute(
+                    "SELECT id FROM shard_%d.%s WHERE id IN (%s)" % (
+                        year, table, ", ".join(
+                            str(int(row_id)) for row_id in chunk))):
+                    shards[row[0]] = year
+        return shards
 
     def _create_schema_eventsource(self):
         """Create Event Source Schema"""
@@ -84,7 +503,7 @@ class Engine(object):
                               primary_key=True),
             sqlalchemy.Column('created_at',
                               sqlalchemy.DateTime,
-                              default=datetime.now()),
+                              default=datetime.now),
             sqlalchemy.Column('name',
                               sqlalchemy.String(255), unique=True))
         orm.Mapper(EventSource, eventsource)
@@ -100,7 +519,7 @@ class Engine(object):
             sqlalchemy.Column('id',
                               sqlalchemy.Integer, primary_key=True),
             sqlalchemy.Column('created_at',
-                              sqlalchemy.DateTime, default=datetime.now()),
+                              sqlalchemy.DateTime, default=datetime.now),
             sqlalchemy.Column('source_key',
                               sqlalchemy.String(), nullable=False),
             sqlalchemy.Column('eventsource_id',
@@ -108,6 +527,9 @@ class Engine(object):
                               sqlalchemy.ForeignKey(
                     'catalogue_eventsource.id'),
                     nullable=False))
+        sqlalchemy.Index('ix_catalogue_agency_source_key',
+                         agency.c.source_key, agency.c.eventsource_id,
+                         unique=True)
         orm.Mapper(Agency, agency, properties={
                 'eventsource': orm.relationship(
                     EventSource,
@@ -124,7 +546,7 @@ class Engine(object):
             'catalogue_event', metadata,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
             sqlalchemy.Column('created_at',
-                              sqlalchemy.DateTime, default=datetime.now()),
+                              sqlalchemy.DateTime, default=datetime.now),
             sqlalchemy.Column('source_key',
                               sqlalchemy.String(), nullable=False),
             sqlalchemy.Column('name',
@@ -133,6 +555,9 @@ class Engine(object):
                               sqlalchemy.ForeignKey(
                     'catalogue_eventsource.id'),
                     nullable=False))
+        sqlalchemy.Index('ix_catalogue_event_source_key',
+                         event.c.source_key, event.c.eventsource_id,
+                         unique=True)
         orm.Mapper(Event, event, properties={
                 'eventsource': orm.relationship(EventSource,
                                                 backref=orm.backref('events'))
@@ -148,7 +573,7 @@ class Engine(object):
             'catalogue_magnitudemeasure', metadata,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
             sqlalchemy.Column('created_at',
-                              sqlalchemy.DateTime, default=datetime.now()),
+                              sqlalchemy.DateTime, default=datetime.now),
             sqlalchemy.Column('event_id',
                               sqlalchemy.Integer,
                               sqlalchemy.ForeignKey('catalogue_event.id'),
@@ -161,11 +586,16 @@ class Engine(object):
                               sqlalchemy.Integer,
                               sqlalchemy.ForeignKey('catalogue_origin.id'),
                               nullable=False),
-            sqlalchemy.Column('scale', sqlalchemy.Enum(*SCALES)),
+            sqlalchemy.Column('scale', sqlalchemy.Enum(*SCALES), index=True),
             sqlalchemy.Column('value', sqlalchemy.Float()),
             sqlalchemy.Column('standard_error',
                               sqlalchemy.Float(),
                               nullable=True))
+        sqlalchemy.Index('ix_catalogue_magnitudemeasure_event_id',
+                         magnitudemeasure.c.event_id,
+                         magnitudemeasure.c.origin_id,
+                         magnitudemeasure.c.agency_id,
+                         magnitudemeasure.c.scale, unique=True)
 
         orm.Mapper(MagnitudeMeasure, magnitudemeasure, properties={
                 'event': orm.relationship(Event,
@@ -184,7 +614,7 @@ class Engine(object):
             'catalogue_origin', metadata,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
             sqlalchemy.Column('created_at',
-                              sqlalchemy.DateTime, default=datetime.now()),
+                              sqlalchemy.DateTime, default=datetime.now),
             sqlalchemy.Column('source_key',
                               sqlalchemy.String(), nullable=False),
             sqlalchemy.Column('eventsource_id',
@@ -192,12 +622,13 @@ class Engine(object):
                               sqlalchemy.ForeignKey(
                     'catalogue_eventsource.id'),
                     nullable=False),
-            sqlalchemy.Column('time', sqlalchemy.DateTime, nullable=False),
+            sqlalchemy.Column('time', sqlalchemy.DateTime, nullable=False,
+                              index=True),
             sqlalchemy.Column('time_error', sqlalchemy.Float(), nullable=True),
             sqlalchemy.Column('time_rms', sqlalchemy.Float(), nullable=True),
-            geoalchemy.GeometryExtensionColumn('position',
-                                               geoalchemy.Point(2, srid=4326),
-                                               nullable=False),
+            geoalchemy.GeometryExtensionColumn(
+                'position', geoalchemy.Point(2, srid=4326, spatial_index=True),
+                nullable=False),
             sqlalchemy.Column('semi_minor_90error',
                               sqlalchemy.Float(),
                               nullable=True),
@@ -205,13 +636,34 @@ class Engine(object):
                               sqlalchemy.Float(), nullable=True),
             sqlalchemy.Column('depth', sqlalchemy.Float(), nullable=True),
             sqlalchemy.Column('depth_error',
-                              sqlalchemy.Float(), nullable=True))
+                              sqlalchemy.Float(), nullable=True),
+            # the coordinates of the position and the seconds since
+            # the epoch of the time, set by ORIGIN_TRIGGERS
+            sqlalchemy.Column('latitude', sqlalchemy.Float(),
+                              server_default=sqlalchemy.FetchedValue(),
+                              server_onupdate=sqlalchemy.FetchedValue()),
+            sqlalchemy.Column('longitude', sqlalchemy.Float(),
+                              server_default=sqlalchemy.FetchedValue(),
+                              server_onupdate=sqlalchemy.FetchedValue()),
+            sqlalchemy.Column('epoch', sqlalchemy.Float(),
+                              server_default=sqlalchemy.FetchedValue(),
+                              server_onupdate=sqlalchemy.FetchedValue()))
+        sqlalchemy.Index('ix_catalogue_origin_source_key',
+                         origin.c.source_key, origin.c.eventsource_id,
+                         unique=True)
+        sqlalchemy.Index('ix_catalogue_origin_latitude',
+                         origin.c.latitude, origin.c.longitude)
         orm.Mapper(Origin, origin, properties={
                 'eventsource': orm.relationship(
                     EventSource,
                     backref=orm.backref('origins')),
                 'position': geoalchemy.GeometryColumn(origin.c.position)})
         geoalchemy.GeometryDDL(origin)
+        # the triggers refer to the position, added by GeometryDDL. DDL
+        # formats its statement, hence the escaped percent signs
+        for trigger in ORIGIN_TRIGGERS:
+            sqlevent.listen(origin, 'after_create',
+                            sqlalchemy.DDL(trigger.replace('%', '%%')))
 
     def _create_schema_measuremetadata(self):
         """Create the schema for the measure metadata model"""
@@ -222,7 +674,7 @@ class Engine(object):
             'catalogue_measuremetadata', metadata,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
             sqlalchemy.Column('created_at', sqlalchemy.DateTime,
-                              default=datetime.now()),
+                              default=datetime.now),
             sqlalchemy.Column('magnitudemeasure_id', sqlalchemy.Integer,
                               sqlalchemy.ForeignKey(
                     'catalogue_magnitudemeasure.id'),
@@ -231,12 +683,72 @@ class Engine(object):
                               sqlalchemy.Enum(*METADATA_TYPES),
                               nullable=False),
             sqlalchemy.Column('value', sqlalchemy.Float(), nullable=False))
+        sqlalchemy.Index('ix_catalogue_measuremetadata_magnitudemeasure_id',
+                         measuremetadata.c.magnitudemeasure_id,
+                         measuremetadata.c.name, unique=True)
         orm.Mapper(MeasureMetadata, measuremetadata, properties={
                 'magnitudemeasure': orm.relationship(
                     MagnitudeMeasure,
                     backref=orm.backref('metadata'))})
         geoalchemy.GeometryDDL(measuremetadata)
 
+    def _create_schema_importcheckpoint(self):
+        """Create the schema for the import checkpoint model"""
+
+        metadata = self._metadata
+
+        importcheckpoint = sqlalchemy.Table(
+            'catalogue_importcheckpoint', metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('created_at', sqlalchemy.DateTime,
+                              default=datetime.now),
+            sqlalchemy.Column('source',
+                              sqlalchemy.String(), nullable=False,
+                              unique=True),
+            sqlalchemy.Column('eventsource_id',
+                              sqlalchemy.Integer,
+                              sqlalchemy.ForeignKey(
+                    'catalogue_eventsource.id'),
+                    nullable=True),
+            sqlalchemy.Column('byte_offset', sqlalchemy.Integer,
+                              nullable=False),
+            sqlalchemy.Column('line_num', sqlalchemy.Integer,
+                              nullable=False),
+            sqlalchemy.Column('digest', sqlalchemy.String(40),
+                              nullable=True),
+            sqlalchemy.Column('last_event', sqlalchemy.String(),
+                              nullable=True))
+        orm.Mapper(ImportCheckpoint, importcheckpoint, properties={
+                'eventsource': orm.relationship(EventSource)})
+        geoalchemy.GeometryDDL(importcheckpoint)
+
+    def _create_schema_measurerow(self):
+        """Create the denormalised table of the measures, with a row
+        per measure holding the values of its event, agency and origin
+        (see :meth:`refresh_measure_rows`). It is not mapped to a
+        model."""
+
+        metadata = self._metadata
+
+        sqlalchemy.Table(
+            'catalogue_measurerow', metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer,
+                              sqlalchemy.ForeignKey(
+                    'catalogue_magnitudemeasure.id'),
+                    primary_key=True, autoincrement=False),
+            sqlalchemy.Column('event_id', sqlalchemy.Integer, index=True),
+            sqlalchemy.Column('origin_id', sqlalchemy.Integer),
+            sqlalchemy.Column('event_key', sqlalchemy.String()),
+            sqlalchemy.Column('eventsource', sqlalchemy.String(255)),
+            sqlalchemy.Column('agency_key', sqlalchemy.String(), index=True),
+            sqlalchemy.Column('scale', sqlalchemy.String(), index=True),
+            sqlalchemy.Column('value', sqlalchemy.Float()),
+            sqlalchemy.Column('standard_error', sqlalchemy.Float()),
+            sqlalchemy.Column('epoch', sqlalchemy.Float(), index=True),
+            sqlalchemy.Column('latitude', sqlalchemy.Float()),
+            sqlalchemy.Column('longitude', sqlalchemy.Float()),
+            sqlalchemy.Column('depth', sqlalchemy.Float()))
+
     def _create_schema(self):
         """
         Create and contains the model definition. We used
@@ -245,9 +757,14 @@ class Engine(object):
         we can load the spatialite extension and then the spatialite
         metadata needed by geoalchemy to build the orm (s. #_setup
         method)
+
+        The models are mapped by the first engine only, the next ones
+        share its tables (see :attr:`_metadata`).
         """
 
-        orm.clear_mappers()
+        if Engine._metadata is not None:
+            return
+        Engine._metadata = sqlalchemy.MetaData()
 
         self._create_schema_eventsource()
         self._create_schema_agency()
@@ -255,6 +772,8 @@ class Engine(object):
         self._create_schema_magnitudemeasure()
         self._create_schema_origin()
         self._create_schema_measuremetadata()
+        self._create_schema_importcheckpoint()
+        self._create_schema_measurerow()
 
     @staticmethod
     def position_from_latlng(latitude, longitude):
@@ -262,6 +781,484 @@ class Engine(object):
             'POINT(%s %s)' % (latitude, longitude))
         return position
 
+    def bulk_insert(self, class_object, rows):
+        """
+        Insert `rows` (a list of dictionaries with the same keys) into
+        the table mapped by `class_object` with a single executemany
+        statement. Origin rows give their position by the `latitude`
+        and `longitude` keys. In a sharded catalogue, the rows of the
+        sharded tables are stored with a statement per shard, and the
+        missing shards are created.
+        """
+        table = orm.class_mapper(class_object).mapped_table
+        if self._shard_by and table.name in SHARDED_TABLES:
+            for year, shard_rows in self._route(class_object, rows).items():
+                if year is not None:
+                    self._ensure_shard(year)
+                self._insert(self._shard_table(table, year), shard_rows)
+        else:
+            self._insert(table, rows)
+        self.bump_generation()
+
+    def _insert(self, table, rows):
+        statement = table.insert()
+        if table.name == 'catalogue_origin':
+            statement = statement.values(position=sqlalchemy.func.MakePoint(
+                    sqlalchemy.bindparam('position_x'),
+                    sqlalchemy.bindparam('position_y'), 4326))
+            rows = [_position_params(row) for row in rows]
+        self.session.execute(statement, rows)
+
+    @property
+    def measure_rows(self):
+        """
+        The denormalised table of the measures, updated with the
+        measures stored since its last refresh (see
+        :meth:`refresh_measure_rows`)
+        """
+        self._append_measure_rows()
+        return self._metadata.tables['catalogue_measurerow']
+
+    def refresh_measure_rows(self, full=False):
+        """
+        Append to the denormalised table of the measures the rows of
+        the measures stored since its last refresh, by a single
+        statement joining the new measures with their event, event
+        source, agency and origin. As the table is refreshed
+        incrementally, measures, events or origins modified in place
+        are updated only by a `full` refresh, that rebuilds the whole
+        table. The changes are committed.
+        """
+        if full:
+            for schema in self._schemas():
+                self.session.execute(
+                    "DELETE FROM %s.catalogue_measurerow" % schema)
+            self.bump_generation()
+        self._append_measure_rows()
+        self.session.commit()
+
+    def _append_measure_rows(self):
+        """
+        Append the rows of the new measures to the denormalised table,
+        if any. The rows of the measures of a shard are stored in the
+        same shard.
+        """
+        self.session.flush()
+        for schema in self._schemas():
+            last_row, last_measure = self.session.execute(
+                "SELECT (SELECT max(id) FROM %(schema)s.catalogue_measurerow),"
+                " (SELECT max(id) FROM %(schema)s.catalogue_magnitudemeasure)"
+                % {'schema': schema}).fetchone()
+            if last_measure is None or last_measure == last_row:
+                continue
+            self.session.execute("""
+INSERT INTO %(schema)s.catalogue_measurerow (
+  id, event_id, origin_id, event_key, eventsource, agency_key, scale,
+  value, standard_error, epoch, latitude, longitude, depth)
+SELECT m.id, m.event_id, m.origin_id, e.source_key, s.name, a.source_key,
+  m.scale, m.value, m.standard_error,
+  o.epoch, o.latitude, o.longitude, o.depth
+FROM %(schema)s.catalogue_magnitudemeasure AS m
+JOIN main.catalogue_event AS e ON e.id = m.event_id
+JOIN main.catalogue_eventsource AS s ON s.id = e.eventsource_id
+JOIN main.catalogue_agency AS a ON a.id = m.agency_id
+JOIN %(schema)s.catalogue_origin AS o ON o.id = m.origin_id
+WHERE m.id > :last_row""" % {'schema': schema},
+                                 {'last_row': last_row or 0})
+
+    def save_snapshot(self, filename):
+        """
+        Save the catalogue to the snapshot `filename`, a numpy archive
+        with an array per column (see
+        :func:`eqcatalogue.datastores.columnar.save_snapshot`)
+        """
+        columnar.save_snapshot(columnar.read_tables(self.session), filename)
+
+    def load_snapshot(self, filename):
+        """
+        Store the rows of the snapshot `filename` into the catalogue,
+        that is expected to be empty, as the ids of the rows are
+        kept. The rows are stored :data:`SNAPSHOT_BATCH_SIZE` at a
+        time, and the indexes are built once, after all the rows are
+        stored.
+        """
+        tables = columnar.load_snapshot(filename)
+        with self.deferred_indexes():
+            for class_object in SNAPSHOT_TABLES:
+                table = tables[class_object]
+                for start in range(0, len(table), SNAPSHOT_BATCH_SIZE):
+                    rows = table.rows(start, start + SNAPSHOT_BATCH_SIZE)
+                    if class_object is Origin:
+                        for row in rows:
+                            row['latitude'] = row.pop('position_x')
+                            row['longitude'] = row.pop('position_y')
+                    self.bulk_insert(class_object, rows)
+            self._append_measure_rows()
+            self.session.commit()
+
+    def _spatial_indexes(self):
+        """
+        Returns the (table name, column name) pairs of the geometry
+        columns with a spatial index
+        """
+        return [(table.name, column.name)
+                for table in self._metadata.sorted_tables
+                for column in table.columns
+                if getattr(column.type, 'spatial_index', False)]
+
+    def _on_connect(self, dbapi_connection, connection_rec=None):
+        """Load the spatialite extension and set the pragmas of the
+        profile on each new connection of the pool. Event handler
+        triggered by sqlalchemy"""
+        _connect(dbapi_connection, connection_rec)
+        _set_pragmas(dbapi_connection, self._profile)
+        if connection_rec is not None:
+            connection_rec.info['profile'] = self._profile
+
+    def _on_execute(self, connection, cursor, statement, parameters,
+                    context, executemany):
+        """Count the statements run on the database, such that the
+        queries issued per object, e.g. by lazy loads, show up. Event
+        handler triggered by sqlalchemy"""
+        self.statement_count += 1
+
+    def _on_flush(self, session, flush_context):
+        """Bump the generation of the catalogue when objects are
+        stored, changed or deleted. Event handler triggered by
+        sqlalchemy"""
+        self.bump_generation()
+
+    def _on_sharded_flush(self, session, flush_context, instances):
+        """Reject the objects of the sharded tables stored, changed or
+        deleted by the session of a sharded catalogue, as the tables
+        are read through views that can not be written (see
+        :meth:`bulk_insert`). Event handler triggered by sqlalchemy"""
+        for instance in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            if isinstance(instance, SHARDED_MODELS):
+                raise ValueError(
+                    "The %s of a sharded catalogue are written by bulk "
+                    "inserts only (see bulk_insert and the bulk importers)"
+                    % orm.class_mapper(type(instance)).mapped_table.name)
+
+    def remove_session(self):
+        """
+        Close the session of the current thread, returning its
+        connection to the pool. A new session is created by the next
+        access to the catalogue from the thread.
+        """
+        self.session.remove()
+
+    def close(self):
+        """
+        Close the session of the current thread and all the
+        connections to the database
+        """
+        self.session.remove()
+        self._engine.dispose()
+
+    @property
+    def profile(self):
+        """
+        The name of the settings of the connections
+        """
+        return self._profile
+
+    def set_profile(self, profile):
+        """
+        Switch the connections to the settings of `profile`, e.g. to
+        analyse a catalogue just imported with the `bulk_load`
+        profile. Pending changes are committed and the session of the
+        current thread is closed. The idle connections of a file
+        database are closed, and the connections in use by other
+        threads are switched when they are checked out again.
+        """
+        _check_profile(profile)
+        self.session.commit()
+        self.session.remove()
+        self._profile = profile
+        # the only connection of an in-memory database holds the data
+        if not isinstance(self._engine.pool, sqlalchemy.pool.StaticPool):
+            self._engine.dispose()
+
+    def _migrate(self):
+        """
+        Upgrade a catalogue created by a previous version of the
+        schema, whose version is stored in the user_version pragma of
+        the database. The tables, and the indexes, missing in the
+        catalogues before version 1 and 2 are created by
+        :meth:`__init__`. Version 3 adds the latitude, longitude and
+        epoch columns of the origins and version 4 computes the epochs
+        with the microseconds of the times, so before version 4 the
+        columns are added if missing, their triggers are created again,
+        and the columns and the denormalised rows of the measures that
+        copy them are computed again.
+        """
+        connection = self.session.connection()
+        version = self._schema_version()
+        if version < 4:
+            self._add_origin_columns(connection)
+            connection.execute("DELETE FROM main.catalogue_measurerow")
+            self._append_measure_rows()
+        if version < SCHEMA_VERSION:
+            connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.session.commit()
+
+    def _add_origin_columns(self, connection):
+        """
+        Add the latitude, longitude and epoch columns to the origins
+        of a catalogue created before schema version 3, if missing,
+        create again their triggers, and compute their values
+        """
+        existing = set(row[1] for row in connection.execute(
+                "PRAGMA main.table_info(catalogue_origin)"))
+        for name in ('latitude', 'longitude', 'epoch'):
+            if not name in existing:
+                connection.execute(
+                    "ALTER TABLE main.catalogue_origin ADD COLUMN %s FLOAT" %
+                    name)
+        for name in ORIGIN_TRIGGER_NAMES:
+            connection.execute("DROP TRIGGER IF EXISTS main.%s" % name)
+        for trigger in ORIGIN_TRIGGERS:
+            connection.execute(trigger)
+        connection.execute(
+            "UPDATE main.catalogue_origin SET latitude = X(position), "
+            "longitude = Y(position), epoch = %s" %
+            (EPOCH_SQL % {'time': "time"}))
+
+    def _ensure_indexes(self):
+        """
+        Create the indexes missing in the database, e.g. in catalogues
+        created before schema version 1. A unique index is not created
+        on a table that already holds duplicated rows, e.g. the origins
+        stored twice by the importers of those versions, as the
+        catalogue could not be opened at all, not even to remove them.
+        A warning names the table and the duplicated columns instead,
+        and the index is created by the first opening of the catalogue
+        after the duplicates are removed.
+        """
+        connection = self.session.connection()
+        existing = set(row[0] for row in connection.execute(
+                "SELECT name FROM main.sqlite_master WHERE type = 'index'"))
+        for table in self._metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                columns = ", ".join(column.name for column in index.columns)
+                if index.unique:
+                    duplicates = connection.execute(
+                        "SELECT count(*) FROM (SELECT 1 FROM main.%s "
+                        "GROUP BY %s HAVING count(*) > 1)" % (
+                            table.name, columns)).scalar()
+                    if duplicates:
+                        warnings.warn(
+                            "%s holds %d groups of rows with the same %s, "
+                            "so the unique index %s is not created. Remove "
+                            "the duplicated rows, e.g. by importing the "
+                            "catalogue again into a new file, and open the "
+                            "catalogue again to create it." % (
+                                table.name, duplicates, columns, index.name))
+                        continue
+                connection.execute(_create_index_sql(index, 'main'))
+        self.session.commit()
+
+    def _schema_version(self):
+        """
+        Returns the schema version of the catalogue, 0 for a new one
+        """
+        return self.session.execute("PRAGMA user_version").scalar()
+
+    def _ensure_spatial_indexes(self):
+        """
+        Create the spatial indexes missing in the database, e.g. in
+        catalogues created before the index was declared. The index
+        of the origin positions, maintained by triggers, is used by
+        the spatial criteria to select the candidate origins (see
+        :mod:`eqcatalogue.filtering`)
+        """
+        for table, column in self._spatial_indexes():
+            if not self._engine.has_table('idx_%s_%s' % (table, column)):
+                self.session.execute(
+                    "SELECT CreateSpatialIndex('%s', '%s')" % (table, column))
+        self.session.commit()
+
+    @contextmanager
+    def deferred_indexes(self):
+        """
+        Context manager that drops the secondary indexes and the
+        spatial indexes of the catalogue, and of all its shards, so
+        that the rows stored inside the block do not update them one
+        by one. The shards created inside the block have their indexes
+        dropped too. At the end of the block, the indexes are built
+        again in a single pass and the statistics used by the query
+        planner are updated.
+
+        e.g.::
+          with engine.deferred_indexes():
+              V1(stream, cat).store(bulk=True)
+        """
+        self._deferred = True
+        for year in [None] + self._shards:
+            self._build_spatial_indexes(year, False)
+            self._drop_indexes(year)
+        self.session.commit()
+
+        try:
+            yield
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            self._deferred = False
+            self.session.commit()
+            for year in [None] + self._shards:
+                self._create_indexes(year)
+                self._build_spatial_indexes(year, True)
+            self.session.execute("ANALYZE")
+            self.session.commit()
+
+    def _indexes(self):
+        """
+        Returns the secondary indexes of the tables of the catalogue
+        """
+        return [index for table in self._metadata.sorted_tables
+                for index in table.indexes]
+
+    def _drop_indexes(self, year):
+        """
+        Drop the secondary indexes of the shard of the period starting
+        in `year`, or of the catalogue file if `year` is None
+        """
+        for index in self._indexes():
+            self.session.execute("DROP INDEX IF EXISTS %s.%s" % (
+                    _schema(year), index.name))
+
+    def _create_indexes(self, year):
+        """
+        Create the secondary indexes of the shard of the period
+        starting in `year`, or of the catalogue file if `year` is None
+        """
+        for index in self._indexes():
+            self.session.execute(_create_index_sql(index, _schema(year)))
+
+    def _build_spatial_indexes(self, year, build):
+        """
+        Build (if `build` is True) or drop the spatial indexes of the
+        shard of the period starting in `year`, or of the catalogue
+        file if `year` is None. In a sharded catalogue, a dropped index
+        is replaced by an empty table, that keeps its views valid. The
+        spatialite functions work on the tables of the main database
+        only, and their statements would read and write the views of a
+        sharded catalogue instead of its tables, so the indexes of a
+        sharded catalogue are built on a connection of their own to
+        each file. The pending changes are committed.
+        """
+        statements = []
+        for table, column in self._spatial_indexes():
+            if build:
+                statements += [
+                    "DROP TABLE IF EXISTS main.idx_%s_%s" % (table, column),
+                    "SELECT CreateSpatialIndex('%s', '%s')" % (table, column)]
+            else:
+                statements += [
+                    "SELECT DisableSpatialIndex('%s', '%s')" % (table, column),
+                    "DROP TABLE IF EXISTS main.idx_%s_%s" % (table, column)]
+                if self._shard_by:
+                    statements.append(
+                        "CREATE VIRTUAL TABLE main.idx_%s_%s USING rtree("
+                        "pkid, xmin, xmax, ymin, ymax)" % (table, column))
+        if not self._shard_by:
+            for statement in statements:
+                self.session.execute(statement)
+            self.session.commit()
+            return
+        self.session.commit()
+        connection = sqlite.connect(self._filename if year is None
+                                    else self._shard_filename(year))
+        try:
+            _connect(connection)
+            for statement in statements:
+                connection.execute(statement).fetchall()
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def _position_params(row):
+    """
+    Returns a copy of an origin `row` where latitude and longitude
+    are given also as the coordinates of the point built by
+    `Engine.position_from_latlng`, and the time also as seconds since
+    the epoch
+    """
+    row = dict(row)
+    row['position_x'] = row['latitude']
+    row['position_y'] = row['longitude']
+    row['epoch'] = _epoch(row['time'])
+    return row
+
+
+def _epoch(time):
+    """
+    Returns the seconds since the epoch of a naive utc datetime
+    """
+    return calendar.timegm(time.utctimetuple()) + time.microsecond / 1e6
+
+
+def _schema(year):
+    """
+    Returns the name of the database of the shard of the period
+    starting in `year`, or of the catalogue file if `year` is None
+    """
+    return 'main' if year is None else 'shard_%d' % year
+
+
+def _create_index_sql(index, schema):
+    """
+    Returns the statement that creates the sqlalchemy `index` in the
+    database `schema`, if missing. The names are qualified, as the
+    temporary views of a sharded catalogue hide its tables.
+    """
+    return "CREATE %sINDEX IF NOT EXISTS %s.%s ON %s (%s)" % (
+        "UNIQUE " if index.unique else "", schema, index.name,
+        index.table.name, ", ".join(column.name for column in index.columns))
+
+
+def _file_schema_version(filename):
+    """
+    Returns the schema version of the catalogue file `filename`,
+    without loading the spatialite extension
+    """
+    connection = sqlite.connect(filename)
+    try:
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def _check_profile(profile):
+    if not profile in PROFILES:
+        raise ValueError("Unknown profile %s. Valid profiles are: %s" % (
+                profile, ", ".join(sorted(PROFILES))))
+
+
+def _set_pragmas(dbapi_connection, profile):
+    """
+    Set the pragmas of `profile` on a dbapi connection. As some of
+    them can not be changed inside a transaction, the pending one is
+    committed and the pragmas are executed in autocommit mode.
+    """
+    dbapi_connection.commit()
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    try:
+        cursor = dbapi_connection.cursor()
+        for pragma, value in PROFILES[profile]:
+            cursor.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+        cursor.close()
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+
 
 def _initialize_spatialite_db(connection):
     """Initialize Spatialite Database. Needed only when a newly
@@ -289,11 +1286,14 @@ def _load_extension(session):
     # guess different filename for the spatialite extension and use a
     # variable as a sentinel. The exceptions raised are saved in the
     # variable exception for further printing/logging
+    global _loaded_library
     exceptions, loaded = {}, False
-    for library in [SO_LIBRARY, DLL_LIBRARY, DYLIB_LIBRARY]:
+    for library in ([_loaded_library] if _loaded_library else
+                    [SO_LIBRARY, DLL_LIBRARY, DYLIB_LIBRARY]):
         try:
             session.execute("select load_extension('%s')" % library)
-            loaded = True
+            _loaded_library, loaded = library, True
+            break
         except sqlite.OperationalError as e:
             exceptions[library] = e
 
@@ -18,8 +18,283 @@ Module :mod:`eqcatalogue.filtering` defines the abstract class
 :class:`Criteria` and its derived classes.
 """
 
+import re
+import math
+import sys
+import collections
+
+import numpy as np
+from sqlalchemy import orm
+from sqlalchemy.sql import expression, func
+
 import eqcatalogue.models as db
 from eqcatalogue import exceptions
+from eqcatalogue.datastores import columnar
+
+
+# The R*Tree index of the origin positions (see
+# :meth:`eqcatalogue.datastores.spatialite.Engine._ensure_spatial_indexes`)
+SPATIAL_INDEX = 'idx_catalogue_origin_position'
+
+# A lower bound of the length in meters of one degree of latitude,
+# such that the bounding box of a distance never misses a point
+METERS_PER_DEGREE = 110000.
+
+# The number of measures loaded at a time by Criteria.stream
+STREAM_BATCH_SIZE = 1000
+
+# The relationships of the measures loaded together with them by
+# default (see Criteria.eager_load)
+EAGER_RELATIONSHIPS = ('origin', 'agency', 'event')
+
+# The relationships of the measures joined by the queries of the
+# criteria, whose rows are loaded from the joins
+JOINED_RELATIONSHIPS = ('origin', 'agency')
+
+# The default limits of the cache of the results (see enable_cache)
+CACHE_MAX_ENTRIES = 128
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The cache of the results of the criteria, None if disabled
+_cache = None
+
+POINT_REGEXP = re.compile(
+    r'^\s*POINT\s*\(\s*(?P<x>[-+0-9.eE]+)\s+(?P<y>[-+0-9.eE]+)\s*\)\s*$',
+    re.IGNORECASE)
+
+
+def within_bounding_box(xmin, xmax, ymin, ymax):
+    """
+    Returns the sql condition that selects the origins whose position
+    may be in the given bounding box, by looking up the spatial index.
+    The bounds are sql expressions, None for an unbounded side.
+    """
+    conditions = ["%s %s %s" % (bound, operator, value)
+                  for bound, operator, value in (('xmax', '>=', xmin),
+                                                 ('xmin', '<=', xmax),
+                                                 ('ymax', '>=', ymin),
+                                                 ('ymin', '<=', ymax))
+                  if value is not None]
+    return "catalogue_origin.id IN (SELECT pkid FROM %s%s)" % (
+        SPATIAL_INDEX,
+        " WHERE " + " AND ".join(conditions) if conditions else "")
+
+
+def eager_loaders(path):
+    """
+    Returns the query options that load the relationship `path` of
+    the measures, a dotted path like 'event.measures', together with
+    them. Each step is loaded from the joins of the query, by a
+    further join or, for collections, by a further query over all the
+    measures
+    """
+    loaders = []
+    mapper = orm.class_mapper(db.MagnitudeMeasure)
+    names = path.split('.')
+    for i, name in enumerate(names):
+        prefix = '.'.join(names[:i + 1])
+        relationship = mapper.get_property(name)
+        mapper = relationship.mapper
+        if prefix in JOINED_RELATIONSHIPS:
+            loaders.append(orm.contains_eager(prefix))
+        elif relationship.uselist:
+            loaders.append(orm.subqueryload(prefix))
+        else:
+            loaders.append(orm.joinedload(prefix))
+    return loaders
+
+
+def and_(*clauses):
+    """
+    Returns the conjunction of the sql conditions `clauses`, where
+    True and False stand for the constant conditions, which are folded
+    """
+    if False in clauses:
+        return False
+    clauses = [clause for clause in clauses if clause is not True]
+    if not clauses:
+        return True
+    if len(clauses) == 1:
+        return clauses[0]
+    return expression.and_(*clauses)
+
+
+def or_(*clauses):
+    """
+    Returns the disjunction of the sql conditions `clauses`, where
+    True and False stand for the constant conditions, which are folded
+    """
+    if True in clauses:
+        return True
+    clauses = [clause for clause in clauses if clause is not False]
+    if not clauses:
+        return False
+    if len(clauses) == 1:
+        return clauses[0]
+    return expression.or_(*clauses)
+
+
+def not_(clause):
+    """
+    Returns the negation of the sql condition `clause`, where True and
+    False stand for the constant conditions, which are folded
+    """
+    if clause is True or clause is False:
+        return not clause
+    return expression.not_(clause)
+
+
+def result_size(result):
+    """
+    Returns an estimate of the bytes taken by `result`, a result of
+    the criteria: a number, or a list of tuples or a dictionary of
+    numpy arrays
+    """
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, dict):
+        return sys.getsizeof(result) + sum(
+            result_size(value) for value in result.values())
+    if isinstance(result, (list, tuple)):
+        return sys.getsizeof(result) + sum(
+            result_size(value) for value in result)
+    return sys.getsizeof(result)
+
+
+class ResultCache(object):
+    """
+    A least recently used cache of the results of the criteria, keyed
+    by their canonical form (see :meth:`Criteria.key`). The results
+    are discarded as soon as the generation of the catalogue changes
+    (see :meth:`eqcatalogue.models.CatalogueDatabase.generation`).
+
+    :param max_entries: the number of results kept at most.
+    :param max_bytes: the bytes taken at most by the results, as
+      estimated by :func:`result_size`. Larger results are not kept.
+
+    :attribute hits: the number of results found in the cache.
+    :attribute misses: the number of results computed.
+    :attribute evictions: the number of results discarded to keep
+      the cache within its limits.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES,
+                 max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = collections.OrderedDict()
+        self._size = 0
+        # the catalogue and its generation the results come from
+        self._state = None
+
+    def __len__(self):
+        return len(self._results)
+
+    def clear(self):
+        """
+        Discard all the results
+        """
+        self._results.clear()
+        self._size = 0
+
+    def stats(self):
+        """
+        Returns a dictionary with the hits, the misses, the evictions,
+        the number of entries and the bytes taken by the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self),
+                'bytes': self._size}
+
+    def get(self, catalogue, key, compute):
+        """
+        Returns the result `key` of `catalogue`, given by the function
+        `compute` if it is not in the cache
+        """
+        state = (catalogue, catalogue.generation())
+        if (self._state is None or self._state[0] is not catalogue or
+            self._state[1] != state[1]):
+            self.clear()
+            self._state = state
+        if key in self._results:
+            self.hits += 1
+            result, size = self._results.pop(key)
+            self._results[key] = result, size
+            return result
+
+        self.misses += 1
+        result = compute()
+        size = result_size(result)
+        if size <= self.max_bytes:
+            if isinstance(result, dict):
+                # the arrays are shared by all the callers
+                for value in result.values():
+                    value.flags.writeable = False
+            self._results[key] = result, size
+            self._size += size
+            while (len(self._results) > self.max_entries or
+                   self._size > self.max_bytes):
+                _, (_, evicted) = self._results.popitem(last=False)
+                self._size -= evicted
+                self.evictions += 1
+        return result
+
+
+def enable_cache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+    """
+    Cache the results of :meth:`Criteria.count`, :meth:`Criteria.rows`
+    and :meth:`Criteria.to_arrays`, such that evaluating again the
+    same criteria, e.g. in an interactive session, does not query the
+    catalogue again until its data change. Returns the
+    :class:`ResultCache`, that gives the statistics of the cache.
+    """
+    global _cache
+    _cache = ResultCache(max_entries, max_bytes)
+    return _cache
+
+
+def disable_cache():
+    """
+    Stop caching the results of the criteria (see :func:`enable_cache`)
+    """
+    global _cache
+    _cache = None
+
+
+def _combined_eager(*criterias):
+    """
+    Returns the relationships loaded by the combination of
+    `criterias`: the union of the ones set on them by
+    :meth:`Criteria.eager_load`, or the default ones if none is set
+    """
+    paths = []
+    for criteria in criterias:
+        if criteria._eager is not EAGER_RELATIONSHIPS:
+            paths.extend(path for path in criteria._eager
+                         if not path in paths)
+    if not paths:
+        return EAGER_RELATIONSHIPS
+    return tuple(paths)
+
+
+def _combined_key(operator, *keys):
+    """
+    Returns the key of the combination by `operator` of the criteria
+    with the given `keys`, that does not depend on their order or
+    nesting, None if one of the keys is None
+    """
+    if None in keys:
+        return None
+    members = set()
+    for key in keys:
+        if key[0] == operator:
+            members.update(key[1])
+        else:
+            members.add(key)
+    return operator, frozenset(members)
 
 
 class Criteria(object):
@@ -28,7 +303,12 @@ class Criteria(object):
     check if a criteria holds for a measure and to return all the
     measures stored in a catalogue database that statisfy the
     specified criteria. Criteria can be combined with logical
-    operators.
+    operators, and the whole combination is compiled into the
+    condition of a single query (see :meth:`clause`).
+
+    With a catalogue that keeps its data as columns (see
+    :mod:`eqcatalogue.datastores.columnar`), measures are selected
+    by the vectorised masks of the criteria rather than by queries.
 
     :param _cat: a Catalogue Database object.
     """
@@ -36,8 +316,51 @@ class Criteria(object):
     def __init__(self):
         self._cat = db.CatalogueDatabase()
         self._session = self._cat.session
-        self.default_queryset = self._session.query(
-            db.MagnitudeMeasure).join(db.Origin).join(db.Agency)
+        self._eager = EAGER_RELATIONSHIPS
+        # True while the measures are selected by the filter of a
+        # derived class (see clause)
+        self._filtering = False
+
+    @property
+    def default_queryset(self):
+        """
+        The query of all the measures joined with their origins and
+        agencies, that loads the relationships set by
+        :meth:`eager_load`, or the selection of all the measures of a
+        columnar catalogue
+        """
+        if self._session is None:
+            return self._cat.selection()
+        return self._query(self._eager)
+
+    def _query(self, relationships):
+        """
+        Returns the query of all the measures joined with their
+        origins and agencies, that loads `relationships` too
+        """
+        return self._session.query(db.MagnitudeMeasure).join(
+            db.Origin).join(db.Agency).options(
+            *[loader for path in relationships
+              for loader in eager_loaders(path)])
+
+    def eager_load(self, *paths):
+        """
+        Set the relationships of the measures loaded together with
+        them when the criteria is evaluated, such that reading them
+        does not issue a query per measure, and returns the criteria.
+        By default the origin, the agency and the event of the
+        measures are loaded (see :data:`EAGER_RELATIONSHIPS`). E.g. a
+        pipeline that walks the measures of the events, like
+        :class:`eqcatalogue.selection.MUSSetEventMaximum`, can use::
+
+          C(scale='mb').eager_load('origin', 'agency', 'event.measures')
+
+        A combination of criteria loads the relationships set on any
+        of its members (see :func:`_combined_eager`), unless they are
+        set on the combination itself.
+        """
+        self._eager = paths
+        return self
 
     def filter(self, queryset=None):
         """
@@ -46,7 +369,75 @@ class Criteria(object):
         in the catalogue are considered
         """
         queryset = queryset or self.default_queryset
-        return queryset.filter()
+        if self._session is None:
+            return queryset.restrict(self.mask)
+        clause = and_(self.clause(), self._shard_clause())
+        if clause is True:
+            return queryset
+        return queryset.filter(expression.false() if clause is False
+                               else clause)
+
+    def clause(self):
+        """
+        Returns the sql condition on the measures joined with their
+        origins and agencies that the measures satisfying the criteria
+        fulfill. True and False stand for the conditions that hold for
+        all or for none of the measures.
+
+        Derived classes that select their measures by overriding
+        :meth:`filter` only, as before the criteria were compiled into
+        a single query, get the condition on the ids of the measures
+        their filter selects, so that they can still be combined.
+        """
+        if not _overrides_filter(self) or self._filtering:
+            return True
+        self._filtering = True
+        try:
+            measure_ids = self.filter().with_entities(
+                db.MagnitudeMeasure.id).statement
+        finally:
+            self._filtering = False
+        # the enclosing query joins the same tables
+        return db.MagnitudeMeasure.id.in_(measure_ids.correlate(None))
+
+    def time_bounds(self):
+        """
+        Returns the (lower, upper) bounds of the times of the origins
+        of the measures satisfying the criteria, as datetimes, None
+        for an unbounded side. The queries on a sharded catalogue look
+        up only the shards within the bounds (see :meth:`filter`).
+        """
+        return None, None
+
+    def _shard_clause(self, tables=('catalogue_origin',)):
+        """
+        Returns the sql condition that joins the measures with the
+        rows of `tables` of the same shard of a sharded catalogue, and
+        skips the shards out of the time bounds of the criteria, or
+        True if the catalogue is not sharded
+        """
+        clause = self._cat.shard_clause(tables, self.time_bounds())
+        return True if clause is None else clause
+
+    def _prefiltered(self, bounding_box, clause):
+        """
+        Returns the sql condition `clause` on the origins, preceded by
+        the condition `bounding_box` that looks up the spatial index
+        (see :func:`within_bounding_box`), unless the indexes of the
+        catalogue are deferred, as the spatial index would miss the
+        origins
+        """
+        if self._cat.indexes_deferred():
+            return clause
+        return expression.and_(expression.text(bounding_box), clause)
+
+    def mask(self, columns):
+        """
+        Returns a boolean array telling which of the measures given
+        by `columns` satisfy the criteria (see
+        :class:`eqcatalogue.datastores.columnar.Columns`)
+        """
+        return np.ones(len(columns), dtype=bool)
 
     def all(self):
         """
@@ -60,18 +451,119 @@ class Criteria(object):
         """
         return self.filter().__iter__()
 
+    def stream(self, batch_size=STREAM_BATCH_SIZE):
+        """
+        Returns an iterator on all the measures that satisfy the
+        criteria, sorted by id, that fetches and builds them
+        `batch_size` at a time together with their origin, agency and
+        event. Measures are not kept by the iterator, so that a whole
+        catalogue can be scanned in bounded memory, as long as the
+        consumer does not keep them either.
+        """
+        if self._session is None:
+            return self.filter().stream(batch_size)
+        return iter(self.filter(self._query(EAGER_RELATIONSHIPS)).order_by(
+                db.MagnitudeMeasure.id).yield_per(batch_size))
+
     def __len__(self):
         return self.count()
 
     def __contains__(self, el):
         return self.predicate(el)
 
+    def key(self):
+        """
+        Returns a hashable form of the criteria, the same for the
+        criteria that select measures by the same conditions however
+        they are combined, used as key of the cache of the results
+        (see :func:`enable_cache`). None if the results of the
+        criteria can not be cached, the default for the derived
+        classes that do not implement it.
+        """
+        if type(self) is Criteria:
+            return ('all',)
+        return None
+
+    def _cached(self, method, compute, *args):
+        """
+        Returns the result of `compute(*args)`, from the cache of the
+        results if it is enabled, under the name `method`
+        """
+        key = self.key()
+        if _cache is None or key is None:
+            return compute(*args)
+        if self._session is not None:
+            # the pending changes are stored, as the queries would
+            # autoflush them, so that the generation of the catalogue
+            # accounts for them
+            self._session.flush()
+        return _cache.get(self._cat, (method, key) + args,
+                          lambda: compute(*args))
+
+    def rows(self, *names):
+        """
+        Returns the values of the columns `names` of the denormalised
+        table of the measures (see
+        :data:`eqcatalogue.datastores.columnar.MEASURE_ROW_COLUMNS`)
+        for the measures that satisfy the criteria, as a list of
+        tuples sorted by measure id. The values of the events, agencies
+        and origins of the measures are read without loading them,
+        e.g.::
+
+          C(scale='mb').rows('event_key', 'agency_key', 'value', 'epoch')
+        """
+        _check_columns(names)
+        return list(self._cached('rows', self._rows, names))
+
+    def _rows(self, names):
+        if self._session is None:
+            return self.filter().rows(names)
+        table = self._cat.measure_rows()
+        # the rows are joined with the measures, rather than looked up
+        # by a subquery, so that the rows of a shard are joined only
+        # with its measures
+        query = self.filter(self._query(())).join(
+            table, table.c.id == db.MagnitudeMeasure.id)
+        shard_clause = self._shard_clause((table.name,))
+        if shard_clause is not True:
+            query = query.filter(shard_clause)
+        return [tuple(row) for row in query.with_entities(
+                *[table.c[name] for name in names]).order_by(table.c.id)]
+
+    def to_arrays(self, *names):
+        """
+        Returns the columns `names` of the denormalised table of the
+        measures for the measures that satisfy the criteria, as a
+        dictionary of numpy arrays sorted by measure id (see
+        :func:`eqcatalogue.datastores.columnar.measure_arrays`), e.g.::
+
+          arrays = C(scale='mb').to_arrays('agency_key', 'value', 'epoch')
+          agencies = arrays['agency_key.values'][arrays['agency_key']]
+
+        No measure is loaded, so that the analytical stages can work
+        on whole catalogues.
+        """
+        _check_columns(names)
+        return dict(self._cached('to_arrays', self._arrays, names))
+
+    def _arrays(self, names):
+        if self._session is None:
+            columns = self.filter().columns
+            return columnar.measure_arrays(
+                dict((name, columns[name]) for name in names))
+        rows = self._rows(names)
+        return columnar.measure_arrays(dict(
+                (name, [row[i] for row in rows])
+                for i, name in enumerate(names)))
+
     def events(self):
         """
         Returns all the distinct events associated with all the
         measures that satisfies the criteria
         """
 
+        if self._session is None:
+            return self.filter().events()
         subquery = self.filter().subquery()
         return self._session.query(db.Event).join(subquery).all()
 
@@ -80,7 +572,13 @@ class Criteria(object):
         Returns a count of all the measures that satisfies the criteria.
         """
 
-        return self.filter().count()
+        return self._cached('count', self._count)
+
+    def _count(self):
+        if self._session is None:
+            return self.filter().count()
+        return self.filter().with_entities(
+            func.count(db.MagnitudeMeasure.id)).scalar()
 
     def predicate(self, measure):
         """
@@ -98,9 +596,13 @@ class Criteria(object):
 
     def __getitem__(self, item):
         """
-        Support for the index protocol
+        Support for the index protocol. Measures are sorted by id, and
+        only the ones indexed are loaded, as slices translate into a
+        LIMIT/OFFSET clause
         """
-        return self.all()[item]
+        if self._session is None:
+            return self.filter()[item]
+        return self.filter().order_by(db.MagnitudeMeasure.id)[item]
 
     def __or__(self, criteria):
         """
@@ -108,6 +610,12 @@ class Criteria(object):
         """
         return AlternativeCriteria(self, criteria)
 
+    def __invert__(self):
+        """
+        Returns the negation of the criteria
+        """
+        return NegatedCriteria(self)
+
     def group_measures(self, grouping_strategy=None):
         """
         Returns a dictionary where the key identifies an event,
@@ -123,6 +631,47 @@ class Criteria(object):
         return grouping_strategy.group_measures(self)
 
 
+def _intersect_bounds(bounds1, bounds2):
+    """
+    Returns the time bounds of the times within both `bounds1` and
+    `bounds2` (see :meth:`Criteria.time_bounds`)
+    """
+    lowers = [bound for bound in (bounds1[0], bounds2[0]) if bound is not None]
+    uppers = [bound for bound in (bounds1[1], bounds2[1]) if bound is not None]
+    return (max(lowers) if lowers else None,
+            min(uppers) if uppers else None)
+
+
+def _join_bounds(bounds1, bounds2):
+    """
+    Returns the time bounds of the times within `bounds1` or `bounds2`
+    (see :meth:`Criteria.time_bounds`)
+    """
+    lowers, uppers = zip(bounds1, bounds2)
+    return (None if None in lowers else min(lowers),
+            None if None in uppers else max(uppers))
+
+
+def _overrides_filter(criteria):
+    """
+    Tells if the class of `criteria` overrides :meth:`Criteria.filter`
+    """
+    method = type(criteria).filter
+    return getattr(method, '__func__', method) is not getattr(
+        Criteria.filter, '__func__', Criteria.filter)
+
+
+def _check_columns(names):
+    """
+    Raises a ValueError if one of `names` is not a column of the
+    denormalised table of the measures
+    """
+    for name in names:
+        if not name in columnar.MEASURE_ROW_COLUMNS:
+            raise ValueError("Unknown column %s. Valid columns are: %s" %
+                             (name, ", ".join(columnar.MEASURE_ROW_COLUMNS)))
+
+
 class CombinedCriteria(Criteria):
     """
     A criteria that is the and-combination of two criterias
@@ -131,10 +680,21 @@ class CombinedCriteria(Criteria):
         super(CombinedCriteria, self).__init__()
         self.criteria1 = criteria1
         self.criteria2 = criteria2
+        self._eager = _combined_eager(criteria1, criteria2)
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return self.criteria1.filter(self.criteria2.filter(queryset))
+    def clause(self):
+        return and_(self.criteria1.clause(), self.criteria2.clause())
+
+    def key(self):
+        return _combined_key('and', self.criteria1.key(),
+                             self.criteria2.key())
+
+    def time_bounds(self):
+        return _intersect_bounds(self.criteria1.time_bounds(),
+                                 self.criteria2.time_bounds())
+
+    def mask(self, columns):
+        return self.criteria1.mask(columns) & self.criteria2.mask(columns)
 
     def predicate(self, measure):
         return (self.criteria1.predicate(measure) and
@@ -149,17 +709,52 @@ class AlternativeCriteria(Criteria):
         super(AlternativeCriteria, self).__init__()
         self.criteria1 = criteria1
         self.criteria2 = criteria2
+        self._eager = _combined_eager(criteria1, criteria2)
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return (self.criteria1.filter(queryset).union(
-                self.criteria2.filter(queryset)))
+    def clause(self):
+        return or_(self.criteria1.clause(), self.criteria2.clause())
+
+    def key(self):
+        return _combined_key('or', self.criteria1.key(),
+                             self.criteria2.key())
+
+    def time_bounds(self):
+        return _join_bounds(self.criteria1.time_bounds(),
+                            self.criteria2.time_bounds())
+
+    def mask(self, columns):
+        return self.criteria1.mask(columns) | self.criteria2.mask(columns)
 
     def predicate(self, measure):
         return (self.criteria1.predicate(measure) or
                 self.criteria2.predicate(measure))
 
 
+class NegatedCriteria(Criteria):
+    """
+    A criteria that is the negation of a criteria
+    """
+    def __init__(self, criteria):
+        super(NegatedCriteria, self).__init__()
+        self.criteria = criteria
+        self._eager = _combined_eager(criteria)
+
+    def clause(self):
+        return not_(self.criteria.clause())
+
+    def key(self):
+        key = self.criteria.key()
+        if key is None:
+            return None
+        return 'not', key
+
+    def mask(self, columns):
+        return ~self.criteria.mask(columns)
+
+    def predicate(self, measure):
+        return not self.criteria.predicate(measure)
+
+
 class Before(Criteria):
     """
     all the measures before a specified time
@@ -171,9 +766,17 @@ class Before(Criteria):
         super(Before, self).__init__()
         self.time = time
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(db.Origin.time < self.time)
+    def clause(self):
+        return db.Origin.time < self.time
+
+    def key(self):
+        return 'before', self.time
+
+    def time_bounds(self):
+        return None, self.time
+
+    def mask(self, columns):
+        return columns['time'] < np.datetime64(self.time, 'us')
 
     def predicate(self, measure):
         return measure.origin.time < self.time
@@ -190,9 +793,17 @@ class After(Criteria):
         super(After, self).__init__()
         self.time = time
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(db.Origin.time > self.time)
+    def clause(self):
+        return db.Origin.time > self.time
+
+    def key(self):
+        return 'after', self.time
+
+    def time_bounds(self):
+        return self.time, None
+
+    def mask(self, columns):
+        return columns['time'] > np.datetime64(self.time, 'us')
 
     def predicate(self, measure):
         return measure.origin.time > self.time
@@ -210,8 +821,17 @@ class Between(Criteria):
         self.time_lb, self.time_ub = bounds
         self._comb = Before(self.time_ub) & After(self.time_lb)
 
-    def filter(self, queryset=None):
-        return self._comb.filter(queryset)
+    def clause(self):
+        return self._comb.clause()
+
+    def key(self):
+        return self._comb.key()
+
+    def time_bounds(self):
+        return self._comb.time_bounds()
+
+    def mask(self, columns):
+        return self._comb.mask(columns)
 
     def predicate(self, measure):
         return self._comb.predicate(measure)
@@ -228,10 +848,16 @@ class WithAgencies(Criteria):
         super(WithAgencies, self).__init__()
         self.agencies = agency_name_list
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(
-            db.Agency.source_key.in_(self.agencies))
+    def clause(self):
+        if not self.agencies:
+            return False
+        return db.Agency.source_key.in_(self.agencies)
+
+    def key(self):
+        return 'agency__in', frozenset(self.agencies)
+
+    def mask(self, columns):
+        return np.in1d(columns['agency'], list(self.agencies))
 
     def predicate(self, measure):
         return measure.agency.source_key in self.agencies
@@ -252,10 +878,16 @@ class WithMagnitudeScales(Criteria):
     def make_with_scale(cls, scale):
         return cls([scale])
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(
-            db.MagnitudeMeasure.scale.in_(self.scales))
+    def clause(self):
+        if not self.scales:
+            return False
+        return db.MagnitudeMeasure.scale.in_(self.scales)
+
+    def key(self):
+        return 'scale__in', frozenset(self.scales)
+
+    def mask(self, columns):
+        return np.in1d(columns['scale'], list(self.scales))
 
     def predicate(self, measure):
         return measure.scale in self.scales
@@ -272,9 +904,14 @@ class WithMagnitudeGreater(Criteria):
         super(WithMagnitudeGreater, self).__init__()
         self.value = value
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(db.MagnitudeMeasure.value > self.value)
+    def clause(self):
+        return db.MagnitudeMeasure.value > self.value
+
+    def key(self):
+        return 'magnitude__gt', self.value
+
+    def mask(self, columns):
+        return columns['value'] > self.value
 
     def predicate(self, measure):
         return measure.value > self.value
@@ -291,11 +928,21 @@ class WithinPolygon(Criteria):
         super(WithinPolygon, self).__init__()
         self.polygon = polygon
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(
+    def clause(self):
+        polygon = "GeomFromText('%s')" % self.polygon
+        return self._prefiltered(
+            within_bounding_box(
+                "MbrMinX(%s)" % polygon, "MbrMaxX(%s)" % polygon,
+                "MbrMinY(%s)" % polygon, "MbrMaxY(%s)" % polygon),
             db.Origin.position.within(self.polygon))
 
+    def key(self):
+        return 'within_polygon', self.polygon
+
+    def mask(self, columns):
+        return columnar.within_polygon(
+            columns['position_x'], columns['position_y'], self.polygon)
+
 
 class WithinDistanceFromPoint(Criteria):
     """
@@ -309,11 +956,45 @@ class WithinDistanceFromPoint(Criteria):
         self.point, self.distance = params
         super(WithinDistanceFromPoint, self).__init__()
 
-    def filter(self, queryset=None):
-        queryset = queryset or self.default_queryset
-        return queryset.filter(
-            "PtDistWithin(catalogue_origin.position, GeomFromText('%s', "
-            "4326), %s)" % (self.point, self.distance))
+    def clause(self):
+        return self._prefiltered(
+            self._bounding_box(),
+            expression.text(
+                "PtDistWithin(catalogue_origin.position, GeomFromText("
+                "'%s', 4326), %s)" % (self.point, self.distance)))
+
+    def key(self):
+        return 'within_distance_from_point', self.point, float(self.distance)
+
+    def mask(self, columns):
+        return columnar.distances(
+            columns['position_x'], columns['position_y'],
+            self.point) <= float(self.distance)
+
+    def _bounding_box(self):
+        """
+        Returns the sql condition that selects, through the spatial
+        index, the origins in a box of longitudes and latitudes around
+        the point that contains all the points within the distance.
+        The box is not bounded in longitude when it includes a pole or
+        crosses the antimeridian
+        """
+        match = POINT_REGEXP.match(self.point)
+        if match is None:
+            return within_bounding_box(None, None, None, None)
+        longitude, latitude = float(match.group('x')), float(match.group('y'))
+        delta = float(self.distance) / METERS_PER_DEGREE
+
+        max_latitude = abs(latitude) + delta
+        if max_latitude < 90:
+            delta_longitude = delta / math.cos(math.radians(max_latitude))
+        else:
+            delta_longitude = 360
+        xmin, xmax = longitude - delta_longitude, longitude + delta_longitude
+        if xmin < -180 or xmax > 180:
+            xmin = xmax = None
+        return within_bounding_box(xmin, xmax, latitude - delta,
+                                   latitude + delta)
 
 
 CRITERIA_MAP = {
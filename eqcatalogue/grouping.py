@@ -21,17 +21,24 @@ Module :mod:`eqcatalogue.grouping` defines
 
 import numpy as np
 
-# FIXME: Remove the unused import of matplotlib.
-# To allow the use of this code on an headless machine we import mpl
-# and change the rendering backend to Agg before the module
-# scipy.cluster, that is needed in this module and imports matplotlib,
-# chooses a rendering backend that requires a display. We remark that
-# it is not possible to change the mpl rendering backend once it has
-# been set.
-import matplotlib
-matplotlib.use('Agg')
 
-from scipy.cluster import hierarchy
+def _hierarchy():
+    """
+    Returns the module scipy.cluster.hierarchy. It is imported only
+    by the clustering of the measures, as it is slow to import.
+    """
+    # FIXME: Remove the unused import of matplotlib.
+    # To allow the use of this code on an headless machine we import mpl
+    # and change the rendering backend to Agg before the module
+    # scipy.cluster, that is needed in this module and imports matplotlib,
+    # chooses a rendering backend that requires a display. We remark that
+    # it is not possible to change the mpl rendering backend once it has
+    # been set.
+    import matplotlib
+    matplotlib.use('Agg')
+
+    from scipy.cluster import hierarchy
+    return hierarchy
 
 
 class GroupMeasuresByEventSourceKey(object):
@@ -46,8 +53,11 @@ class GroupMeasuresByEventSourceKey(object):
         Groups the measures that are the result of measure_filter
         """
         groups = {}
+        # the keys of the events are read by a single query instead of
+        # loading the event of each measure
+        event_keys = dict(measure_filter.rows('id', 'event_key'))
         for m in measure_filter.all():
-            key = m.event.source_key
+            key = event_keys[m.id]
             if not key in groups:
                 groups[key] = []
             groups[key].append(m)
@@ -96,7 +106,7 @@ class GroupMeasuresByHierarchicalClustering(object):
         data = np.array([self._key_fn(m) for m in measures])
         npdata = np.reshape(np.array(data), [len(data), 1])
 
-        clusters = hierarchy.fclusterdata(npdata, **self._clustering_args)
+        clusters = _hierarchy().fclusterdata(npdata, **self._clustering_args)
 
         grouped = {}
         for i, cluster in enumerate(clusters):
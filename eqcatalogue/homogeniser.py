@@ -19,6 +19,12 @@ between different magnitude scales value.
 """
 
 
+# To allow the use of this code on an headless machine the rendering
+# backend is changed to Agg before pyplot is imported by the serializer
+# (see :func:`eqcatalogue.grouping._hierarchy`)
+import matplotlib
+matplotlib.use('Agg')
+
 from eqcatalogue import selection, grouping
 from eqcatalogue.regression import EmpiricalMagnitudeScalingRelationship
 from eqcatalogue.serializers import mpl
@@ -2,4 +2,5 @@ from eqcatalogue.importers.base import Importer, store_events
 from eqcatalogue.importers.iaspei import Iaspei
 from eqcatalogue.importers.isf_bulletin import V1
 
-from eqcatalogue.importers.csv1 import CsvEqCatalogueReader, Converter
+from eqcatalogue.importers.csv1 import (CsvEqCatalogueReader, Converter,
+                                        CsvEqCatalogueImporter)
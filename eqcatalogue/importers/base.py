@@ -19,15 +19,153 @@ kinds of :class:` earthquake catalogue readers <CatalogueReader>`.
 """
 
 import abc
+import hashlib
+
+from eqcatalogue import models as catalogue
+from eqcatalogue.importers.reader_utils import open_stream
+
+# The number of bytes read at a time to check the data already
+# imported when an import is resumed (see Importer._resume)
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
 def store_events(cls, stream, cat, **kwargs):
     """
      Utility that create an instance of the importer and load the
-     data from `stream`
+     data from `stream`, which can be a stream or the path of a
+     (possibly compressed) file. The denormalised table of the
+     measures is then refreshed (see
+     :meth:`eqcatalogue.models.CatalogueDatabase.refresh_measure_rows`)
     """
     importer = cls(stream, cat)
-    return importer.store(**kwargs)
+    try:
+        summary = importer.store(**kwargs)
+    finally:
+        importer.close()
+    cat.refresh_measure_rows()
+    return summary
+
+
+class IdentityCache(object):
+    """
+    An import scoped cache of the objects identified by an event
+    source and a source key (agencies, events and origins). Event
+    sources are identified by their name.
+
+    The cache is pre-warmed with all the event sources and agencies
+    stored in the catalogue (they are few), while events and origins
+    are cached as they are looked up. The database is queried only
+    on a cache miss.
+
+    :param cat: the catalogue database the objects are looked up into
+
+    :attribute hits: the number of lookups served by the cache
+
+    :attribute misses: the number of lookups that queried the database
+    """
+
+    def __init__(self, cat):
+        self._catalogue = cat
+        self._objects = {}
+        self.hits = 0
+        self.misses = 0
+        self.warm()
+
+    def warm(self):
+        """
+        Load into the cache the event sources and the agencies
+        already stored
+        """
+        session = self._catalogue.session
+        for eventsource in session.query(catalogue.EventSource):
+            self._objects[(catalogue.EventSource, None,
+                           eventsource.name)] = eventsource
+        # event sources are in the identity map, so accessing the
+        # relationship of the agency does not issue any query
+        for agency in session.query(catalogue.Agency):
+            self._objects[(catalogue.Agency, agency.eventsource,
+                           agency.source_key)] = agency
+
+    @staticmethod
+    def _query_args(class_object, eventsource, source_key):
+        if class_object is catalogue.EventSource:
+            return {'name': source_key}
+        return {'source_key': source_key, 'eventsource': eventsource}
+
+    def get_or_create(self, class_object, eventsource, source_key,
+                      creation_args=None):
+        """
+        Returns the object of type `class_object` identified by
+        `eventsource` and `source_key` and a flag telling if it has
+        been created (with `creation_args`), like
+        :meth:`~eqcatalogue.models.CatalogueDatabase.get_or_create`.
+        For event sources, `source_key` is the name and `eventsource`
+        is None.
+        """
+        key = (class_object, eventsource, source_key)
+        if key in self._objects:
+            self.hits += 1
+            return self._objects[key], False
+        self.misses += 1
+        obj, created = self._catalogue.get_or_create(
+            class_object,
+            self._query_args(class_object, eventsource, source_key),
+            creation_args)
+        self._objects[key] = obj
+        return obj, created
+
+    def find(self, class_object, eventsource, source_key):
+        """
+        Returns the object of type `class_object` identified by
+        `eventsource` and `source_key`, or None if it does not exist
+        """
+        key = (class_object, eventsource, source_key)
+        if key in self._objects:
+            self.hits += 1
+            return self._objects[key]
+        self.misses += 1
+        obj = self._catalogue.session.query(class_object).filter_by(
+            **self._query_args(class_object, eventsource, source_key)).first()
+        if obj is not None:
+            self._objects[key] = obj
+        return obj
+
+
+class TrackedStream(object):
+    """
+    Iterate over the lines of `stream` keeping track of the number of
+    bytes and lines read before the current one and of the sha1
+    digest of those bytes.
+
+    :param stream: the stream to read the lines from
+
+    :param sha1: the sha1 object updated with the data already read
+      from the stream, if any
+
+    :param byte_offset: the number of bytes already read
+
+    :param line_num: the number of lines already read
+    """
+
+    def __init__(self, stream, sha1=None, byte_offset=0, line_num=0):
+        self._stream = stream
+        self._sha1 = sha1 or hashlib.sha1()
+        self.byte_offset = byte_offset
+        self.line_num = line_num
+
+    def __iter__(self):
+        for line in self._stream:
+            yield line
+            self.byte_offset += len(line)
+            self.line_num += 1
+            self._sha1.update(line)
+
+    @property
+    def digest(self):
+        """
+        The sha1 hex digest of the bytes read before the current line
+        """
+        return self._sha1.hexdigest()
 
 
 class Importer(object):
@@ -42,16 +180,28 @@ class Importer(object):
     EVENT = 'Events_Created'
     ORIGIN = 'Origins_Created'
     MEASURE = 'Measures_Created'
+    ROWS_PER_SECOND = 'Rows_Per_Second'
 
     def __init__(self, file_stream, db_catalogue):
-        self._file_stream = file_stream
+        # the importer closes only the streams it has opened
+        self._opened = isinstance(file_stream, basestring)
+        self._file_stream = open_stream(file_stream)
         self._catalogue = db_catalogue
+        self._cache = IdentityCache(db_catalogue)
         self._summary = {self.EVENT_SOURCE: 0,
                          self.AGENCY: 0,
                          self.EVENT: 0,
                          self.ORIGIN: 0,
                          self.MEASURE: 0}
 
+    def close(self):
+        """
+        Close the input stream, if it has been opened by the importer
+        from a path
+        """
+        if self._opened:
+            self._file_stream.close()
+
     @abc.abstractmethod
     def store(self):
         """
@@ -74,3 +224,67 @@ class Importer(object):
         """
 
         return self._summary
+
+    @property
+    def cache(self):
+        """
+        The :class:`IdentityCache` used by the importer to look up the
+        objects already stored. Its `hits` and `misses` counters
+        measure the queries saved.
+        """
+        return self._cache
+
+    def _resume(self, source):
+        """
+        Returns the :class:`~eqcatalogue.models.ImportCheckpoint` of
+        the file `source` and a :class:`TrackedStream` over the lines
+        of the input stream not imported yet.
+
+        If the input stream does not start with the data already
+        imported (e.g. the file has changed), it is read from the
+        beginning and the checkpoint is reset.
+        """
+        checkpoint, _ = self._catalogue.get_or_create(
+            catalogue.ImportCheckpoint, {'source': source})
+        if checkpoint.byte_offset:
+            sha1, size = self._hash_prefix(checkpoint.byte_offset)
+            if (size == checkpoint.byte_offset and
+                sha1.hexdigest() == checkpoint.digest):
+                return checkpoint, TrackedStream(
+                    self._file_stream, sha1, size, checkpoint.line_num)
+            self._file_stream.seek(0)
+            checkpoint.eventsource = None
+            checkpoint.byte_offset = checkpoint.line_num = 0
+            checkpoint.digest = checkpoint.last_event = None
+        return checkpoint, TrackedStream(self._file_stream)
+
+    def _hash_prefix(self, byte_offset):
+        """
+        Read the first `byte_offset` bytes of the input stream, at
+        most :data:`HASH_CHUNK_SIZE` at a time, and returns their sha1
+        object and the number of bytes actually read
+        """
+        sha1 = hashlib.sha1()
+        size = 0
+        while size < byte_offset:
+            chunk = self._file_stream.read(
+                min(HASH_CHUNK_SIZE, byte_offset - size))
+            if not chunk:
+                break
+            sha1.update(chunk)
+            size += len(chunk)
+        return sha1, size
+
+    @staticmethod
+    def _update_checkpoint(checkpoint, stream, eventsource, last_event):
+        """
+        Update `checkpoint` to the position of the :class:`TrackedStream`
+        `stream`. The checkpoint is stored with the next commit, so it
+        should be updated only when all the data read before are going
+        to be stored by the same commit.
+        """
+        checkpoint.byte_offset = stream.byte_offset
+        checkpoint.line_num = stream.line_num
+        checkpoint.digest = stream.digest
+        checkpoint.eventsource = eventsource
+        checkpoint.last_event = last_event
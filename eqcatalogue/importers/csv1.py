@@ -15,12 +15,28 @@
 
 """
 Module :mod:`eq_catalogue_tool.reader` defines classes for reading
-different formats of earthquake catalogues.
+different formats of earthquake catalogues, and the importer of the
+ISC csv format.
 """
 
-from csv import DictReader
+from csv import DictReader, reader as csv_reader
+from itertools import islice
 
-from eqcatalogue.importers.reader_utils import CSV_FIELDNAMES, TRANSF_MAP
+from sqlalchemy.exc import IntegrityError
+
+from eqcatalogue import models as catalogue
+from eqcatalogue.exceptions import ParsingFailure
+from eqcatalogue.importers.base import Importer
+from eqcatalogue.importers.writers import BulkWriter
+from eqcatalogue.importers.reader_utils import (CSV_FIELDNAMES, TRANSF_MAP,
+                                                STR_TRANSF, open_stream,
+                                                float_column, datetime_column,
+                                                column_values)
+
+# The number of entries converted at once by CsvEqCatalogueReader.read_columns
+DEFAULT_BLOCK_SIZE = 10000
+
+TIME_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
 
 
 class CsvEqCatalogueReader(object):
@@ -28,12 +44,13 @@ class CsvEqCatalogueReader(object):
     EqCatalogueReader reads earthquake
     events descriptions, defined in a csv file.
 
-    :param fileobj: csv file object
-    :type fileobj: file object
+    :param fileobj: csv file object or the path of a (possibly
+      compressed) csv file
+    :type fileobj: file object or string
     """
 
     def __init__(self, fileobj):
-        self.fileobj = fileobj
+        self.fileobj = open_stream(fileobj)
 
     def read(self, converter):
         """
@@ -45,6 +62,37 @@ class CsvEqCatalogueReader(object):
             converted_entry = converter.convert(entry)
             yield converted_entry
 
+    def read_columns(self, size=None, header=False):
+        """
+        Read the csv entries in blocks of at most `size` entries,
+        skipping the first line if `header` is True. For
+        each block, it yields a dictionary that maps each field to the
+        column of its values. Numeric fields are converted at once
+        into float64 arrays (nan for missing values), string fields
+        into lists of stripped strings (None for missing values). The
+        date and time fields are also combined into a datetime64
+        array with key `time`.
+        """
+        rows = csv_reader(self.fileobj)
+        if header:
+            next(rows, None)
+        nr_fields = len(CSV_FIELDNAMES)
+        while True:
+            block = [row + [''] * (nr_fields - len(row))
+                     for row in islice(rows, size or DEFAULT_BLOCK_SIZE)]
+            if not block:
+                break
+            columns = {}
+            for field, values in zip(CSV_FIELDNAMES, zip(*block)):
+                if TRANSF_MAP[field] is STR_TRANSF:
+                    columns[field] = [value.strip() or None
+                                      for value in values]
+                else:
+                    columns[field] = float_column(values)
+            columns['time'] = datetime_column(
+                *[columns[field] for field in TIME_FIELDS])
+            yield columns
+
 
 class Converter(object):
     """
@@ -96,3 +144,127 @@ class Converter(object):
             value = transf(value)
 
         return value
+
+
+class CsvEqCatalogueImporter(Importer):
+    """
+    Import data in the ISC csv format (see
+    :data:`~eqcatalogue.importers.reader_utils.CSV_FIELDNAMES`) into
+    a CatalogueDatabase. Each entry is a magnitude measure, together
+    with its origin and its event. Entries without a magnitude store
+    only their origin and event.
+    """
+
+    ERR_MSG = 'The entry %s violates the csv format: %s'
+
+    # The csv fields stored as metadata of each measure
+    METADATA_FIELDS = {'phases': 'phases',
+                       'stations': 'stations',
+                       'azimuthGap': 'azimuth_gap',
+                       'minDistance': 'min_distance',
+                       'maxDistance': 'max_distance'}
+
+    # The csv fields stored as attributes of each origin
+    ORIGIN_FIELDS = {'timeError': 'time_error',
+                     'time_rms': 'time_rms',
+                     'Latitude': 'latitude',
+                     'Longitude': 'longitude',
+                     'semiMajor90': 'semi_major_90error',
+                     'semiMinor90': 'semi_minor_90error',
+                     'depth': 'depth',
+                     'depthError': 'depth_error'}
+
+    def update_summary(self, item_key):
+        self._summary[item_key] += 1
+
+    def store(self, eventsource='ISC', header=False, batch_size=None):
+        """
+        Read and parse from the input stream the data and insert them
+        into the catalogue db, as imported from the event source named
+        `eventsource`. If `header` is True, the first line is skipped.
+        A summary of entities stored is returned.
+
+        Entries are converted in blocks, whose events, origins and
+        agencies already stored are looked up at once, and the data are
+        stored in batches of about `batch_size` rows (see
+        :class:`~eqcatalogue.importers.writers.BulkWriter`).
+        """
+        writer = BulkWriter(self._catalogue, batch_size)
+        reader = CsvEqCatalogueReader(self._file_stream)
+        event_source = None
+        entry_num = 1 if header else 0
+
+        for columns in reader.read_columns(writer.batch_size, header):
+            if event_source is None:
+                event_source, created = writer.eventsource(eventsource)
+                if created:
+                    self.update_summary(Importer.EVENT_SOURCE)
+            writer.prefetch(event_source, {
+                    catalogue.Event: columns['eventKey'],
+                    catalogue.Origin: columns['originID'],
+                    catalogue.Agency: (columns['solutionAgency'] +
+                                       columns['mag_agency'])})
+            values = dict((field, column_values(columns[field]))
+                          for field in (self.ORIGIN_FIELDS.keys() +
+                                        self.METADATA_FIELDS.keys() +
+                                        ['magnitude', 'magnitudeError',
+                                         'time']))
+            for i in xrange(len(columns['eventKey'])):
+                entry_num += 1
+                entry = dict((field, column[i])
+                             for field, column in values.iteritems())
+                for field in ('eventKey', 'originID', 'solutionAgency',
+                              'mag_agency', 'mag_type'):
+                    entry[field] = columns[field][i]
+                writer.flush_if_full()
+                try:
+                    self._store_entry(writer, event_source, entry)
+                except IntegrityError as e:
+                    raise ParsingFailure(self.ERR_MSG % (entry_num, e))
+
+        writer.flush()
+        return self._summary
+
+    def _store_entry(self, writer, event_source, entry):
+        agency_key = entry['mag_agency'] or entry['solutionAgency']
+        if (entry['eventKey'] is None or entry['originID'] is None or
+            agency_key is None or entry['time'] is None or
+            entry['Latitude'] is None or entry['Longitude'] is None):
+            raise IntegrityError(
+                "Missing event, origin, agency, time or position",
+                entry, None)
+
+        event, created = writer.event(event_source, entry['eventKey'])
+        if created:
+            self.update_summary(Importer.EVENT)
+
+        if entry['solutionAgency'] is not None:
+            _, created = writer.agency(event_source, entry['solutionAgency'])
+            if created:
+                self.update_summary(Importer.AGENCY)
+
+        origin_values = dict((name, entry[field])
+                             for field, name in self.ORIGIN_FIELDS.items())
+        origin_values['time'] = entry['time']
+        origin, created = writer.origin(event_source, entry['originID'],
+                                        origin_values)
+        if created:
+            self.update_summary(Importer.ORIGIN)
+
+        if entry['mag_type'] is None or entry['magnitude'] is None:
+            # an origin without magnitude
+            return
+
+        agency, created = writer.agency(event_source, agency_key)
+        if created:
+            self.update_summary(Importer.AGENCY)
+
+        measure, created = writer.measure(
+            event, agency, origin, entry['mag_type'],
+            {'value': entry['magnitude'],
+             'standard_error': entry['magnitudeError']})
+        if created:
+            self.update_summary(Importer.MEASURE)
+            for field, name in self.METADATA_FIELDS.items():
+                if entry[field] is not None:
+                    writer.metadata(measure, name, entry[field])
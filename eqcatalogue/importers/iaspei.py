@@ -13,12 +13,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with eqcataloguetool. If not, see <http://www.gnu.org/licenses/>.
 
-from datetime import datetime
+import numpy as np
 
 from eqcatalogue import models as catalogue
 from eqcatalogue.exceptions import InvalidMagnitudeSeq
 
 from eqcatalogue.importers.base import Importer
+from eqcatalogue.importers.writers import BulkWriter
+from eqcatalogue.importers.reader_utils import (float_column,
+                                                iso_datetime_column,
+                                                column_values)
 
 
 class Iaspei(Importer):
@@ -36,21 +40,54 @@ class Iaspei(Importer):
 
     def _parse_csv(self, header):
         """
-        Returns a list of entries parsed in the csv file
-        if the header is present in the csv it is skipped
-        in the result.
+        Yields the entries parsed in the csv file, one at a time.
+        If the header is present in the csv it is skipped.
         :param header:
             A flag which states if the header is in the csv file.
         """
 
-        entries = []
-        for line in self._file_stream:
-            entries.append([item.strip() for item in line.split(',')])
+        lines = iter(self._file_stream)
         if header:
             #skip the header line
-            entries = entries[1:]
+            next(lines, None)
+        for line in lines:
+            yield [item.strip() for item in line.split(',')]
 
-        return entries
+    def _parse_blocks(self, header, size):
+        """
+        Yields blocks of at most `size` entries parsed in the csv file
+        """
+        block = []
+        for entry in self._parse_csv(header):
+            block.append(entry)
+            if len(block) == size:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    def _convert_block(self, entries):
+        """
+        Convert at once the time, the coordinates, the depth and the
+        magnitude values of a block of entries. Returns a list of
+        (time, latitude, longitude, depth) tuples, one per entry, and
+        an iterator over the magnitude values of the block
+        """
+        columns = zip(*[entry[:self.MAG_GR_INDEX] for entry in entries])
+        times = iso_datetime_column(np.char.add(
+                np.char.add(np.asarray(columns[self.DATE_INDEX], dtype=str),
+                            'T'),
+                np.asarray(columns[self.TIME_INDEX], dtype=str)))
+        origins = zip(
+            column_values(times),
+            *[column_values(float_column(columns[index]))
+              for index in (self.LAT_INDEX, self.LON_INDEX,
+                            self.DEPTH_INDEX)])
+        magnitudes = float_column(
+            [value for entry in entries
+             for value in entry[self.MAG_GR_INDEX + 2::
+                                self.MAG_MEASURE_ITEMS]])
+        return origins, iter(column_values(magnitudes))
 
     def _check_magnitude_group(self, mag_group):
         """
@@ -63,66 +100,77 @@ class Iaspei(Importer):
     def update_summary(self, item_key):
         self._summary[item_key] += 1
 
-    def store(self, header=True):
+    def store(self, header=True, batch_size=None):
         """
         Read and parse from the input stream the data and insert them
         into the catalogue db, a summary of entities stored is returned.
+
+        Entries are read in blocks, whose times, coordinates, depths
+        and magnitudes are converted at once, and whose events, origins
+        and agencies already stored are looked up at once. The data are
+        stored in batches of about `batch_size` rows (see
+        :class:`~eqcatalogue.importers.writers.BulkWriter`), so that
+        memory use does not depend on the size of the input or of the
+        catalogue.
         """
 
-        for entry in self._parse_csv(header):
+        writer = BulkWriter(self._catalogue, batch_size)
+        event_source = None
+
+        for entries in self._parse_blocks(header, writer.batch_size):
+
+            origins, magnitudes = self._convert_block(entries)
+
+            if event_source is None:
+                event_source, created = writer.eventsource('IASPEI')
+                if created:
+                    self.update_summary(Importer.EVENT_SOURCE)
+
+            # events and origins share the key of the entry
+            keys = [entry[self.EVENTID_INDEX] for entry in entries]
+            writer.prefetch(event_source, {
+                    catalogue.Event: keys, catalogue.Origin: keys,
+                    catalogue.Agency: [
+                        agency for entry in entries
+                        for agency in entry[self.MAG_GR_INDEX::
+                                            self.MAG_MEASURE_ITEMS]]})
+
+            for entry, (time, latitude, longitude, depth) in zip(entries,
+                                                                 origins):
 
-            event_source, created = self._catalogue.get_or_create(
-                    catalogue.EventSource, {'name': 'IASPEI'})
-            if created:
-                self.update_summary(Importer.EVENT_SOURCE)
-
-            event, created = self._catalogue.get_or_create(catalogue.Event,
-                {'source_key': entry[self.EVENTID_INDEX],
-                 'eventsource': event_source})
-            if created:
-                self.update_summary(Importer.EVENT)
-
-            self._check_magnitude_group(entry[self.MAG_GR_INDEX:])
-
-            # Time String Creation
-            microsec = int(float(entry[self.TIME_INDEX][8:]) * 10000)
-            time = ''.join([entry[self.TIME_INDEX][:9], str(microsec)])
-            date_time = '/'.join(
-                [entry[self.DATE_INDEX], time])
-
-            values = {'time': datetime.strptime(
-                            date_time, '%Y-%m-%d/%H:%M:%S.%f'),
-                        'position': self._catalogue.position_from_latlng(
-                            entry[self.LAT_INDEX], entry[self.LON_INDEX]),
-                        'depth': float(entry[self.DEPTH_INDEX]),
-                        'eventsource': event_source,
-                        'source_key': entry[self.EVENTID_INDEX]}
-
-            magnitude_group = entry[self.MAG_GR_INDEX:]
-
-            for mag_group_start in xrange(0, len(magnitude_group),
-                self.MAG_MEASURE_ITEMS):
-
-                agency, created = self._catalogue.get_or_create(
-                    catalogue.Agency,
-                    {'source_key': magnitude_group[mag_group_start],
-                     'eventsource': event_source})
+                # batches are stored only between two entries
+                writer.flush_if_full()
+
+                event, created = writer.event(event_source,
+                                              entry[self.EVENTID_INDEX])
                 if created:
-                    self.update_summary(Importer.AGENCY)
+                    self.update_summary(Importer.EVENT)
+
+                self._check_magnitude_group(entry[self.MAG_GR_INDEX:])
 
-                origin, created = self._catalogue.get_or_create(
-                    catalogue.Origin, values)
+                origin, created = writer.origin(
+                    event_source, entry[self.EVENTID_INDEX],
+                    {'time': time, 'latitude': latitude,
+                     'longitude': longitude, 'depth': depth})
                 if created:
                     self.update_summary(Importer.ORIGIN)
-                _,  created = self._catalogue.get_or_create(
-                    catalogue.MagnitudeMeasure,
-                    {'event': event,
-                     'agency': agency,
-                     'scale': magnitude_group[mag_group_start + 1],
-                     'value': magnitude_group[mag_group_start + 2],
-                     'origin': origin
-                     })
-                if created:
-                    self.update_summary(Importer.MEASURE)
 
-        self._catalogue.session.commit()
+                magnitude_group = entry[self.MAG_GR_INDEX:]
+
+                for mag_group_start in xrange(0, len(magnitude_group),
+                    self.MAG_MEASURE_ITEMS):
+
+                    agency, created = writer.agency(
+                        event_source, magnitude_group[mag_group_start])
+                    if created:
+                        self.update_summary(Importer.AGENCY)
+
+                    _, created = writer.measure(
+                        event, agency, origin,
+                        magnitude_group[mag_group_start + 1],
+                        {'value': magnitudes.next()})
+                    if created:
+                        self.update_summary(Importer.MEASURE)
+
+        writer.flush()
+        return self._summary
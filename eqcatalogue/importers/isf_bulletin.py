@@ -14,52 +14,43 @@
 # along with eqcataloguetool. If not, see <http://www.gnu.org/licenses/>.
 
 
-import re
-import datetime
+import time
+import multiprocessing
+from itertools import islice
 from sqlalchemy.exc import IntegrityError
 
 from eqcatalogue import models as catalogue
-
 from eqcatalogue.importers import Importer
+from eqcatalogue.importers.isf_decoder import (CATALOGUE_HEADER,
+    EVENT_REGEXP, UK_MEASURE_REGEXP, ORIGIN_ATTRIBUTES, ORIGIN_METADATA,
+    detect_line_type, decode_event, decode_origin, decode_measure, decode_uk_measure)
+from eqcatalogue.importers.writers import (SessionWriter, BulkWriter,
+                                           RecordingWriter, Replayer,
+                                           Placeholder)
 from eqcatalogue.exceptions import ParsingFailure
 
 CATALOG_URL = 'http://www.isc.ac.uk/cgi-bin/web-db-v4'
 
-ANALYSIS_TYPES = {'a': 'automatic',
-                  'm': 'manual',
-                  'g': 'guess'}
-
-LOCATION_METHODS = {
-    'i': 'inversion',
-    'p': 'pattern recognition',
-    'g': 'ground truth',
-    'o': 'other'
-    }
-
-EVENT_TYPES = {
-    'uk': 'unknown',
-    'de': 'damaging earthquake ( Not standard IMS )',
-    'fe': 'felt earthquake ( Not standard IMS )',
-    'ke': 'known earthquake',
-    'se': 'suspected earthquake',
-    'kr': 'known rockburst',
-    'sr': 'suspected rockburst',
-    'ki': 'known induced event',
-    'si': 'suspected induced event',
-    'km': 'known mine expl.',
-    'sm': 'suspected mine expl.',
-    'kh': 'known chemical expl. ( Not standard IMS )',
-    'sh': 'suspected chemical expl. ( Not standard IMS )',
-    'kx': 'known experimental expl.',
-    'sx': 'suspected experimental expl.',
-    'kn': 'known nuclear expl.',
-    'sn': 'suspected nuclear explosion',
-    'ls': 'landslide'
-    }
-
 ERR_MSG = ('The line %s violates the format, please check the related format'
            ' documentation at: http://www.isc.ac.uk/standards/isf/')
 
+# The number of lines parsed by each process when parsing in parallel
+DEFAULT_CHUNK_SIZE = 20000
+
+# The summary item updated by each writer call
+SUMMARY_KEYS = {'eventsource': Importer.EVENT_SOURCE,
+                'event': Importer.EVENT,
+                'agency': Importer.AGENCY,
+                'origin': Importer.ORIGIN,
+                'measure': Importer.MEASURE}
+
+# The types of the rows looked up at once before the calls recorded for
+# a chunk are replayed, by writer method
+PREFETCHED = {'event': catalogue.Event,
+              'agency': catalogue.Agency,
+              'origin': catalogue.Origin,
+              'find_origin': catalogue.Origin}
+
 
 class UnexpectedLine(BaseException):
     """
@@ -74,15 +65,16 @@ class UnexpectedLine(BaseException):
 
 class BaseState(object):
     """
-    The base state object. A state stores the catalogue db instance
-    and calculate the next state based on the current event
+    The base state object. A state stores the writer used to persist
+    the parsed data and calculate the next state based on the current
+    event
     """
 
     def __init__(self):
-        self._catalogue = None
+        self._writer = None
 
-    def setup(self, cat):
-        self._catalogue = cat
+    def setup(self, writer):
+        self._writer = writer
 
     def is_start(self):
         return False
@@ -128,8 +120,7 @@ class StartState(BaseState):
         return {Importer.EVENT_SOURCE: 1 if created else 0}
 
     def _save_eventsource(self, name):
-        return self._catalogue.get_or_create(catalogue.EventSource,
-                                             {'name': name})
+        return self._writer.eventsource(name)
 
 
 class EventState(BaseState):
@@ -150,24 +141,17 @@ class EventState(BaseState):
     def match(cls, line):
         """Return True if line match a proper regexp, that triggers an
         event that makes the fsm jump to an EventState"""
-        event_regexp = re.compile(
-            '^Event (?P<source_event_id>\w{0,9}) (?P<name>.{0,65})$')
-        return event_regexp.match(line)
+        return EVENT_REGEXP.match(line)
 
     def process_line(self, line):
-        result = self.__class__.match(line)
-        created = self._save_event(**result.groupdict())
+        record = decode_event(line)
+        created = self._save_event(record.source_key, record.name)
         created_nr = 1 if created else 0
         return {Importer.EVENT: created_nr}
 
     def _save_event(self, source_event_id, name):
-        self.event, created = self._catalogue.get_or_create(
-            catalogue.Event,
-            {'source_key': source_event_id,
-              'eventsource': self._eventsource})
-        if self.event.name != name:
-            self.event.name = name
-        self._catalogue.session.commit()
+        self.event, created = self._writer.event(
+            self._eventsource, source_event_id, name)
         return created
 
 
@@ -210,126 +194,26 @@ class OriginBlockState(BaseState):
         elif line_type == 'event_header':
             return EventState(self.event.eventsource)
 
-    def _process_agency(self, line):
-        author = line[118:127].strip()
-        self.agency, agency_created = self._save_agency(author)
-        return agency_created
-
-    @staticmethod
-    def _process_time(line):
-        datetime_components = line[0:10].split('/') + \
-            line[11:19].split(':')
-        # some agency does not provide the msec part
-        if line[20:22].strip():
-            datetime_components += [line[20:22]]
-        datetime_components = [int(d) for d in datetime_components]
-        return datetime.datetime(*datetime_components)
-
-    def _process_origin(self, line):
-        time = OriginBlockState._process_time(line)
-
-        if line[22] == 'f':
-            time_error = None
-        else:
-            if line[24:29].strip():
-                time_error = float(line[24:29])
-            else:
-                time_error = None
-        time_rms = None if not line[30:35].strip() else float(line[30:35])
-
-        position = self._catalogue.position_from_latlng(float(line[36:44]),
-                                                        float(line[45:54]))
-        fixed_position = line[54] == 'f'
-        errors = (line[55:60].strip(), line[61:66].strip())
-        if fixed_position or not errors[0]:
-            semi_major_90error = None
-        else:
-            semi_major_90error = float(errors[0])
-
-        if fixed_position or not errors[1]:
-            semi_minor_90error = None
-        else:
-            semi_minor_90error = float(errors[1])
-
-        azimuth_error = None if not line[93:96].strip() else int(line[93:96])
-
-        if line[71:76].strip():
-            depth = float(line[71:76])
-        else:
-            depth = None
-        if line[76] == 'f' or not line[78:82].strip():
-            depth_error = None
-        else:
-            depth_error = float(line[71:76])
-
-        self.origin, origin_created = self._save_origin(
-            line[128:136],
-            time=time, time_error=time_error, time_rms=time_rms,
-            position=position, semi_major_90error=semi_major_90error,
-            semi_minor_90error=semi_minor_90error, depth=depth,
-            depth_error=depth_error, azimuth_error=azimuth_error)
-        return origin_created
-
-    def _process_metadata(self, line):
-        strike = None if not line[67:70].strip() else int(line[67:70])
-        if line[83:87].strip():
-            phases = int(line[83:87])
-        else:
-            phases = None
-        stations_string = line[88:92].strip()
-
-        if stations_string:
-            stations = int(stations_string)
-        else:
-            stations = None
-
-        dist1 = None if not line[97:103].strip() else float(line[97:103])
-        dist2 = None if not line[104:110].strip() else float(line[104:110])
-
-        analysis_type_str = line[111].strip()
-        if analysis_type_str:
-            analysis_type = ANALYSIS_TYPES[analysis_type_str]
-        else:
-            analysis_type = None
-        location_method_str = line[113].strip()
-        if location_method_str:
-            location_method = LOCATION_METHODS[location_method_str]
-        else:
-            location_method = None
-        event_type = line[115:117].strip()
-        event_type = None if not event_type else EVENT_TYPES[event_type]
-
-        self.metadata = {'strike': strike,
-                        'phases': phases,
-                        'stations': stations,
-                        'distance_to_closest_station': dist1,
-                        'distance_to_furthest_station': dist2,
-                        'analysis_type': analysis_type,
-                        'location_method': location_method,
-                        'event_type': event_type
-                        }
-
     def process_line(self, line):
-        agency_created = self._process_agency(line)
-        origin_created = self._process_origin(line)
-        self._process_metadata(line)
+        record = decode_origin(line)
+        self.agency, agency_created = self._save_agency(record.agency)
+        self.origin, origin_created = self._save_origin(
+            record.source_key,
+            **dict((name, getattr(record, name))
+                   for name in ORIGIN_ATTRIBUTES))
+        self.metadata = dict((name, getattr(record, name))
+                             for name in ORIGIN_METADATA)
 
         return {
             Importer.AGENCY: 1 if agency_created else 0,
             Importer.ORIGIN: 1 if origin_created else 0}
 
     def _save_agency(self, author):
-        return self._catalogue.get_or_create(
-            catalogue.Agency,
-            {'source_key': author,
-             'eventsource': self.event.eventsource})
+        return self._writer.agency(self.event.eventsource, author)
 
     def _save_origin(self, source_key, **kwargs):
-        return self._catalogue.get_or_create(
-            catalogue.Origin,
-            {'source_key': source_key,
-             'eventsource': self.event.eventsource},
-            kwargs)
+        return self._writer.origin(self.event.eventsource, source_key,
+                                   kwargs)
 
 
 class MeasureBlockState(BaseState):
@@ -350,45 +234,27 @@ class MeasureBlockState(BaseState):
             return MeasureUKScaleBlockState(self.event, self.metadata)
 
     def process_line(self, line):
-        scale = line[0:5].strip()
-        minmax_indicator = line[5].strip()
-        assert(not minmax_indicator)
-        value = float(line[6:10])
-        if line[11:14].strip():
-            standard_magnitude_error = float(line[11:14])
-        else:
-            standard_magnitude_error = None
-        if line[15:19].strip():
-            stations = int(line[15:19])
-        else:
-            stations = None
-        agency_name = line[20:29].strip()
-        origin_source_key = line[30:38]
-        created = self._save_measure(agency_name=agency_name,
-                           origin_source_key=origin_source_key,
-                           scale=scale,
-                           value=value,
-                           standard_error=standard_magnitude_error,
+        return self._process_record(decode_measure(line))
+
+    def _process_record(self, record):
+        created = self._save_measure(agency_name=record.agency,
+                           origin_source_key=record.origin_source_key,
+                           scale=record.scale,
+                           value=record.value,
+                           standard_error=record.standard_error,
             )
-        self._save_metadata(stations=stations)
+        self._save_metadata(stations=record.stations)
         return {Importer.MEASURE: 1 if created else 0}
 
     def _save_measure(self, agency_name, origin_source_key,
                       scale, value, standard_error):
-        agency, _ = self._catalogue.get_or_create(
-            catalogue.Agency,
-            {'source_key': agency_name,
-             'eventsource': self.event.eventsource})
-        origin = self._catalogue.session.query(catalogue.Origin).filter_by(
-              eventsource=self.event.eventsource,
-              source_key=origin_source_key).first()
-        self._catalogue.session.commit()
-        _, created = self._catalogue.get_or_create(
-            catalogue.MagnitudeMeasure,
-            {'event': self.event, 'origin': origin,
-             'agency': agency, 'scale': scale},
-             {'value': value,
-              'standard_error': standard_error})
+        agency, _ = self._writer.agency(self.event.eventsource, agency_name)
+        origin = self._writer.find_origin(self.event.eventsource,
+                                          origin_source_key)
+        _, created = self._writer.measure(
+            self.event, agency, origin, scale,
+            {'value': value,
+             'standard_error': standard_error})
         return created
 
     def _save_metadata(self, stations):
@@ -403,60 +269,51 @@ class MeasureUKScaleBlockState(MeasureBlockState):
 
     @classmethod
     def match(cls, line):
-        pat = ('^(?P<val>-*[0-9]+\.[0-9]+)\s+(?P<error>[0-9]+\.[0-9]+)*\s+'
-               '(?P<stations>[0-9]+)*\s+(?P<agency>\w+)\s+(?P<origin>\w+)$')
-        return re.compile(pat).match(line)
+        return UK_MEASURE_REGEXP.match(line)
 
     def process_line(self, line):
-        scale = 'Muk'
-        result = MeasureUKScaleBlockState.match(line)
-        data = result.groupdict()
-        created = self._save_measure(agency_name=data['agency'],
-                           origin_source_key=data['origin'],
-                           scale=scale,
-                           value=data['val'],
-                           standard_error=data.get('error'))
-        self._save_metadata(stations=data.get('stations'))
-        return {Importer.MEASURE: 1 if created else 0}
+        return self._process_record(decode_uk_measure(line))
 
 
-class V1(Importer):
+class Parser(object):
     """
-    Import data into a CatalogueDatabase from stream objects.
+    Drive the fsm over the lines of an ISF stream, handing the parsed
+    data to a writer. The parser does not access the database by
+    itself.
 
-    The specification of the format can be found at
-    http://www.isc.ac.uk/standards/isf/
+    :param writer: the writer used to persist the parsed data
 
-    Data file in ISF format can be generated at
-    http://www.isc.ac.uk/iscbulletin/search/bulletin/
+    :param state: the state the fsm starts from. Defaults to a
+      :class:`StartState`
 
-    by flagging "Only prime hypocentre" and checking that "Output web
-    links" is unchecked
-    """
+    :attribute eventsource: the event source of the data parsed
 
-    def __init__(self, stream, cat):
-        """
-        Initialize the importer.
+    :attribute last_event: the source key of the last event parsed
+    """
 
-        :param: stream:
-          A stream object storing the seismic event data
-        :type stream: file
+    def __init__(self, writer, state=None):
+        self._writer = writer
+        self._state = None
+        self._transition(state or StartState())
+        self.eventsource = getattr(self._state, 'eventsource', None)
+        self.last_event = None
 
-        :param: cat:
-          The catalogue database used to import the data
-        :type cat: CatalogueDatabase
+    def setup(self, writer):
         """
-        super(V1, self).__init__(stream, cat)
-        self._state = None
-        self._transition(StartState())
+        Use `writer` to persist the data parsed from now on
+        """
+        self._writer = writer
+        self._state.setup(writer)
 
-    def store(self, allow_junk=True):
+    def parse(self, lines, allow_junk=True, start=1, before_event=None):
         """
-        Read and parse from the input stream the data and insert them
-        into the catalogue db. If `allow_junk` is True, it allows
-        unexpected line inputs at the beginning of the file
+        Feed the fsm with `lines`, numbered from `start`. Yields the
+        number of each line processed and the partial summary
+        returned by its state. If given, `before_event` is called
+        before each event header is processed, when all the previous
+        events have been handed to the writer.
         """
-        for line_num, line in enumerate(self._file_stream, start=1):
+        for line_num, line in enumerate(lines, start=start):
             line = line.strip()
 
             # line_type acts as "event" in the traditional fsm jargon.
@@ -468,60 +325,293 @@ class V1(Importer):
                 continue
             elif line_type == "stop":
                 break
+            elif line_type == "event_header":
+                if before_event is not None:
+                    before_event()
+                # batches are stored only between two seismic events
+                self._writer.flush_if_full()
 
             try:
                 next_state = self._state.transition_rule(line_type)
                 self._transition(next_state)
                 try:
                     state_output = next_state.process_line(line)
-                    self.update_summary(state_output)
                 except IntegrityError:
                     raise ParsingFailure(ERR_MSG % line_num)
+                if line_type == 'catalogue_header':
+                    self.eventsource = next_state.eventsource
+                elif line_type == 'event_header':
+                    self.last_event = next_state.event.source_key
             except UnexpectedLine as e:
                 current = self._state
                 if current.is_start() and line_type == 'junk' and allow_junk:
                     continue
                 else:
                     raise e
-        self._catalogue.session.commit()
-        return self._summary
+            yield line_num, state_output
 
     def _detect_line_type(self, line):
-        ORIGIN_FIELDS = ["Date", "Time", "Err", "RMS", "Latitude", "Longitude",
-                         "Smaj", "Smin", "Az", "Depth", "Err", "Ndef",
-                         "Nst[a]*", "Gap", "mdist", "Mdist", "Qual", "Author",
-                         "OrigID"]
-        origin_regexp = re.compile('^%s$' % '\s+'.join(ORIGIN_FIELDS))
-
-        MEASURE_FIELDS = ["Magnitude", "Err", "Nsta", "Author", "OrigID"]
-        measure_regexp = re.compile('^%s$' % '\s+'.join(MEASURE_FIELDS))
-
-        comment_regexp = re.compile('^\([^\)].+\)')
-
-        if line == 'ISC Bulletin':
-            return "catalogue_header"
-        elif line == 'STOP':
-            return 'stop'
-        elif comment_regexp.match(line) or not line.strip():
-            return "comment"
-        elif origin_regexp.match(line):
-            return "origin_header"
-        elif measure_regexp.match(line):
-            return "measure_header"
-        elif EventState.match(line):
-            return "event_header"
-        elif len(line) == 136 and not self._state.is_start():
-            return "origin_block"
-        elif len(line) == 38 and not self._state.is_start():
-            return "measure_block"
-        elif MeasureUKScaleBlockState.match(line):
-            return "measure_unknown_scale_block"
-        else:
-            return "junk"
+        return detect_line_type(line, not self._state.is_start())
 
     def _transition(self, next_state):
         self._state = next_state
-        self._state.setup(self._catalogue)
+        self._state.setup(self._writer)
+
+
+def split_events(stream, chunk_size=None):
+    """
+    Split the lines of an ISF `stream` in chunks of about
+    `chunk_size` lines, each one but the first starting with an event
+    header. Yields tuples with the number of the first line of the
+    chunk, the name of the event source the chunk belongs to (None if
+    still unknown) and the lines of the chunk.
+    """
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    start, eventsource, lines = 1, None, []
+    chunk_eventsource = None
+    for line_num, line in enumerate(stream, start=1):
+        stripped = line.strip()
+        if (len(lines) >= chunk_size and stripped.startswith('Event ')
+            and EventState.match(stripped)):
+            yield start, chunk_eventsource, lines
+            start, chunk_eventsource, lines = line_num, eventsource, []
+        lines.append(line)
+        if stripped == CATALOGUE_HEADER:
+            eventsource = stripped
+        elif stripped == 'STOP':
+            break
+    if lines:
+        yield start, chunk_eventsource, lines
+
+
+def parse_chunk(chunk, allow_junk=True):
+    """
+    Parse a chunk given by :func:`split_events` without accessing the
+    database. Returns a list of (line number, calls) tuples, where
+    each call is a tuple of the method, the arguments and the
+    placeholder recorded by a
+    :class:`~eqcatalogue.importers.writers.RecordingWriter` plus the
+    summary item it updates, and the exception that stopped the
+    parsing, if any.
+    """
+    start, eventsource, lines = chunk
+    writer = RecordingWriter()
+    state = StartState()
+    if eventsource is not None:
+        state.eventsource = Placeholder('eventsource', eventsource, None)
+    parser = Parser(writer, state)
+    records = []
+    try:
+        for line_num, state_output in parser.parse(lines, allow_junk, start):
+            calls = []
+            for method, args, placeholder in writer.calls:
+                summary_key = SUMMARY_KEYS.get(method)
+                if not summary_key in state_output:
+                    summary_key = None
+                calls.append((method, args, placeholder, summary_key))
+            records.append((line_num, calls))
+            writer.calls = []
+    # UnexpectedLine is not an Exception, so it would not be sent back
+    # by the process pool
+    except (UnexpectedLine, Exception) as e:
+        return records, e
+    return records, None
+
+
+def _parse_chunk(args):
+    return parse_chunk(*args)
+
+
+class V1(Importer):
+    """
+    Import data into a CatalogueDatabase from stream objects.
+
+    The specification of the format can be found at
+    http://www.isc.ac.uk/standards/isf/
+
+    Data file in ISF format can be generated at
+    http://www.isc.ac.uk/iscbulletin/search/bulletin/
+
+    by flagging "Only prime hypocentre" and checking that "Output web
+    links" is unchecked
+    """
+
+    def __init__(self, stream, cat):
+        """
+        Initialize the importer.
+
+        :param: stream:
+          A stream object storing the seismic event data, or the path
+          of a (possibly compressed) file storing them
+        :type stream: file or string
+
+        :param: cat:
+          The catalogue database used to import the data
+        :type cat: CatalogueDatabase
+        """
+        super(V1, self).__init__(stream, cat)
+        self._writer = SessionWriter(cat, self._cache)
+        self._parser = Parser(self._writer)
+
+    def store(self, allow_junk=True, bulk=False, batch_size=None,
+              processes=None, chunk_size=None, checkpoint=None):
+        """
+        Read and parse from the input stream the data and insert them
+        into the catalogue db. If `allow_junk` is True, it allows
+        unexpected line inputs at the beginning of the file.
+
+        If `bulk` is True, the parsed data are buffered and stored in
+        batches of about `batch_size` rows (see
+        :class:`~eqcatalogue.importers.writers.BulkWriter`), each one
+        inside its own transaction. The stream is parsed in chunks of
+        about `chunk_size` lines, and the events, agencies and origins
+        of each chunk already stored are looked up at once. The
+        returned summary then reports also the number of rows stored
+        per second.
+
+        If `processes` is given, the stream is split in chunks of
+        about `chunk_size` lines at event headers, and the chunks are
+        parsed by a pool of `processes` processes. The parsed data are
+        stored by the calling process only, in the same order, so the
+        result is the same as the one of a serial import.
+
+        If `checkpoint` is given, it identifies the input file (e.g. by
+        its name) and the import records its progress at each commit
+        into an :class:`~eqcatalogue.models.ImportCheckpoint`. A later
+        import with the same `checkpoint` skips the data already
+        imported, provided that the file still starts with them. This
+        allows resuming an interrupted import and importing only what
+        has been appended to a growing bulletin. Checkpoints are not
+        supported when parsing in parallel, and the data are then
+        looked up one event at a time, as the checkpoint is updated
+        before each event.
+
+        A sharded catalogue is written by bulk imports only.
+        """
+        if processes and checkpoint is not None:
+            raise ValueError(
+                "Checkpoints are not supported when parsing in parallel")
+        if not bulk and self._catalogue.sharded:
+            raise ValueError(
+                "A sharded catalogue is written by bulk imports only: "
+                "store the bulletin with bulk=True")
+        if bulk:
+            self._writer = BulkWriter(self._catalogue, batch_size)
+            self._parser.setup(self._writer)
+        start = time.time()
+
+        try:
+            if checkpoint is not None:
+                self._store_from_checkpoint(allow_junk, checkpoint)
+            elif processes or bulk:
+                self._store_chunks(allow_junk, processes, chunk_size)
+            else:
+                for _, state_output in self._parser.parse(self._file_stream,
+                                                          allow_junk):
+                    self.update_summary(state_output)
+        except ParsingFailure:
+            # leave the session usable by the following imports
+            self._catalogue.session.rollback()
+            raise
+        self._writer.flush()
+        if bulk:
+            elapsed = time.time() - start
+            self._summary[Importer.ROWS_PER_SECOND] = (
+                self._writer.rows_written / elapsed if elapsed else None)
+        return self._summary
+
+    def _store_from_checkpoint(self, allow_junk, source):
+        checkpoint, lines = self._resume(source)
+        if checkpoint.eventsource is not None:
+            # the data to import follow an event already imported
+            state = StartState()
+            state.eventsource = checkpoint.eventsource
+            self._parser = Parser(self._writer, state)
+            self._parser.last_event = checkpoint.last_event
+
+        def update_checkpoint():
+            self._update_checkpoint(checkpoint, lines,
+                                    self._parser.eventsource,
+                                    self._parser.last_event)
+
+        for _, state_output in self._parser.parse(
+            lines, allow_junk, lines.line_num + 1, update_checkpoint):
+            self.update_summary(state_output)
+        update_checkpoint()
+
+    def _store_chunks(self, allow_junk, processes, chunk_size):
+        """
+        Parse the stream in chunks (see :func:`split_events`), by a
+        pool of `processes` processes if given, otherwise by the
+        calling process, and replay the calls recorded for each chunk
+        on the writer
+        """
+        replayer = Replayer(self._writer)
+        chunks = split_events(self._file_stream, chunk_size)
+        pool = multiprocessing.Pool(processes) if processes else None
+        try:
+            while True:
+                # keep a bounded number of chunks in memory
+                window = [(chunk, allow_junk)
+                          for chunk in islice(chunks, 2 * (processes or 1))]
+                if not window:
+                    break
+                if pool is None:
+                    results = (_parse_chunk(args) for args in window)
+                else:
+                    results = pool.imap(_parse_chunk, window)
+                for records, error in results:
+                    self._replay(replayer, records)
+                    if error is not None:
+                        raise error
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _source_keys(self, records):
+        """
+        Returns the source keys of the events, agencies and origins
+        of the calls recorded in `records`, as a dictionary that maps
+        the placeholders of the event sources to the keys by type
+        (see :meth:`~eqcatalogue.importers.writers.BulkWriter.prefetch`).
+        Empty if the writer does not look up rows at once.
+        """
+        source_keys = {}
+        if not hasattr(self._writer, 'prefetch'):
+            return source_keys
+        for _, calls in records:
+            for method, args, _, _ in calls:
+                if method in PREFETCHED:
+                    source_keys.setdefault(args[0], {}).setdefault(
+                        PREFETCHED[method], set()).add(args[1])
+        return source_keys
+
+    def _prefetch(self, replayer, source_keys):
+        """
+        Look up at once the rows of the event sources of `source_keys`
+        already replayed, and remove them from `source_keys`
+        """
+        for placeholder in list(source_keys):
+            eventsource = replayer.resolve(placeholder)
+            if eventsource is not None:
+                self._writer.prefetch(eventsource,
+                                      source_keys.pop(placeholder))
+
+    def _replay(self, replayer, records):
+        # the rows of an event source are looked up as soon as it is
+        # known, e.g. after the catalogue header of the first chunk
+        source_keys = self._source_keys(records)
+        for line_num, calls in records:
+            try:
+                for method, args, placeholder, summary_key in calls:
+                    if source_keys:
+                        self._prefetch(replayer, source_keys)
+                    _, created = replayer.replay(method, args, placeholder)
+                    if summary_key is not None:
+                        self.update_summary({summary_key: 1 if created else 0})
+            except IntegrityError:
+                raise ParsingFailure(ERR_MSG % line_num)
 
     def update_summary(self, output):
         for object_type, nr in output.items():
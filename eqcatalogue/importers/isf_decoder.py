@@ -0,0 +1,304 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# eqcataloguetool is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# EqCatalogueTool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with eqcataloguetool. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module :mod:`eqcatalogue.importers.isf_decoder` decodes the lines of
+a stream in ISF format (see http://www.isc.ac.uk/standards/isf/) into
+lightweight records, without accessing any database. It is used by
+:mod:`eqcatalogue.importers.isf_bulletin` and it can be used on its
+own to validate or convert bulletins, e.g.::
+
+  for line_num, line_type, record in decode(file('bulletin.txt')):
+      if line_type == 'origin_block':
+          print record.source_key, record.latitude, record.longitude
+"""
+
+import re
+import datetime
+from collections import namedtuple
+
+
+ANALYSIS_TYPES = {'a': 'automatic',
+                  'm': 'manual',
+                  'g': 'guess'}
+
+LOCATION_METHODS = {
+    'i': 'inversion',
+    'p': 'pattern recognition',
+    'g': 'ground truth',
+    'o': 'other'
+    }
+
+EVENT_TYPES = {
+    'uk': 'unknown',
+    'de': 'damaging earthquake ( Not standard IMS )',
+    'fe': 'felt earthquake ( Not standard IMS )',
+    'ke': 'known earthquake',
+    'se': 'suspected earthquake',
+    'kr': 'known rockburst',
+    'sr': 'suspected rockburst',
+    'ki': 'known induced event',
+    'si': 'suspected induced event',
+    'km': 'known mine expl.',
+    'sm': 'suspected mine expl.',
+    'kh': 'known chemical expl. ( Not standard IMS )',
+    'sh': 'suspected chemical expl. ( Not standard IMS )',
+    'kx': 'known experimental expl.',
+    'sx': 'suspected experimental expl.',
+    'kn': 'known nuclear expl.',
+    'sn': 'suspected nuclear explosion',
+    'ls': 'landslide'
+    }
+
+CATALOGUE_HEADER = 'ISC Bulletin'
+
+ORIGIN_FIELDS = ["Date", "Time", "Err", "RMS", "Latitude", "Longitude",
+                 "Smaj", "Smin", "Az", "Depth", "Err", "Ndef",
+                 "Nst[a]*", "Gap", "mdist", "Mdist", "Qual", "Author",
+                 "OrigID"]
+MEASURE_FIELDS = ["Magnitude", "Err", "Nsta", "Author", "OrigID"]
+
+ORIGIN_HEADER_REGEXP = re.compile('^%s$' % '\s+'.join(ORIGIN_FIELDS))
+MEASURE_HEADER_REGEXP = re.compile('^%s$' % '\s+'.join(MEASURE_FIELDS))
+COMMENT_REGEXP = re.compile('^\([^\)].+\)')
+EVENT_REGEXP = re.compile(
+    '^Event (?P<source_event_id>\w{0,9}) (?P<name>.{0,65})$')
+UK_MEASURE_REGEXP = re.compile(
+    '^(?P<val>-*[0-9]+\.[0-9]+)\s+(?P<error>[0-9]+\.[0-9]+)*\s+'
+    '(?P<stations>[0-9]+)*\s+(?P<agency>\w+)\s+(?P<origin>\w+)$')
+
+# Length of the fixed-width origin and magnitude lines
+ORIGIN_LENGTH = 136
+MEASURE_LENGTH = 38
+
+# Column layout of an origin line
+ORIGIN_DATE = slice(0, 10)
+ORIGIN_TIME = slice(11, 19)
+ORIGIN_MSEC = slice(20, 22)
+ORIGIN_TIME_FIXED = 22
+ORIGIN_TIME_ERROR = slice(24, 29)
+ORIGIN_TIME_RMS = slice(30, 35)
+ORIGIN_LATITUDE = slice(36, 44)
+ORIGIN_LONGITUDE = slice(45, 54)
+ORIGIN_POSITION_FIXED = 54
+ORIGIN_SEMI_MAJOR = slice(55, 60)
+ORIGIN_SEMI_MINOR = slice(61, 66)
+ORIGIN_STRIKE = slice(67, 70)
+ORIGIN_DEPTH = slice(71, 76)
+ORIGIN_DEPTH_FIXED = 76
+ORIGIN_DEPTH_ERROR = slice(78, 82)
+ORIGIN_PHASES = slice(83, 87)
+ORIGIN_STATIONS = slice(88, 92)
+ORIGIN_AZIMUTH_GAP = slice(93, 96)
+ORIGIN_MIN_DISTANCE = slice(97, 103)
+ORIGIN_MAX_DISTANCE = slice(104, 110)
+ORIGIN_ANALYSIS_TYPE = 111
+ORIGIN_LOCATION_METHOD = 113
+ORIGIN_EVENT_TYPE = slice(115, 117)
+ORIGIN_AUTHOR = slice(118, 127)
+ORIGIN_ID = slice(128, 136)
+
+# Column layout of a magnitude line
+MEASURE_SCALE = slice(0, 5)
+MEASURE_MINMAX = 5
+MEASURE_VALUE = slice(6, 10)
+MEASURE_ERROR = slice(11, 14)
+MEASURE_STATIONS = slice(15, 19)
+MEASURE_AUTHOR = slice(20, 29)
+MEASURE_ORIGIN_ID = slice(30, 38)
+
+EventRecord = namedtuple('EventRecord', 'source_key name')
+
+# The attributes of an origin, followed by its metadata
+ORIGIN_ATTRIBUTES = ('time', 'time_error', 'time_rms', 'latitude',
+                     'longitude', 'semi_major_90error', 'semi_minor_90error',
+                     'depth', 'depth_error', 'azimuth_error')
+ORIGIN_METADATA = ('strike', 'phases', 'stations',
+                   'distance_to_closest_station',
+                   'distance_to_furthest_station', 'analysis_type',
+                   'location_method', 'event_type')
+OriginRecord = namedtuple(
+    'OriginRecord',
+    ('agency', 'source_key') + ORIGIN_ATTRIBUTES + ORIGIN_METADATA)
+
+MeasureRecord = namedtuple(
+    'MeasureRecord',
+    'scale value standard_error stations agency origin_source_key')
+
+
+def _float(text):
+    return float(text) if text.strip() else None
+
+
+def _int(text):
+    return int(text) if text.strip() else None
+
+
+def detect_line_type(line, started=True):
+    """
+    Returns the type of a stripped `line`. Origin and magnitude lines
+    are recognised by their length, only if `started` is True, i.e.
+    after the catalogue header.
+    """
+    if line == CATALOGUE_HEADER:
+        return "catalogue_header"
+    elif line == 'STOP':
+        return 'stop'
+    elif not line.strip() or COMMENT_REGEXP.match(line):
+        return "comment"
+    elif ORIGIN_HEADER_REGEXP.match(line):
+        return "origin_header"
+    elif MEASURE_HEADER_REGEXP.match(line):
+        return "measure_header"
+    elif EVENT_REGEXP.match(line):
+        return "event_header"
+    elif len(line) == ORIGIN_LENGTH and started:
+        return "origin_block"
+    elif len(line) == MEASURE_LENGTH and started:
+        return "measure_block"
+    elif UK_MEASURE_REGEXP.match(line):
+        return "measure_unknown_scale_block"
+    else:
+        return "junk"
+
+
+def decode_event(line):
+    """
+    Decode an event header line into an :class:`EventRecord`
+    """
+    result = EVENT_REGEXP.match(line)
+    return EventRecord(result.group('source_event_id'), result.group('name'))
+
+
+def decode_time(line):
+    """
+    Decode the time of an origin line. Some agency does not provide
+    the msec part
+    """
+    datetime_components = (line[ORIGIN_DATE].split('/') +
+                           line[ORIGIN_TIME].split(':'))
+    if line[ORIGIN_MSEC].strip():
+        datetime_components.append(line[ORIGIN_MSEC])
+    return datetime.datetime(*[int(d) for d in datetime_components])
+
+
+def decode_origin(line):
+    """
+    Decode an origin line into an :class:`OriginRecord`
+    """
+    if line[ORIGIN_TIME_FIXED] == 'f':
+        time_error = None
+    else:
+        time_error = _float(line[ORIGIN_TIME_ERROR])
+
+    fixed_position = line[ORIGIN_POSITION_FIXED] == 'f'
+    if fixed_position:
+        semi_major_90error = semi_minor_90error = None
+    else:
+        semi_major_90error = _float(line[ORIGIN_SEMI_MAJOR])
+        semi_minor_90error = _float(line[ORIGIN_SEMI_MINOR])
+
+    depth = _float(line[ORIGIN_DEPTH])
+    if (line[ORIGIN_DEPTH_FIXED] == 'f' or
+        not line[ORIGIN_DEPTH_ERROR].strip()):
+        depth_error = None
+    else:
+        depth_error = depth
+
+    analysis_type = line[ORIGIN_ANALYSIS_TYPE].strip()
+    location_method = line[ORIGIN_LOCATION_METHOD].strip()
+    event_type = line[ORIGIN_EVENT_TYPE].strip()
+
+    return OriginRecord(
+        agency=line[ORIGIN_AUTHOR].strip(),
+        source_key=line[ORIGIN_ID],
+        time=decode_time(line),
+        time_error=time_error,
+        time_rms=_float(line[ORIGIN_TIME_RMS]),
+        latitude=float(line[ORIGIN_LATITUDE]),
+        longitude=float(line[ORIGIN_LONGITUDE]),
+        semi_major_90error=semi_major_90error,
+        semi_minor_90error=semi_minor_90error,
+        depth=depth,
+        depth_error=depth_error,
+        azimuth_error=_int(line[ORIGIN_AZIMUTH_GAP]),
+        strike=_int(line[ORIGIN_STRIKE]),
+        phases=_int(line[ORIGIN_PHASES]),
+        stations=_int(line[ORIGIN_STATIONS]),
+        distance_to_closest_station=_float(line[ORIGIN_MIN_DISTANCE]),
+        distance_to_furthest_station=_float(line[ORIGIN_MAX_DISTANCE]),
+        analysis_type=ANALYSIS_TYPES[analysis_type] if analysis_type else None,
+        location_method=(LOCATION_METHODS[location_method]
+                         if location_method else None),
+        event_type=EVENT_TYPES[event_type] if event_type else None)
+
+
+def decode_measure(line):
+    """
+    Decode a magnitude line into a :class:`MeasureRecord`
+    """
+    assert not line[MEASURE_MINMAX].strip()
+    return MeasureRecord(
+        scale=line[MEASURE_SCALE].strip(),
+        value=float(line[MEASURE_VALUE]),
+        standard_error=_float(line[MEASURE_ERROR]),
+        stations=_int(line[MEASURE_STATIONS]),
+        agency=line[MEASURE_AUTHOR].strip(),
+        origin_source_key=line[MEASURE_ORIGIN_ID])
+
+
+def decode_uk_measure(line):
+    """
+    Decode a magnitude line with an unknown scale into a
+    :class:`MeasureRecord`
+    """
+    data = UK_MEASURE_REGEXP.match(line).groupdict()
+    return MeasureRecord(
+        scale='Muk',
+        value=float(data['val']),
+        standard_error=float(data['error']) if data['error'] else None,
+        stations=int(data['stations']) if data['stations'] else None,
+        agency=data['agency'],
+        origin_source_key=data['origin'])
+
+
+DECODERS = {
+    'catalogue_header': lambda line: line,
+    'event_header': decode_event,
+    'origin_block': decode_origin,
+    'measure_block': decode_measure,
+    'measure_unknown_scale_block': decode_uk_measure}
+
+
+def decode(lines, start=1):
+    """
+    Decode the `lines` of an ISF stream, numbered from `start`, until
+    the end of the bulletin. Yields a tuple with the number, the type
+    and the record of each line that is not a comment. The record of
+    the catalogue header is the name of the catalogue, lines without
+    data (headers of blocks and junk) have no record.
+    """
+    started = False
+    for line_num, line in enumerate(lines, start=start):
+        line = line.strip()
+        line_type = detect_line_type(line, started)
+        if line_type == 'comment':
+            continue
+        elif line_type == 'stop':
+            break
+        elif line_type == 'catalogue_header':
+            started = True
+        decoder = DECODERS.get(line_type)
+        yield line_num, line_type, decoder(line) if decoder else None
@@ -13,6 +13,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with EqCatalogueTool. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import bz2
+import gzip
+import mmap
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 CSV_FIELDNAMES = ['eventKey', 'solutionKey', 'solutionDesc',
                     'originID', 'year', 'month', 'day', 'hour',
                     'minute', 'second', 'timeError', 'time_rms',
@@ -42,6 +57,61 @@ def convert_to_float(str_value):
     return value
 
 
+def float_column(values):
+    """
+    Convert a sequence of strings into a float64 array in a single
+    pass. Blank values, or values that are not numbers, are converted
+    to nan.
+    """
+    column = np.char.strip(np.asarray(values, dtype=str))
+    column[column == ''] = 'nan'
+    try:
+        return column.astype(np.float64)
+    except ValueError:
+        return np.array([convert_to_float(value) for value in column],
+                        dtype=np.float64)
+
+
+def iso_datetime_column(values):
+    """
+    Convert a sequence of ISO 8601 strings (e.g.
+    '2008-02-09T07:12:06.43') into a datetime64 array with a
+    microsecond resolution
+    """
+    return np.array(values, dtype='datetime64[us]')
+
+
+def datetime_column(years, months, days, hours, minutes, seconds):
+    """
+    Build a datetime64 array with a microsecond resolution from
+    float64 arrays of the date and time components. The datetimes
+    with a missing component are not a time (NaT).
+    """
+    components = np.vstack([years, months, days, hours, minutes, seconds])
+    missing = np.isnan(components).any(axis=0)
+    components[:, missing] = 0
+    years, months, days, hours, minutes, seconds = components
+    column = ((years - 1970).astype('datetime64[Y]').astype('datetime64[M]')
+              + (months - 1).astype('timedelta64[M]')).astype(
+        'datetime64[us]')
+    column += ((days - 1).astype('timedelta64[D]') +
+               hours.astype('timedelta64[h]') +
+               minutes.astype('timedelta64[m]'))
+    column += np.round(seconds * 1e6).astype('timedelta64[us]')
+    column[missing] = np.datetime64('NaT')
+    return column
+
+
+def column_values(column):
+    """
+    Returns the values of a float64 or datetime64 array as a list of
+    python objects, with None in place of nan and NaT
+    """
+    if column.dtype.kind == 'M':
+        return column.tolist()
+    return [None if np.isnan(value) else value for value in column.tolist()]
+
+
 STR_TRANSF = [str.strip]
 INT_TRANSF = [convert_to_int]
 FLOAT_TRANSF = [convert_to_float]
@@ -61,3 +131,80 @@ TRANSF_MAP = {'eventKey': STR_TRANSF, 'solutionKey': STR_TRANSF,
                 'magnitude': FLOAT_TRANSF, 'solutionAgency': STR_TRANSF,
                 'mag_type': STR_TRANSF, 'mag_agency': STR_TRANSF,
                 'magnitudeError': FLOAT_TRANSF, 'magStations': INT_TRANSF}
+
+
+class MappedFile(object):
+    """
+    A read-only file object over a memory map of the file at `path`.
+    Lines are split by the memory map itself, without going through
+    the buffers of a python file object. Each line is still copied
+    into a new string, as the readers parse strings: what is saved is
+    the read system calls and the copy of the data into the buffer of
+    a file object, as the pages of the file are read from the page
+    cache when touched.
+
+    :param path: the path of the file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fileobj:
+            self._map = mmap.mmap(fileobj.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        return iter(self._map.readline, '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def readline(self):
+        return self._map.readline()
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._map.size() - self._map.tell()
+        return self._map.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._map.seek(offset, whence)
+
+    def tell(self):
+        return self._map.tell()
+
+    def close(self):
+        self._map.close()
+
+
+def _open_xz(path):
+    if lzma is None:
+        raise ImportError(
+            "Reading xz files needs the lzma module "
+            "(backports.lzma on python 2)")
+    return lzma.LZMAFile(path)
+
+DECOMPRESSORS = {'.gz': gzip.GzipFile,
+                 '.bz2': bz2.BZ2File,
+                 '.xz': _open_xz}
+
+
+def open_stream(source):
+    """
+    Returns a stream over the lines of `source`. If `source` is not a
+    path, it is assumed to be a stream and it is returned as it is.
+
+    Files compressed with gzip, bzip2 or xz (recognised by their
+    extension) are decompressed while they are read, other non-empty
+    files are read through a :class:`MappedFile`.
+    """
+    if not isinstance(source, basestring):
+        return source
+    extension = os.path.splitext(source)[1].lower()
+    if extension in DECOMPRESSORS:
+        return DECOMPRESSORS[extension](source)
+    elif not os.path.getsize(source):
+        # empty files can not be memory-mapped
+        return open(source, 'rb')
+    return MappedFile(source)
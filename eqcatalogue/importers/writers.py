@@ -0,0 +1,653 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# eqcataloguetool is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# EqCatalogueTool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with eqcataloguetool. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module :mod:`eqcatalogue.importers.writers` defines the objects used by
+the importers to persist what they have parsed:
+:class:`SessionWriter` stores each object through the ORM session as
+soon as it is parsed, :class:`BulkWriter` buffers rows and stores them
+in batches.
+"""
+
+import collections
+from collections import namedtuple
+
+import sqlalchemy
+from sqlalchemy import orm
+from sqlalchemy.exc import IntegrityError
+
+from eqcatalogue import models as catalogue
+from eqcatalogue.importers.base import IdentityCache
+
+
+DEFAULT_BATCH_SIZE = 10000
+
+# The number of keys of the rows already stored kept in memory by a
+# BulkWriter (see KeyCache)
+DEFAULT_KEY_CACHE_SIZE = 100000
+
+# The number of keys looked up by a single query, as the number of
+# the parameters of a statement is limited
+LOOKUP_CHUNK_SIZE = 500
+
+# A lightweight reference to a row buffered or stored by a
+# BulkWriter. It exposes the attributes the importers need to link
+# the objects together
+RowRef = namedtuple('RowRef', 'id source_key eventsource')
+
+
+class SessionWriter(object):
+    """
+    Persist each object through the ORM session of the catalogue
+    database. Objects identified by an event source and a source key
+    are looked up through an
+    :class:`~eqcatalogue.importers.base.IdentityCache`.
+
+    :param cat: the catalogue database used to store the data
+
+    :param cache: the identity cache used for lookups. If not
+      given, a new one is created
+    """
+
+    def __init__(self, cat, cache=None):
+        self._catalogue = cat
+        self._cache = cache or IdentityCache(cat)
+
+    def eventsource(self, name):
+        """
+        Get or create the event source named `name`
+        """
+        return self._cache.get_or_create(catalogue.EventSource, None, name)
+
+    def event(self, eventsource, source_key, name=None):
+        """
+        Get or create the event `source_key` of `eventsource` and
+        update its name
+        """
+        event, created = self._cache.get_or_create(
+            catalogue.Event, eventsource, source_key)
+        if event.name != name:
+            event.name = name
+        self._catalogue.session.commit()
+        return event, created
+
+    def agency(self, eventsource, source_key):
+        """
+        Get or create the agency `source_key` of `eventsource`
+        """
+        return self._cache.get_or_create(catalogue.Agency, eventsource,
+                                         source_key)
+
+    def origin(self, eventsource, source_key, values):
+        """
+        Get or create the origin `source_key` of `eventsource`.
+
+        :param values: a dictionary with the origin attributes. The
+          position is given by its `latitude` and `longitude` keys.
+        """
+        values = dict(values)
+        values['position'] = self._catalogue.position_from_latlng(
+            values.pop('latitude'), values.pop('longitude'))
+        return self._cache.get_or_create(catalogue.Origin, eventsource,
+                                         source_key, values)
+
+    def find_origin(self, eventsource, source_key):
+        """
+        Returns the origin `source_key` of `eventsource` or None if
+        it does not exist
+        """
+        origin = self._cache.find(catalogue.Origin, eventsource, source_key)
+        self._catalogue.session.commit()
+        return origin
+
+    def measure(self, event, agency, origin, scale, values):
+        """
+        Get or create the measure of `event` in `scale` provided by
+        `agency` for `origin`.
+
+        :param values: a dictionary with the measure `value` and
+          `standard_error`.
+        """
+        return self._catalogue.get_or_create(
+            catalogue.MagnitudeMeasure,
+            {'event': event, 'origin': origin,
+             'agency': agency, 'scale': scale},
+            dict(values))
+
+    def flush_if_full(self):
+        """
+        Objects are stored as soon as they are created, there is
+        nothing to do.
+        """
+
+    def flush(self):
+        """
+        Commit the current transaction
+        """
+        self._catalogue.session.commit()
+        self._catalogue.bump_generation()
+
+
+class KeyCache(object):
+    """
+    A least recently used map of the keys of the rows already stored
+    to their ids, holding at most `size` keys, so that the memory used
+    by a :class:`BulkWriter` does not grow with the catalogue.
+
+    :attribute hits: the number of lookups served by the cache
+
+    :attribute misses: the number of lookups of keys not in the cache
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._values = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key):
+        """
+        Returns the value of `key`, None if it is not in the cache
+        """
+        if key in self._values:
+            self.hits += 1
+            value = self._values.pop(key)
+            self._values[key] = value
+            return value
+        self.misses += 1
+        return None
+
+    def pop(self, key):
+        """
+        Remove `key` from the cache and returns its value, None if it
+        is not in the cache
+        """
+        return self._values.pop(key, None)
+
+    def put(self, key, value):
+        """
+        Set the value of `key`, discarding the least recently used
+        keys beyond the size of the cache
+        """
+        self._values.pop(key, None)
+        self._values[key] = value
+        while len(self._values) > self.size:
+            self._values.popitem(last=False)
+
+
+class BulkWriter(object):
+    """
+    Buffer the rows of events, agencies, origins, measures and their
+    metadata and store them in batches, each batch inside its own
+    transaction.
+
+    The ids of the rows already stored are looked up by their keys,
+    through a query per key or, for the keys given to
+    :meth:`prefetch`, through a query per block of keys, and kept in a
+    :class:`KeyCache` of at most `key_cache_size` keys. The keys of
+    the rows buffered are kept until they are stored, so memory use
+    depends on the batch size and on the size of the cache, not on
+    the size of the catalogue. Primary keys are allocated by the
+    writer itself, so the rows can be inserted with a single
+    `executemany` per table. For this reason only one writer at a
+    time should store data into a catalogue.
+
+    :param cat: the catalogue database used to store the data
+
+    :param batch_size: the number of buffered rows that makes
+      :meth:`flush_if_full` actually store the rows
+
+    :param key_cache_size: the number of keys kept by the cache
+    """
+
+    # the order in which the buffered rows are inserted, such that
+    # each foreign key references a row already stored
+    TABLES = (catalogue.Event, catalogue.Agency, catalogue.Origin,
+              catalogue.MagnitudeMeasure, catalogue.MeasureMetadata)
+
+    def __init__(self, cat, batch_size=None, key_cache_size=None):
+        self._catalogue = cat
+        self._session = cat.session
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.rows_written = 0
+        self._rows = dict((class_object, []) for class_object in self.TABLES)
+        self._event_names = []
+        self._next_ids = {}
+        self.cache = KeyCache(key_cache_size or DEFAULT_KEY_CACHE_SIZE)
+        # the keys of the rows buffered, or whose measures are, since
+        # the last flush: they can not be looked up in the database
+        self._pending = {}
+        # the keys not found in the database by the last prefetch of
+        # each event source
+        self._absent = set()
+
+    @staticmethod
+    def _table(class_object):
+        return orm.class_mapper(class_object).mapped_table
+
+    @property
+    def pending(self):
+        """
+        The number of rows buffered and not yet stored
+        """
+        return (sum(len(rows) for rows in self._rows.values()) +
+                len(self._event_names))
+
+    def _next_id(self, class_object):
+        if not class_object in self._next_ids:
+            table = self._table(class_object)
+            last_id = self._session.execute(
+                sqlalchemy.select([sqlalchemy.func.max(table.c.id)])).scalar()
+            self._next_ids[class_object] = (last_id or 0) + 1
+        next_id = self._next_ids[class_object]
+        self._next_ids[class_object] = next_id + 1
+        return next_id
+
+    def _load_keys(self, class_object, eventsource, source_keys):
+        """
+        Look up the rows of type `class_object` imported from
+        `eventsource` with the given `source_keys` and keep their ids
+        in the cache. Returns a dictionary that maps the source keys
+        found to their id. Events map to a (id, name) tuple.
+        """
+        table = self._table(class_object)
+        columns = [table.c.source_key, table.c.id]
+        if class_object is catalogue.Event:
+            columns.append(table.c.name)
+        source_keys = list(source_keys)
+        found = {}
+        for i in range(0, len(source_keys), LOOKUP_CHUNK_SIZE):
+            for row in self._session.execute(sqlalchemy.select(columns).where(
+                    sqlalchemy.and_(
+                        table.c.eventsource_id == eventsource.id,
+                        table.c.source_key.in_(
+                            source_keys[i:i + LOOKUP_CHUNK_SIZE])))):
+                if class_object is catalogue.Event:
+                    found[row[0]] = (row[1], row[2])
+                else:
+                    found[row[0]] = row[1]
+        for source_key, value in found.items():
+            self.cache.put((class_object, eventsource.id, source_key), value)
+        return found
+
+    def _load_measures(self, event_ids):
+        """
+        Look up the measures of the events `event_ids` and keep them
+        in the cache, as a dictionary per event that maps the
+        (origin id, agency id, scale) of each measure to its id.
+        Returns the dictionaries by event id.
+        """
+        measure = self._table(catalogue.MagnitudeMeasure)
+        event_ids = list(event_ids)
+        measures = dict((event_id, {}) for event_id in event_ids)
+        for i in range(0, len(event_ids), LOOKUP_CHUNK_SIZE):
+            for row in self._session.execute(
+                sqlalchemy.select([measure.c.event_id, measure.c.origin_id,
+                                   measure.c.agency_id, measure.c.scale,
+                                   measure.c.id]).where(
+                    measure.c.event_id.in_(
+                        event_ids[i:i + LOOKUP_CHUNK_SIZE]))):
+                measures[row[0]][tuple(row[1:4])] = row[4]
+        for event_id, event_measures in measures.items():
+            self.cache.put(('measures', event_id), event_measures)
+        return measures
+
+    def prefetch(self, eventsource, source_keys):
+        """
+        Look up at once the rows imported from `eventsource` about to
+        be given to the writer, e.g. the ones of a block of entries,
+        instead of one at a time. The measures of the events found are
+        looked up too.
+
+        :param source_keys: a dictionary that maps the types of the
+          rows (events, agencies and origins) to their source keys.
+          Missing keys (None) are skipped.
+        """
+        self._absent = set(key for key in self._absent
+                           if key[1] != eventsource.id)
+        for class_object, keys in source_keys.items():
+            keys = set(key for key in keys if key is not None and
+                       self._unknown((class_object, eventsource.id, key)))
+            found = self._load_keys(class_object, eventsource, keys)
+            self._absent.update((class_object, eventsource.id, key)
+                                for key in keys if not key in found)
+            if class_object is catalogue.Event:
+                self._load_measures(
+                    event_id for event_id, _ in found.values()
+                    if self._unknown(('measures', event_id)))
+
+    def _unknown(self, key):
+        """
+        Tells if `key` is neither pending nor in the cache
+        """
+        return not key in self._pending and not key in self.cache
+
+    def _find(self, class_object, eventsource, source_key):
+        """
+        Returns the id of the row of type `class_object` imported from
+        `eventsource` with `source_key`, None if it does not exist
+        """
+        key = (class_object, eventsource.id, source_key)
+        if key in self._pending:
+            return self._pending[key]
+        value = self.cache.get(key)
+        if value is None and not key in self._absent:
+            value = self._load_keys(
+                class_object, eventsource, [source_key]).get(source_key)
+        return value
+
+    def _set(self, key, value):
+        """
+        Set the value of `key`, pinned until the next flush if it
+        refers to a buffered row
+        """
+        if key in self._pending:
+            self._pending[key] = value
+        else:
+            self.cache.put(key, value)
+
+    def _add(self, key, value):
+        """
+        Keep the id of a row just buffered until it is stored
+        """
+        self._pending[key] = value
+        self._absent.discard(key)
+
+    def _event_measures(self, event_id):
+        """
+        Returns the dictionary of the measures of the event `event_id`
+        (see :meth:`_load_measures`), kept until the next flush as new
+        measures may be added to it
+        """
+        key = ('measures', event_id)
+        if key in self._pending:
+            return self._pending[key]
+        measures = self.cache.pop(key)
+        if measures is None:
+            measures = self._load_measures([event_id])[event_id]
+            self.cache.pop(key)
+        self._pending[key] = measures
+        return measures
+
+    def _buffer(self, class_object, row):
+        row['id'] = self._next_id(class_object)
+        self._rows[class_object].append(row)
+        return row['id']
+
+    def eventsource(self, name):
+        """
+        Get or create the event source named `name`. Event sources
+        are few, so they are stored through the ORM session
+        """
+        eventsource, created = self._catalogue.get_or_create(
+            catalogue.EventSource, {'name': name})
+        self._session.commit()
+        return eventsource, created
+
+    def event(self, eventsource, source_key, name=None):
+        """
+        Get or buffer the event `source_key` of `eventsource` and
+        update its name
+        """
+        key = (catalogue.Event, eventsource.id, source_key)
+        known = self._find(catalogue.Event, eventsource, source_key)
+        if known is not None:
+            event_id, old_name = known
+            if old_name != name:
+                self._event_names.append({'event_id': event_id,
+                                          'event_name': name})
+                self._set(key, (event_id, name))
+            created = False
+        else:
+            event_id = self._buffer(catalogue.Event, {
+                    'source_key': source_key, 'name': name,
+                    'eventsource_id': eventsource.id})
+            self._add(key, (event_id, name))
+            self._pending[('measures', event_id)] = {}
+            created = True
+        return RowRef(event_id, source_key, eventsource), created
+
+    def agency(self, eventsource, source_key):
+        """
+        Get or buffer the agency `source_key` of `eventsource`
+        """
+        agency_id = self._find(catalogue.Agency, eventsource, source_key)
+        created = agency_id is None
+        if created:
+            agency_id = self._buffer(catalogue.Agency, {
+                    'source_key': source_key,
+                    'eventsource_id': eventsource.id})
+            self._add((catalogue.Agency, eventsource.id, source_key),
+                      agency_id)
+        return RowRef(agency_id, source_key, eventsource), created
+
+    def origin(self, eventsource, source_key, values):
+        """
+        Get or buffer the origin `source_key` of `eventsource`.
+
+        :param values: a dictionary with the origin attributes. The
+          position is given by its `latitude` and `longitude` keys.
+        """
+        origin_id = self._find(catalogue.Origin, eventsource, source_key)
+        created = origin_id is None
+        if created:
+            columns = self._table(catalogue.Origin).c
+            row = dict((k, v) for k, v in values.items()
+                       if k in columns or k in ('latitude', 'longitude'))
+            row.update({'source_key': source_key,
+                        'eventsource_id': eventsource.id})
+            origin_id = self._buffer(catalogue.Origin, row)
+            self._add((catalogue.Origin, eventsource.id, source_key),
+                      origin_id)
+        return RowRef(origin_id, source_key, eventsource), created
+
+    def find_origin(self, eventsource, source_key):
+        """
+        Returns the origin `source_key` of `eventsource` or None if
+        it does not exist
+        """
+        origin_id = self._find(catalogue.Origin, eventsource, source_key)
+        if origin_id is not None:
+            return RowRef(origin_id, source_key, eventsource)
+
+    def measure(self, event, agency, origin, scale, values):
+        """
+        Get or buffer the measure of `event` in `scale` provided by
+        `agency` for `origin`.
+
+        :param values: a dictionary with the measure `value` and
+          `standard_error`.
+
+        Rows that would violate the schema constraints raise an
+        IntegrityError as soon as they are given, as the batch they
+        belong to is stored only later.
+        """
+        if origin is None or not scale in catalogue.SCALES:
+            raise IntegrityError(
+                "Invalid magnitude measure", (origin, scale), None)
+        known = self._event_measures(event.id)
+        key = (origin.id, agency.id, scale)
+        created = not key in known
+        if created:
+            row = {'event_id': event.id, 'origin_id': origin.id,
+                   'agency_id': agency.id, 'scale': scale,
+                   'value': values.get('value'),
+                   'standard_error': values.get('standard_error')}
+            known[key] = self._buffer(catalogue.MagnitudeMeasure, row)
+        return RowRef(known[key], None, event.eventsource), created
+
+    def metadata(self, measure, name, value):
+        """
+        Buffer the metadata `name` of `measure`. It should be given
+        only for the measures just created, as metadata are not looked
+        up.
+        """
+        if not name in catalogue.METADATA_TYPES:
+            raise IntegrityError("Invalid measure metadata", (name,), None)
+        self._buffer(catalogue.MeasureMetadata, {
+                'magnitudemeasure_id': measure.id,
+                'name': name, 'value': value})
+
+    def flush_if_full(self):
+        """
+        Store the buffered rows if they are at least `batch_size`
+        """
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Store all the buffered rows in a single transaction. Their
+        keys are then kept by the cache.
+        """
+        for class_object in self.TABLES:
+            rows = self._rows[class_object]
+            if rows:
+                self._catalogue.bulk_insert(class_object, rows)
+                self.rows_written += len(rows)
+                self._rows[class_object] = []
+        if self._event_names:
+            event = self._table(catalogue.Event)
+            self._session.execute(
+                event.update().where(
+                    event.c.id == sqlalchemy.bindparam('event_id')).values(
+                    name=sqlalchemy.bindparam('event_name')),
+                self._event_names)
+            self.rows_written += len(self._event_names)
+            self._event_names = []
+        self._session.commit()
+        self._catalogue.bump_generation()
+        for key, value in self._pending.items():
+            self.cache.put(key, value)
+        self._pending = {}
+
+
+# A reference to an object parsed by a RecordingWriter. Event sources
+# are identified by their name, the other objects by their kind, their
+# source key and the placeholder of their event source
+Placeholder = namedtuple('Placeholder', 'kind source_key eventsource')
+
+
+class RecordingWriter(object):
+    """
+    Record the calls made by an importer without accessing any
+    database, so that parsing can happen in a different process than
+    storing. Each call is recorded as a plain (method, args,
+    placeholder) tuple, where `placeholder` is the
+    :class:`Placeholder` returned to the importer in place of the
+    object. Calls are stored by replaying them with a
+    :class:`Replayer`.
+
+    Being unable to tell which objects are already stored, the writer
+    reports each object as created and each origin as found.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def _record(self, method, args, placeholder):
+        self.calls.append((method, args, placeholder))
+        return placeholder
+
+    def eventsource(self, name):
+        return self._record('eventsource', (name,),
+                            Placeholder('eventsource', name, None)), True
+
+    def event(self, eventsource, source_key, name=None):
+        return self._record('event', (eventsource, source_key, name),
+                            Placeholder('event', source_key,
+                                        eventsource)), True
+
+    def agency(self, eventsource, source_key):
+        return self._record('agency', (eventsource, source_key),
+                            Placeholder('agency', source_key,
+                                        eventsource)), True
+
+    def origin(self, eventsource, source_key, values):
+        return self._record('origin', (eventsource, source_key, values),
+                            Placeholder('origin', source_key,
+                                        eventsource)), True
+
+    def find_origin(self, eventsource, source_key):
+        return self._record('find_origin', (eventsource, source_key),
+                            Placeholder('origin', source_key, eventsource))
+
+    def measure(self, event, agency, origin, scale, values):
+        return self._record('measure',
+                            (event, agency, origin, scale, values),
+                            Placeholder('measure', None,
+                                        event.eventsource)), True
+
+    def flush_if_full(self):
+        """
+        Nothing is stored, there is nothing to do.
+        """
+
+    def flush(self):
+        """
+        Nothing is stored, there is nothing to do.
+        """
+
+
+class Replayer(object):
+    """
+    Replay the calls recorded by one or more :class:`RecordingWriter`
+    on `writer`, which actually stores the objects. The placeholders
+    in the arguments of each call are replaced by the objects returned
+    by the calls replayed before it. Only the objects of the current
+    event and the event sources are kept.
+
+    :param writer: the writer used to store the data
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._objects = {}
+
+    def resolve(self, arg):
+        """
+        Returns the object replacing `arg`, if it is a placeholder
+        (None if its call has not been replayed yet), otherwise `arg`
+        """
+        if isinstance(arg, Placeholder):
+            return self._objects.get(arg)
+        return arg
+
+    def replay(self, method, args, placeholder):
+        """
+        Replay a single recorded call. Returns the object and the
+        created flag given by the writer. Batches are stored only
+        before a seismic event, as when calls are not recorded.
+        """
+        if method == 'event':
+            self._writer.flush_if_full()
+            # the calls of an event refer only to its objects and to
+            # the event sources, so the objects of the previous events
+            # are dropped and memory use does not grow with the input
+            self._objects = dict(
+                (key, value) for key, value in self._objects.items()
+                if key.kind == 'eventsource')
+        result = getattr(self._writer, method)(
+            *[self.resolve(arg) for arg in args])
+        if method == 'find_origin':
+            result = result, False
+        self._objects[placeholder] = result[0]
+        return result
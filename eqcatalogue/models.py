@@ -156,7 +156,7 @@ class MagnitudeMeasure(object):
 
     :attribute scale:
       the scale used for this measure.
-      It is unique together with `agency_id` and `origin_id`
+      It is unique together with `event_id`, `agency_id` and `origin_id`
 
     :attribute value:
       the magnitude expressed in the unit suitable for the scale used
@@ -261,6 +261,17 @@ class Origin(object):
       You can create a point object by using the utility function
       `eqcatalogue.models.CatalogueDatabase.position_from_latlng`
 
+    :attribute latitude:
+      First coordinate of the position, kept in sync by the datastore
+      so that plain column comparisons can prefilter the origins.
+
+    :attribute longitude:
+      Second coordinate of the position, kept in sync by the datastore.
+
+    :attribute epoch:
+      Time expressed in seconds since 1970-01-01 UTC, kept in sync by
+      the datastore.
+
     :attribute semi_major_90error:
       Semi-Major axis of the 90th percentile confidence ellipsis of the
       epicentre.
@@ -323,6 +334,48 @@ class MeasureMetadata(object):
         self.magnitudemeasure = magnitudemeasure
 
 
+class ImportCheckpoint(object):
+    """The progress of the import of a file. It is used to resume an
+    interrupted import or to import only the data appended to a file
+    since its last import.
+
+    :attribute id:
+      Internal identifier
+
+    :attribute created_at:
+      When this object has been imported into the catalogue db
+
+    :attribute source:
+      an unique identifier of the imported file, e.g. its name
+
+    :attribute eventsource:
+      the source object the imported data belong to
+
+    :attribute byte_offset:
+      the number of bytes of the file already imported
+
+    :attribute line_num:
+      the number of lines of the file already imported
+
+    :attribute digest:
+      the sha1 hex digest of the bytes already imported
+
+    :attribute last_event:
+      the source key of the last event imported
+    """
+    def __repr__(self):
+        return "Checkpoint %s at %s" % (self.source, self.byte_offset)
+
+    def __init__(self, source, eventsource=None, byte_offset=0, line_num=0,
+                 digest=None, last_event=None):
+        self.source = source
+        self.eventsource = eventsource
+        self.byte_offset = byte_offset
+        self.line_num = line_num
+        self.digest = digest
+        self.last_event = last_event
+
+
 class Singleton(type):
     """Metaclass to implement the singleton pattern"""
     def __init__(mcs, name, bases, der):
@@ -358,6 +411,17 @@ class CatalogueDatabase(object):
     :type filename: string
     :keyword drop:
       Drop and recreate the database after opening
+    :keyword pool_size:
+      The number of connections kept open to a database file, used by
+      the threads querying the catalogue concurrently
+    :keyword profile:
+      The settings of the database connections: `safe` (the default),
+      `bulk_load` or `analytics`
+      (see :data:`eqcatalogue.datastores.spatialite.PROFILES`)
+    :keyword shard_by:
+      Store the origins and the measures of each `year` or `decade`
+      into a file of their own, next to the catalogue file
+      (see :class:`eqcatalogue.datastores.spatialite.Engine`)
 
     e.g.::
       cat = CatalogueDatabase(filename="my-catalogue.db")
@@ -398,10 +462,165 @@ class CatalogueDatabase(object):
         """
         return self._engine_class.position_from_latlng(latitude, longitude)
 
+    def bulk_insert(self, class_object, rows):
+        """
+        Insert `rows`, a list of dictionaries with the same keys, into
+        the table mapped by `class_object` by using a single
+        statement. Used by importers to load data in batches.
+        """
+        self._engine.bulk_insert(class_object, rows)
+
+    def deferred_indexes(self):
+        """
+        Returns a context manager that suspends the update of the
+        indexes of the catalogue while a large amount of data is
+        imported, and rebuilds them at the end. e.g.::
+
+          with cat.deferred_indexes():
+              store_events(V1, 'bulletin.txt.gz', cat, bulk=True)
+        """
+        return self._engine.deferred_indexes()
+
+    def indexes_deferred(self):
+        """
+        Returns True inside :meth:`deferred_indexes`, when the spatial
+        index of the origins can not be looked up, so that the spatial
+        criteria test the position of every origin instead
+        """
+        return self._engine.indexes_deferred
+
+    def save_snapshot(self, filename):
+        """
+        Save the whole catalogue to `filename`, a compressed numpy
+        archive with an array per column, that is loaded much faster
+        than the catalogue is imported again, e.g.::
+
+          cat.save_snapshot('isc.npz')
+          ...
+          cat = CatalogueDatabase(memory=True)
+          cat.load_snapshot('isc.npz')
+
+        A snapshot can be loaded by both the spatialite and the
+        columnar engine.
+        """
+        self._engine.save_snapshot(filename)
+
+    def load_snapshot(self, filename):
+        """
+        Store into an empty catalogue the data of the snapshot
+        `filename` (see :meth:`save_snapshot`)
+        """
+        self._engine.load_snapshot(filename)
+
+    def set_profile(self, profile):
+        """
+        Switch the database connections to the settings of `profile`,
+        e.g. to import with the `bulk_load` profile and then query
+        the catalogue with the `analytics` one::
+
+          cat = CatalogueDatabase(filename='isc.db', profile='bulk_load')
+          store_events(V1, 'bulletin.txt', cat, bulk=True)
+          cat.set_profile('analytics')
+        """
+        self._engine.set_profile(profile)
+
+    def selection(self):
+        """
+        Returns the selection of all the measures of a catalogue that
+        keeps its data as columns (see
+        :mod:`eqcatalogue.datastores.columnar`), used by the criteria
+        to select measures by vectorised masks
+        """
+        return self._engine.selection()
+
+    def refresh_measure_rows(self, full=False):
+        """
+        Update the denormalised table of the measures, with a row per
+        measure holding the keys of its event and agency and the time
+        and position of its origin, read by
+        :meth:`eqcatalogue.filtering.Criteria.rows` without joins. The
+        rows of the measures stored since the last refresh are
+        appended, while a `full` refresh rebuilds the table, e.g.
+        after the data of the catalogue are modified in place. It is
+        called by :func:`eqcatalogue.importers.store_events`.
+        """
+        self._engine.refresh_measure_rows(full)
+
+    def measure_rows(self):
+        """
+        Returns the denormalised table of the measures of a
+        spatialite catalogue, as an up to date sqlalchemy table (see
+        :meth:`refresh_measure_rows`)
+        """
+        return self._engine.measure_rows
+
+    @property
+    def sharded(self):
+        """
+        True if the catalogue file is sharded by period (see the
+        `shard_by` keyword). The origins and the measures of a sharded
+        catalogue are written by bulk inserts only (see
+        :meth:`bulk_insert`).
+        """
+        return self._engine.sharded
+
+    def shard_clause(self, tables=('catalogue_origin',), bounds=(None, None)):
+        """
+        Returns the sql condition that keeps the rows of `tables`
+        joined with the measures of a sharded catalogue in the shard
+        of the measure, and skips the shards out of the `bounds` of the
+        time of the origins, or None if the catalogue is not sharded
+        (see :meth:`eqcatalogue.datastores.spatialite.Engine.shard_clause`)
+        """
+        return self._engine.shard_clause(tables, bounds)
+
+    def generation(self):
+        """
+        Returns the generation of the data of the catalogue, a number
+        that changes whenever they do: when objects are flushed by the
+        session, rows are inserted by :meth:`bulk_insert`, the
+        importers commit, or :meth:`bump_generation` is called. The
+        results computed from the catalogue are stale if the
+        generation has changed since (see
+        :class:`eqcatalogue.filtering.ResultCache`).
+        """
+        return self._engine.generation
+
+    def bump_generation(self):
+        """
+        Change the generation of the catalogue, e.g. after its data
+        have been modified by plain sql statements
+        """
+        self._engine.bump_generation()
+
+    def statement_count(self):
+        """
+        Returns the number of statements run on the database since the
+        catalogue has been opened. The difference across a stage of a
+        pipeline shows whether the stage issues a query per measure,
+        e.g. by reading a relationship not loaded by the criteria (see
+        :meth:`eqcatalogue.filtering.Criteria.eager_load`)
+        """
+        return self._engine.statement_count
+
+    def remove_session(self):
+        """
+        Close the session of the current thread. Threads that query
+        the catalogue concurrently, each one with its own session,
+        should call it when they have done, e.g.::
+
+          def worker(criteria):
+              try:
+                  return len(criteria)
+              finally:
+                  CatalogueDatabase().remove_session()
+        """
+        self._engine.remove_session()
+
     @property
     def session(self):
         """
-        Return the current CatalogueDatabase session
+        Return the CatalogueDatabase session of the current thread
         """
         return self._engine.session
 
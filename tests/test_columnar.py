@@ -0,0 +1,316 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# eqcatalogueTool is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# eqcatalogueTool is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with eqcatalogueTool. If not, see <http://www.gnu.org/licenses/>.
+
+import calendar
+import os
+import random
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from eqcatalogue import models
+from eqcatalogue import filtering
+from eqcatalogue.datastores import columnar, spatialite
+
+from tests.test_utils import in_data_dir
+from tests.test_filtering import load_fixtures
+
+COLUMNAR_ENGINE = 'eqcatalogue.datastores.columnar'
+
+
+def remove_db(filename):
+    for suffix in '', '-wal', '-shm':
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+
+class AColumnarCatalogueShould(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = in_data_dir('test_columnar.db')
+        models.CatalogueDatabase.reset_singleton()
+        cat = models.CatalogueDatabase(filename=self.filename, drop=True)
+        load_fixtures(cat.session)
+        cat.session.commit()
+        cat._engine.close()
+
+        models.CatalogueDatabase.reset_singleton()
+        self.cat = models.CatalogueDatabase(engine=COLUMNAR_ENGINE,
+                                            filename=self.filename)
+
+    def tearDown(self):
+        models.CatalogueDatabase.reset_singleton()
+        remove_db(self.filename)
+
+    def test_load_the_tables(self):
+        tables = self.cat._engine.tables
+        self.assertEqual(1, len(tables[models.EventSource]))
+        self.assertEqual(5, len(tables[models.Event]))
+        self.assertEqual(30, len(tables[models.Origin]))
+        self.assertEqual(30, len(tables[models.MagnitudeMeasure]))
+        self.assertEqual(30, len(tables[models.MeasureMetadata]))
+
+    def test_return_measures(self):
+        measures = filtering.Criteria().all()
+        self.assertEqual(30, len(measures))
+        measure = measures[0]
+        self.assertEqual('IDC', measure.agency.source_key)
+        self.assertEqual('1008566', measure.event.source_key)
+        self.assertEqual(datetime(2001, 5, 2, 3, 7, 11), measure.origin.time)
+        self.assertTrue(measure.id in
+                        [m.id for m in measure.event.measures])
+        self.assertTrue(measure.event is measures[1].event)
+        self.assertEqual(5, len(filtering.Criteria().events()))
+
+    def test_build_the_records_again_on_each_read(self):
+        measures = filtering.Criteria().all()
+        self.assertTrue(measures[0].event is measures[1].event)
+        self.assertFalse(
+            measures[0].event is filtering.Criteria().all()[0].event)
+        self.assertEqual(measures[0].event.source_key,
+                         filtering.Criteria().all()[0].event.source_key)
+
+    def test_filter_by_time(self):
+        time_lb = datetime(2001, 3, 2, 4, 11)
+        time_ub = datetime(2001, 5, 2, 22, 34)
+        self.assertEqual(30, len(filtering.Before(datetime.now())))
+        self.assertEqual(0, len(filtering.After(datetime.now())))
+        self.assertEqual(6, len(filtering.Between((time_lb, time_ub))))
+
+    def test_filter_by_scale_agency_and_magnitude(self):
+        self.assertEqual(20, len(filtering.WithMagnitudeScales(('MS', 'mb'))))
+        self.assertEqual(6, len(filtering.WithAgencies(['LDG', 'NEIC'])))
+        self.assertEqual(0, len(filtering.WithAgencies(['Blabla'])))
+
+        result = filtering.WithAgencies(['BJI']) & \
+            filtering.WithMagnitudeGreater(5)
+        self.assertEqual(2, len(result))
+        for measure in result:
+            self.assertTrue(result.predicate(measure))
+
+        either = (filtering.WithAgencies(['LDG', 'NEIC']) |
+                  filtering.WithAgencies(['BJI']))
+        self.assertEqual(11, len(either))
+        self.assertTrue(either.predicate(random.choice(either)))
+        self.assertEqual(19, len(~either))
+
+    def test_filter_by_position(self):
+        self.assertEqual(16, len(filtering.WithinPolygon(
+                    'POLYGON((85 35, 92 35, 92 25, 85 25, 85 35))')))
+        self.assertEqual(13, len(filtering.WithinPolygon(
+                    'POLYGON((92 15, 95 15, 95 10, 92 10, 92 15))')))
+
+        point = 'POINT(88.20 33.10)'
+        for distance, expected in ((700000, 16), (250000, 3),
+                                   (228000, 0), (2400000, 30)):
+            self.assertEqual(expected, len(filtering.WithinDistanceFromPoint(
+                        (point, distance))))
+
+    def test_check_a_measure_by_position(self):
+        polygon = filtering.WithinPolygon(
+            'POLYGON((85 35, 92 35, 92 25, 85 25, 85 35))')
+        inside = polygon.all()[0]
+        outside = (~polygon).all()[0]
+        self.assertTrue(polygon.predicate(inside))
+        self.assertFalse(polygon.predicate(outside))
+        self.assertTrue(inside in polygon)
+        self.assertTrue((~polygon).predicate(outside))
+        self.assertTrue((polygon & filtering.Criteria()).predicate(inside))
+
+        distance = filtering.WithinDistanceFromPoint(
+            ('POINT(88.20 33.10)', 250000))
+        self.assertTrue(distance.predicate(distance.all()[0]))
+        self.assertFalse(distance.predicate(outside))
+
+    def test_stream_and_slice_the_measures(self):
+        ids = [measure.id for measure in filtering.Criteria().all()]
+        self.assertEqual(ids, [measure.id for measure in
+                               filtering.Criteria().stream(batch_size=7)])
+        self.assertEqual(ids[2:5], [measure.id for measure in
+                                    filtering.Criteria()[2:5]])
+        self.assertEqual(ids[-1], filtering.Criteria()[-1].id)
+
+    def test_group_measures(self):
+        groups = filtering.Criteria().group_measures()
+        self.assertEqual(5, len(groups))
+        self.assertEqual(30, sum(len(group) for group in groups.values()))
+
+    def test_return_the_rows_of_the_measures(self):
+        rows = filtering.WithAgencies(['BJI']).rows(
+            'agency_key', 'event_key', 'eventsource', 'epoch')
+        self.assertEqual(5, len(rows))
+        measure = filtering.WithAgencies(['BJI']).all()[0]
+        self.assertEqual(('BJI', measure.event.source_key,
+                          measure.event.eventsource.name,
+                          calendar.timegm(measure.origin.time.timetuple())),
+                         rows[0])
+
+    def test_return_the_arrays_of_the_measures(self):
+        arrays = filtering.WithAgencies(['BJI']).to_arrays(
+            'agency_key', 'event_key', 'standard_error', 'epoch')
+        rows = filtering.WithAgencies(['BJI']).rows(
+            'agency_key', 'event_key', 'standard_error', 'epoch')
+        self.assertEqual([u'BJI'], arrays['agency_key.values'].tolist())
+        self.assertEqual([0] * 5, arrays['agency_key'].tolist())
+        self.assertEqual([row[1] for row in rows], arrays['event_key.values'][
+                arrays['event_key']].tolist())
+        self.assertEqual([row[3] for row in rows], arrays['epoch'].tolist())
+        self.assertEqual(np.float64, arrays['standard_error'].dtype)
+
+    def test_bulk_insert(self):
+        self.cat.recreate()
+        self.cat.bulk_insert(models.Origin, [
+                {'id': 2, 'source_key': 'b', 'eventsource_id': 1,
+                 'time': datetime(2001, 1, 2), 'latitude': 10.,
+                 'longitude': 20.},
+                {'id': 1, 'source_key': 'a', 'eventsource_id': 1,
+                 'time': datetime(2001, 1, 1), 'latitude': 30.,
+                 'longitude': 40., 'depth': 5.}])
+
+        origins = self.cat._engine.tables[models.Origin]
+        self.assertEqual([1, 2], origins['id'].tolist())
+        self.assertEqual([30., 10.], origins['position_x'].tolist())
+        self.assertTrue(np.isnan(origins['depth'][1]))
+        self.assertEqual(0, len(filtering.Criteria()))
+
+    def test_join_the_batches_when_read(self):
+        table = columnar.Table(columnar.COLUMNS[models.Agency])
+        for agency_id in (3, 1, 2):
+            table.append([{'id': agency_id, 'source_key': str(agency_id),
+                           'eventsource_id': 1}])
+        self.assertEqual(3, len(table._appended))
+        self.assertEqual(3, len(table))
+        self.assertEqual([1, 2, 3], table['id'].tolist())
+        self.assertEqual(['1', '2', '3'], table['source_key'].tolist())
+        self.assertEqual([], table._appended)
+
+    def test_give_no_epoch_to_an_origin_without_time(self):
+        self.cat.recreate()
+        self.cat.bulk_insert(models.EventSource, [{'id': 1, 'name': 's'}])
+        self.cat.bulk_insert(models.Agency, [
+                {'id': 1, 'source_key': 'a', 'eventsource_id': 1}])
+        self.cat.bulk_insert(models.Event, [
+                {'id': 1, 'source_key': 'e', 'eventsource_id': 1}])
+        self.cat.bulk_insert(models.Origin, [
+                {'id': 1, 'source_key': 'a', 'eventsource_id': 1,
+                 'time': datetime(1970, 1, 2), 'latitude': 10.,
+                 'longitude': 20.},
+                {'id': 2, 'source_key': 'b', 'eventsource_id': 1,
+                 'latitude': 30., 'longitude': 40.}])
+        self.cat.bulk_insert(models.MagnitudeMeasure, [
+                {'id': 1, 'event_id': 1, 'agency_id': 1, 'origin_id': 1,
+                 'scale': 'mb', 'value': 5.},
+                {'id': 2, 'event_id': 1, 'agency_id': 1, 'origin_id': 2,
+                 'scale': 'mb', 'value': 6.}])
+
+        epochs = self.cat._engine.measure_columns()['epoch']
+        self.assertEqual(86400., epochs[0])
+        self.assertTrue(np.isnan(epochs[1]))
+
+    def test_return_the_measures_of_an_event(self):
+        engine = self.cat._engine
+        measure_ids = engine.tables[models.MagnitudeMeasure]['id']
+        event_ids = engine.tables[models.MagnitudeMeasure]['event_id']
+        for event_id in set(event_ids.tolist()):
+            self.assertEqual(
+                measure_ids[event_ids == event_id].tolist(),
+                [measure.id for measure in engine.measures_of_event(event_id)])
+        self.assertEqual([], engine.measures_of_event(event_ids.max() + 1))
+
+    def test_reject_the_rows_of_absent_ids(self):
+        table = columnar.Table(columnar.COLUMNS[models.Agency])
+        self.assertRaises(KeyError, table.rows_of, 1)
+        table.append([{'id': agency_id, 'source_key': str(agency_id),
+                       'eventsource_id': 1} for agency_id in (1, 3)])
+        self.assertEqual([0, 1], table.rows_of(np.array([1, 3])).tolist())
+        self.assertRaises(KeyError, table.rows_of, np.array([1, 2]))
+        self.assertRaises(KeyError, table.rows_of, 4)
+
+
+class ColumnarGeometryShould(unittest.TestCase):
+
+    def test_find_points_in_polygon(self):
+        xs = np.array([0.5, 1.5, 0.5, -0.1])
+        ys = np.array([0.5, 0.5, 0.9, 0.5])
+        self.assertEqual([True, False, True, False],
+                         columnar.within_polygon(
+                xs, ys, 'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))').tolist())
+
+    def test_compute_distances(self):
+        distances = columnar.distances(np.array([0., 1.]), np.array([0., 0.]),
+                                       'POINT(0 0)')
+        self.assertEqual(0, distances[0])
+        self.assertAlmostEqual(111195, distances[1], places=0)
+
+
+class ACatalogueSnapshotShould(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = in_data_dir('test_snapshot.db')
+        self.snapshot = in_data_dir('test_snapshot.npz')
+        models.CatalogueDatabase.reset_singleton()
+        cat = models.CatalogueDatabase(filename=self.filename, drop=True)
+        load_fixtures(cat.session)
+        cat.session.commit()
+        cat.save_snapshot(self.snapshot)
+        cat._engine.close()
+        models.CatalogueDatabase.reset_singleton()
+
+    def tearDown(self):
+        models.CatalogueDatabase.reset_singleton()
+        remove_db(self.filename)
+        os.remove(self.snapshot)
+
+    def _check_catalogue(self):
+        self.assertEqual(30, len(filtering.Criteria()))
+        self.assertEqual(5, len(filtering.Criteria().events()))
+        self.assertEqual(20, len(filtering.WithMagnitudeScales(('MS', 'mb'))))
+        self.assertEqual(6, len(filtering.Between((
+                        datetime(2001, 3, 2, 4, 11),
+                        datetime(2001, 5, 2, 22, 34)))))
+        self.assertEqual(16, len(filtering.WithinPolygon(
+                    'POLYGON((85 35, 92 35, 92 25, 85 25, 85 35))')))
+        measure = filtering.Criteria().all()[0]
+        self.assertEqual('IDC', measure.agency.source_key)
+        self.assertEqual(datetime(2001, 5, 2, 3, 7, 11), measure.origin.time)
+
+    def test_load_into_a_columnar_catalogue(self):
+        cat = models.CatalogueDatabase(engine=COLUMNAR_ENGINE,
+                                       snapshot=self.snapshot)
+        self._check_catalogue()
+        self.assertEqual(
+            [None], cat._engine.tables[models.Event]['name'].tolist()[:1])
+
+    def test_load_into_a_spatialite_catalogue(self):
+        cat = models.CatalogueDatabase(memory=True, drop=True)
+        cat.load_snapshot(self.snapshot)
+        self._check_catalogue()
+        self.assertEqual(30, cat.session.query(models.MeasureMetadata).count())
+
+    def test_load_by_batches_into_a_spatialite_catalogue(self):
+        batch_size = spatialite.SNAPSHOT_BATCH_SIZE
+        spatialite.SNAPSHOT_BATCH_SIZE = 7
+        try:
+            cat = models.CatalogueDatabase(memory=True, drop=True)
+            cat.load_snapshot(self.snapshot)
+        finally:
+            spatialite.SNAPSHOT_BATCH_SIZE = batch_size
+        self._check_catalogue()
+        self.assertEqual(30, cat.session.query(models.MeasureMetadata).count())
+
+    def test_reject_an_unknown_version(self):
+        np.savez(self.snapshot, version=np.array(2))
+        self.assertRaises(ValueError, columnar.load_snapshot, self.snapshot)
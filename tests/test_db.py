@@ -13,13 +13,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with eqcatalogueTool. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import threading
+import warnings
 from datetime import datetime
 import unittest
+import mock
+from sqlalchemy import orm
 from eqcatalogue import models as catalogue
+from eqcatalogue import filtering
+from eqcatalogue.datastores import spatialite
+from eqcatalogue.importers import V1, store_events
 import geoalchemy
+from sqlalchemy.exc import IntegrityError
 from tests.test_utils import in_data_dir
 
 
+def remove_db(filename):
+    """
+    Remove a database file together with its write-ahead log
+    """
+    for suffix in '', '-wal', '-shm':
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+
 class ShouldCreateAlchemyTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -33,6 +51,7 @@ class ShouldCreateAlchemyTestCase(unittest.TestCase):
             drop=True,
             filename=in_data_dir("test_drop.db"))
         catalogue.CatalogueDatabase.reset_singleton()
+        remove_db(in_data_dir("test_drop.db"))
         self.catalogue = catalogue.CatalogueDatabase(memory=True, drop=True)
 
     def test_eventsource(self):
@@ -100,6 +119,54 @@ class ShouldCreateAlchemyTestCase(unittest.TestCase):
         self.assertEqual(
             self.session.query(catalogue.MagnitudeMeasure).count(), 1)
 
+    def test_origin_coordinates(self):
+        eventsource = catalogue.EventSource(name="test4")
+        origin = catalogue.Origin(source_key="test", eventsource=eventsource,
+                                 position=geoalchemy.WKTSpatialElement(
+                                     'POINT(-81.40 38.08)'),
+                                 time=datetime(1970, 1, 2),
+                                 depth=3)
+        self.session.add(origin)
+        self.session.flush()
+        self.assertEqual((-81.40, 38.08, 86400.),
+                         (origin.latitude, origin.longitude, origin.epoch))
+
+        origin.time = datetime(1970, 1, 1, 0, 1)
+        self.session.flush()
+        self.assertEqual(60., origin.epoch)
+        self.assertEqual(1, self.session.query(catalogue.Origin).filter(
+                catalogue.Origin.latitude < -80).count())
+
+    def test_origin_epoch_microseconds(self):
+        time = datetime(2001, 5, 2, 3, 7, 11, 123457)
+        origin = catalogue.Origin(source_key="test", eventsource=
+                                  catalogue.EventSource(name="test4"),
+                                  position=geoalchemy.WKTSpatialElement(
+                                      'POINT(-81.40 38.08)'),
+                                  time=time, depth=3)
+        self.session.add(origin)
+        self.session.flush()
+        self.assertEqual(spatialite._epoch(time), origin.epoch)
+
+        self.catalogue.bulk_insert(catalogue.Origin, [
+                {'id': origin.id + 1, 'source_key': 'bulk',
+                 'eventsource_id': origin.eventsource.id, 'time': time,
+                 'latitude': 10., 'longitude': 20.}])
+        self.assertEqual([(origin.epoch,)], self.session.execute(
+                "SELECT epoch FROM catalogue_origin WHERE source_key = 'bulk'"
+                ).fetchall())
+
+    def test_bulk_insert_origin_coordinates(self):
+        self.catalogue.bulk_insert(catalogue.EventSource,
+                                   [{'id': 1, 'name': 'ISC'}])
+        self.catalogue.bulk_insert(catalogue.Origin, [
+                {'id': 1, 'source_key': '1', 'eventsource_id': 1,
+                 'time': datetime(1970, 1, 1, 0, 0, 1, 500000),
+                 'latitude': 10., 'longitude': 20.}])
+        self.assertEqual([(10., 20., 1.5, 10., 20.)], self.session.execute(
+                "SELECT latitude, longitude, epoch, X(position), Y(position) "
+                "FROM catalogue_origin").fetchall())
+
     def test_get_or_add(self):
         event_source1, created = self.catalogue.get_or_create(
             catalogue.EventSource, {'name': "test_5"})
@@ -109,5 +176,357 @@ class ShouldCreateAlchemyTestCase(unittest.TestCase):
         self.assertFalse(created)
         self.assertEqual(event_source1, event_source2)
 
+    def test_generation(self):
+        generation = self.catalogue.generation()
+        store_events(V1, in_data_dir('isc-query-small.html'),
+                     self.catalogue, bulk=True)
+        self.assertTrue(self.catalogue.generation() > generation)
+
+        generation = self.catalogue.generation()
+        self.session.add(catalogue.EventSource(name="test8"))
+        self.session.flush()
+        self.assertTrue(self.catalogue.generation() > generation)
+
+    def test_deferred_indexes(self):
+        with self.catalogue.deferred_indexes():
+            self.assertFalse(self.session.execute(
+                    "SELECT name FROM sqlite_master "
+                    "WHERE name = 'idx_catalogue_origin_position'").fetchall())
+            store_events(V1, in_data_dir('isc-query-small.html'),
+                         self.catalogue, bulk=True)
+
+        self.assertEqual(128, self.session.execute(
+                "SELECT count(*) FROM idx_catalogue_origin_position").scalar())
+        self.assertTrue(self.session.execute(
+                "SELECT count(*) FROM sqlite_stat1").scalar())
+
+    def test_spatial_criteria_inside_deferred_indexes(self):
+        polygon = filtering.WithinPolygon(
+            'POLYGON((-180 -180, 180 -180, 180 180, -180 180, -180 -180))')
+        store_events(V1, in_data_dir('isc-query-small.html'),
+                     self.catalogue, bulk=True)
+        with self.catalogue.deferred_indexes():
+            self.assertEqual(334, len(polygon))
+            self.assertEqual(334, len(filtering.WithinDistanceFromPoint(
+                        ('POINT(0 0)', 40000000))))
+            self.assertFalse(filtering.SPATIAL_INDEX in str(polygon.filter()))
+        self.assertTrue(filtering.SPATIAL_INDEX in str(polygon.filter()))
+        self.assertEqual(334, len(polygon))
+
+    def test_deferred_indexes_on_failure(self):
+        def store():
+            with self.catalogue.deferred_indexes():
+                raise ValueError()
+
+        self.assertRaises(ValueError, store)
+        self.assertEqual(0, self.session.execute(
+                "SELECT count(*) FROM idx_catalogue_origin_position").scalar())
+
+    def test_unique_source_keys(self):
+        eventsource = catalogue.EventSource(name="test6")
+        self.session.add(eventsource)
+        self.session.add(catalogue.Event(source_key="test",
+                                         eventsource=eventsource))
+        self.session.add(catalogue.Event(source_key="test",
+                                         eventsource=eventsource))
+        self.assertRaises(IntegrityError, self.session.flush)
+        self.session.rollback()
+
+    def test_engines_do_not_bind_the_shared_tables(self):
+        spatialite.Engine(memory=True).close()
+        self.assertTrue(spatialite.Engine._metadata.bind is None)
+        # the spatial functions are compiled for the session dialect
+        self.assertEqual(0, len(filtering.WithinPolygon(
+                    'POLYGON((0 0, 1 0, 1 1, 0 0))')))
+
     def tearDown(self):
         self.session.commit()
+
+
+class ACatalogueFileShould(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = in_data_dir("test_catalogue_file.db")
+        catalogue.CatalogueDatabase.reset_singleton()
+
+    def tearDown(self):
+        catalogue.CatalogueDatabase.reset_singleton()
+        remove_db(self.filename)
+
+    def test_missing_spatial_index_is_created(self):
+        cat = catalogue.CatalogueDatabase(drop=True, filename=self.filename)
+        cat.session.execute("SELECT DisableSpatialIndex("
+                            "'catalogue_origin', 'position')")
+        cat.session.execute("DROP TABLE idx_catalogue_origin_position")
+        cat.session.commit()
+
+        catalogue.CatalogueDatabase.reset_singleton()
+        cat = catalogue.CatalogueDatabase(filename=self.filename)
+        self.assertEqual(0, cat.session.execute(
+                "SELECT count(*) FROM idx_catalogue_origin_position").scalar())
+
+    def test_migrate_indexes(self):
+        cat = catalogue.CatalogueDatabase(drop=True, filename=self.filename)
+        cat.session.execute("DROP INDEX ix_catalogue_origin_time")
+        cat.session.execute("PRAGMA user_version = 0")
+        cat.session.commit()
+
+        catalogue.CatalogueDatabase.reset_singleton()
+        cat = catalogue.CatalogueDatabase(filename=self.filename)
+        self.assertTrue(cat.session.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE name = 'ix_catalogue_origin_time'").fetchall())
+        self.assertEqual(spatialite.SCHEMA_VERSION, cat.session.execute(
+                "PRAGMA user_version").scalar())
+
+    def test_migrate_catalogue_with_duplicates(self):
+        cat = catalogue.CatalogueDatabase(drop=True, filename=self.filename)
+        cat.session.execute("DROP INDEX ix_catalogue_origin_source_key")
+        cat.session.execute("PRAGMA user_version = 0")
+        eventsource = catalogue.EventSource(name="test8")
+        for _ in range(2):
+            cat.session.add(catalogue.Origin(
+                    source_key="test", eventsource=eventsource,
+                    position=geoalchemy.WKTSpatialElement('POINT(1 2)'),
+                    time=datetime(1970, 1, 2), depth=3))
+        cat.session.commit()
+
+        index = ("SELECT count(*) FROM sqlite_master "
+                 "WHERE name = 'ix_catalogue_origin_source_key'")
+        catalogue.CatalogueDatabase.reset_singleton()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            cat = catalogue.CatalogueDatabase(filename=self.filename)
+        self.assertEqual(1, len(caught))
+        self.assertTrue('catalogue_origin' in str(caught[0].message))
+        self.assertEqual(0, cat.session.execute(index).scalar())
+
+        cat.session.execute("DELETE FROM catalogue_origin WHERE id = "
+                            "(SELECT max(id) FROM catalogue_origin)")
+        cat.session.commit()
+        catalogue.CatalogueDatabase.reset_singleton()
+        cat = catalogue.CatalogueDatabase(filename=self.filename)
+        self.assertEqual(1, cat.session.execute(index).scalar())
+
+    def test_migrate_origin_coordinates(self):
+        cat = catalogue.CatalogueDatabase(drop=True, filename=self.filename)
+        store_events(V1, in_data_dir('isc-query-small.html'), cat)
+        cat.session.execute("UPDATE catalogue_origin SET latitude = NULL, "
+                            "longitude = NULL, epoch = NULL")
+        cat.session.execute("PRAGMA user_version = 2")
+        cat.session.commit()
+
+        catalogue.CatalogueDatabase.reset_singleton()
+        cat = catalogue.CatalogueDatabase(filename=self.filename)
+        self.assertEqual(0, cat.session.execute(
+                "SELECT count(*) FROM catalogue_origin "
+                "WHERE latitude != X(position) OR longitude != Y(position) "
+                "OR epoch IS NULL").scalar())
+        self.assertEqual(spatialite.SCHEMA_VERSION, cat.session.execute(
+                "PRAGMA user_version").scalar())
+
+    def test_profiles(self):
+        cat = catalogue.CatalogueDatabase(drop=True, filename=self.filename,
+                                          profile='bulk_load')
+        self.assertEqual('wal', cat.session.execute(
+                "PRAGMA journal_mode").scalar())
+        self.assertEqual(0, cat.session.execute(
+                "PRAGMA synchronous").scalar())
+
+        cat.set_profile('analytics')
+        self.assertEqual(1, cat.session.execute(
+                "PRAGMA synchronous").scalar())
+        self.assertRaises(ValueError, cat.set_profile, 'fast')
+
+        # the connections used by other threads get the profile too
+        cat.set_profile('safe')
+        results = {}
+
+        def read_pragmas():
+            try:
+                results['pragmas'] = tuple(
+                    cat.session.execute("PRAGMA %s" % pragma).scalar()
+                    for pragma in ('journal_mode', 'synchronous'))
+            finally:
+                cat.remove_session()
+        thread = threading.Thread(target=read_pragmas)
+        thread.start()
+        thread.join()
+        self.assertEqual(('delete', 2), results['pragmas'])
+
+    def test_concurrent_sessions(self):
+        cat = catalogue.CatalogueDatabase(drop=True, filename=self.filename,
+                                          pool_size=2)
+        cat.session.add(catalogue.EventSource(name="test7"))
+        cat.session.commit()
+
+        results = {}
+
+        def count(name):
+            try:
+                results[name] = (cat.session(), cat.session.query(
+                        catalogue.EventSource).count())
+            finally:
+                cat.remove_session()
+
+        threads = [threading.Thread(target=count, args=(name,))
+                   for name in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, results['a'][1])
+        self.assertEqual(1, results['b'][1])
+        self.assertFalse(results['a'][0] is results['b'][0])
+        self.assertFalse(results['a'][0] is cat.session())
+
+    def test_reopen_without_creating_the_schema(self):
+        catalogue.CatalogueDatabase(drop=True, filename=self.filename)
+        mapper = orm.class_mapper(catalogue.Origin)
+
+        catalogue.CatalogueDatabase.reset_singleton()
+        with mock.patch.object(spatialite.Engine, '_migrate') as migrate:
+            cat = catalogue.CatalogueDatabase(filename=self.filename)
+        self.assertFalse(migrate.called)
+        self.assertTrue(mapper is orm.class_mapper(catalogue.Origin))
+        self.assertEqual(0, cat.session.query(catalogue.Origin).count())
+
+
+class AShardedCatalogueShould(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = in_data_dir("test_shards.db")
+        catalogue.CatalogueDatabase.reset_singleton()
+        self.cat = catalogue.CatalogueDatabase(
+            filename=self.filename, drop=True, shard_by='decade')
+        self.cat.bulk_insert(catalogue.EventSource, [{'id': 1, 'name': 'ISC'}])
+        self.cat.bulk_insert(catalogue.Agency, [
+                {'id': 1, 'source_key': 'ISC', 'eventsource_id': 1}])
+        self.cat.bulk_insert(catalogue.Event, [
+                {'id': i, 'source_key': str(i), 'eventsource_id': 1}
+                for i in (1, 2, 3)])
+        self.cat.bulk_insert(catalogue.Origin, [
+                {'id': i, 'source_key': str(i), 'eventsource_id': 1,
+                 'time': datetime(year, 6, 1), 'latitude': 10. * i,
+                 'longitude': 10. * i}
+                for i, year in ((1, 1995), (2, 2003), (3, 2011))])
+        self.cat.bulk_insert(catalogue.MagnitudeMeasure, [
+                {'id': i, 'event_id': i, 'origin_id': i, 'agency_id': 1,
+                 'scale': 'mb', 'value': 4. + i, 'standard_error': None}
+                for i in (3, 2, 1)])
+        self.cat.session.commit()
+
+    def tearDown(self):
+        catalogue.CatalogueDatabase.reset_singleton()
+        for year in (1980, 1990, 2000, 2010, ''):
+            remove_db(self.filename.replace('.db', '.%s.db' % year))
+        remove_db(self.filename)
+
+    def _count(self, sql):
+        return self.cat.session.execute(sql).scalar()
+
+    def test_store_the_origins_by_period(self):
+        for year in (1990, 2000, 2010):
+            self.assertTrue(os.path.exists(
+                    self.filename.replace('.db', '.%d.db' % year)))
+            self.assertEqual(1, self._count(
+                    "SELECT count(*) FROM shard_%d.catalogue_origin" % year))
+            self.assertEqual(1, self._count(
+                    "SELECT count(*) FROM shard_%d.catalogue_magnitudemeasure"
+                    % year))
+        self.assertEqual(0, self._count(
+                "SELECT count(*) FROM main.catalogue_origin"))
+
+    def test_query_all_the_shards(self):
+        self.assertEqual(3, len(filtering.Criteria()))
+        self.assertEqual(3, len(filtering.Criteria().events()))
+        self.assertEqual(1, len(filtering.Before(datetime(2000, 1, 1))))
+        self.assertEqual(2, len(filtering.After(datetime(2000, 1, 1))))
+        self.assertEqual(1, len(filtering.Between(
+                    (datetime(2001, 1, 1), datetime(2005, 1, 1)))))
+        self.assertEqual(1, len(filtering.WithinPolygon(
+                    'POLYGON((15 15, 25 15, 25 25, 15 25, 15 15))')))
+        self.assertEqual([(3, 7.)], filtering.After(
+                datetime(2010, 1, 1)).rows('id', 'value'))
+        self.assertEqual(2, len(filtering.Before(datetime(2000, 1, 1)) |
+                                filtering.After(datetime(2010, 1, 1))))
+        self.assertEqual(2, len(~filtering.Between(
+                    (datetime(2001, 1, 1), datetime(2005, 1, 1)))))
+
+    def test_look_up_only_the_shards_of_the_time_bounds(self):
+        lower, upper = datetime(2001, 1, 1), datetime(2005, 1, 1)
+        criteria = filtering.Between((lower, upper)) & filtering.C(
+            scale='mb')
+        self.assertEqual((lower, upper), criteria.time_bounds())
+        self.assertEqual((None, None), (~criteria).time_bounds())
+        self.assertEqual((None, upper), (
+                filtering.Before(upper) | filtering.Before(lower)
+                ).time_bounds())
+        self.assertEqual((None, None), (
+                filtering.Before(upper) | filtering.After(lower)
+                ).time_bounds())
+
+        query = str(criteria.filter())
+        self.assertTrue("catalogue_origin.shard_start = "
+                        "catalogue_magnitudemeasure.shard_start" in query)
+        self.assertTrue("catalogue_magnitudemeasure.shard_end >= 2001" in
+                        query)
+        self.assertTrue("catalogue_magnitudemeasure.shard_start <= 2005" in
+                        query)
+        self.assertEqual([(2, 6.)], criteria.rows('id', 'value'))
+
+    def test_reject_the_orm_writes(self):
+        eventsource = self.cat.session.query(catalogue.EventSource).one()
+        self.cat.session.add(catalogue.Origin(
+                source_key="orm", eventsource=eventsource,
+                position=geoalchemy.WKTSpatialElement('POINT(10 10)'),
+                time=datetime(2003, 1, 1)))
+        self.assertRaises(ValueError, self.cat.session.flush)
+        self.cat.session.rollback()
+
+        with open(in_data_dir('isc-query-small.html')) as stream:
+            self.assertRaises(ValueError, V1(stream, self.cat).store)
+        self.assertEqual(3, len(filtering.Criteria()))
+
+    def test_defer_the_indexes_of_the_shards(self):
+        def indexes(schema):
+            return self._count(
+                "SELECT count(*) FROM %s.sqlite_master WHERE type = 'index' "
+                "AND name LIKE 'ix_%%'" % schema)
+
+        existing = indexes('shard_1990')
+        self.assertTrue(existing > 0)
+        with self.cat.deferred_indexes():
+            self.assertEqual(0, indexes('main'))
+            self.assertEqual(0, indexes('shard_1990'))
+            self.cat.bulk_insert(catalogue.Origin, [
+                    {'id': 4, 'source_key': '4', 'eventsource_id': 1,
+                     'time': datetime(1985, 6, 1), 'latitude': 40.,
+                     'longitude': 40.}])
+            self.assertEqual(0, indexes('shard_1980'))
+        for schema in ('main', 'shard_1980', 'shard_1990', 'shard_2010'):
+            self.assertEqual(existing, indexes(schema))
+        self.assertEqual(1, self._count(
+                "SELECT count(*) FROM "
+                "shard_1980.idx_catalogue_origin_position"))
+        self.assertEqual(1, len(filtering.WithinPolygon(
+                    'POLYGON((15 15, 25 15, 25 25, 15 25, 15 15))')))
+
+    def test_attach_the_shards_when_reopened(self):
+        catalogue.CatalogueDatabase.reset_singleton()
+        self.cat._engine.close()
+        self.cat = catalogue.CatalogueDatabase(
+            filename=self.filename, shard_by='decade')
+        self.assertEqual(3, len(filtering.Criteria()))
+
+        self.cat.recreate()
+        self.assertFalse(os.path.exists(
+                self.filename.replace('.db', '.1990.db')))
+        self.assertEqual(0, len(filtering.Criteria()))
+
+    def test_reject_unknown_periods(self):
+        self.assertRaises(ValueError, spatialite.Engine, filename='a.db',
+                          shard_by='century')
+        self.assertRaises(ValueError, spatialite.Engine, memory=True,
+                          shard_by='year')
@@ -14,11 +14,12 @@
 # along with eqcatalogueTool. If not, see <http://www.gnu.org/licenses/>.
 
 
+import calendar
 import unittest
-import mock
 import random
 from datetime import datetime
 from geoalchemy import WKTSpatialElement
+import numpy as np
 
 from tests.test_utils import in_data_dir
 
@@ -64,7 +65,7 @@ def load_fixtures(session):
         origin = models.Origin(
             time=entry_time, position=WKTSpatialElement(entry_pos),
             depth=entry['depth'], eventsource=event_source,
-            source_key=entry['eventKey'])
+            source_key='%s_%s' % (entry['eventKey'], entry['solutionDesc']))
 
         mag_measure = models.MagnitudeMeasure(agency=agency, event=event,
                 origin=origin, scale=entry['mag_type'],
@@ -79,6 +80,21 @@ def load_fixtures(session):
         session.add(measure_meta)
 
 
+class CustomCriteria(filtering.Criteria):
+    pass
+
+
+class FilterOnlyCriteria(filtering.Criteria):
+    """
+    A criteria that overrides only filter, as before the criteria
+    were compiled into a single query
+    """
+
+    def filter(self, queryset=None):
+        queryset = queryset or self.default_queryset
+        return queryset.filter(models.MagnitudeMeasure.value > 5)
+
+
 class ACriteriaShould(unittest.TestCase):
 
     def setUp(self):
@@ -103,6 +119,47 @@ class ACriteriaShould(unittest.TestCase):
         # behavior of this feature is tested in other test modules
         self.assertTrue(filtering.Criteria().group_measures())
 
+    def test_return_the_rows_of_the_measures(self):
+        criteria = (filtering.WithAgencies(['LDG', 'NEIC']) |
+                    filtering.WithAgencies(['BJI']))
+        rows = criteria.rows('id', 'agency_key', 'event_key', 'epoch')
+        self.assertEqual(11, len(rows))
+        for (measure_id, agency, event, epoch), measure in zip(
+            rows, sorted(criteria, key=lambda m: m.id)):
+            self.assertEqual(measure.id, measure_id)
+            self.assertEqual(measure.agency.source_key, agency)
+            self.assertEqual(measure.event.source_key, event)
+            self.assertAlmostEqual(
+                calendar.timegm(measure.origin.time.utctimetuple()), epoch, 3)
+        self.assertRaises(ValueError, criteria.rows, 'position')
+
+    def test_return_the_arrays_of_the_measures(self):
+        criteria = filtering.WithMagnitudeScales(('MS', 'mb'))
+        arrays = criteria.to_arrays('id', 'agency_key', 'value', 'epoch')
+        rows = criteria.rows('id', 'agency_key', 'value', 'epoch')
+        self.assertEqual(20, len(arrays['id']))
+        self.assertEqual(np.float64, arrays['epoch'].dtype)
+        self.assertEqual(rows, zip(
+                arrays['id'].tolist(),
+                arrays['agency_key.values'][arrays['agency_key']].tolist(),
+                arrays['value'].tolist(), arrays['epoch'].tolist()))
+        self.assertEqual(0, len(filtering.WithMagnitudeScales([]).to_arrays(
+                    'scale')['scale']))
+        self.assertRaises(ValueError, criteria.to_arrays, 'position')
+
+    def test_refresh_the_rows_of_new_measures(self):
+        self.assertEqual(30, len(filtering.Criteria().rows('id')))
+        measure = filtering.Criteria().all()[0]
+        self.session.add(models.MagnitudeMeasure(
+                agency=measure.agency, event=measure.event,
+                origin=measure.origin, scale='ML', value=4.))
+        self.assertEqual(31, len(filtering.Criteria().rows('id')))
+
+        measure.value = 9.
+        self.cat_db.refresh_measure_rows(full=True)
+        self.assertEqual([(9.,)], filtering.WithMagnitudeGreater(8.5).rows(
+                'value'))
+
     def test_allows_filtering_measures_on_time_criteria(self):
         time = datetime.now()
         before_time = filtering.Before(time)
@@ -165,14 +222,82 @@ class ACriteriaShould(unittest.TestCase):
         # with a sum for measures of 13.
         self.assertEqual(13, len(filtering.WithinPolygon(snd_polygon)))
 
+    def test_spatial_criteria_use_the_spatial_index(self):
+        polygon = filtering.WithinPolygon(
+            'POLYGON((85 35, 92 35, 92 25, 85 25, 85 35))')
+        distance = filtering.WithinDistanceFromPoint(
+            ('POINT(88.20 33.10)', 700000))
+        for criteria in polygon, distance:
+            self.assertTrue(filtering.SPATIAL_INDEX in str(criteria.filter()))
+
+        # the origins missing in the index are never looked up
+        self.session.flush()
+        self.session.execute("DELETE FROM %s" % filtering.SPATIAL_INDEX)
+        self.assertEqual(0, len(polygon))
+        self.assertEqual(0, len(distance))
+
+    def test_distance_bounding_box_around_a_pole(self):
+        criteria = filtering.WithinDistanceFromPoint(
+            ('POINT(10 85)', 1000000))
+        self.assertFalse('xmin' in criteria._bounding_box())
+        self.assertTrue('ymin' in criteria._bounding_box())
+
     def test_indexing(self):
         measures = filtering.C()
-        measures.all = mock.Mock(return_value=[1, 2, 3])
+        ids = sorted(measure.id for measure in measures.all())
 
-        self.assertEqual(1, measures[0])
-        self.assertEqual(3, measures[2])
+        self.assertEqual(ids[0], measures[0].id)
+        self.assertEqual(ids[2], measures[2].id)
+        self.assertEqual(ids[2:5], [measure.id for measure in measures[2:5]])
         self.assertRaises(IndexError, measures.__getitem__, len(measures))
 
+    def test_load_the_relationships_of_the_measures(self):
+        self.session.commit()
+        count = self.cat_db.statement_count()
+        for measure in filtering.Criteria():
+            self.assertTrue(measure.origin.time and
+                            measure.agency.source_key and
+                            measure.event.source_key)
+        self.assertEqual(1, self.cat_db.statement_count() - count)
+
+        criteria = filtering.C(scale='mb')
+        count = self.cat_db.statement_count()
+        errors = [m.standard_error for measure in criteria
+                  for m in measure.event.measures]
+        self.assertTrue(self.cat_db.statement_count() - count > 2)
+
+        self.session.expire_all()
+        count = self.cat_db.statement_count()
+        self.assertEqual(errors, [
+                m.standard_error for measure in criteria.eager_load(
+                    'origin', 'agency', 'event.measures')
+                for m in measure.event.measures])
+        self.assertEqual(2, self.cat_db.statement_count() - count)
+
+        # the relationships set on a member apply to the combination
+        combined = (filtering.C(scale='mb').eager_load(
+                'origin', 'agency', 'event.measures') &
+                    filtering.WithMagnitudeGreater(0))
+        self.assertEqual(('origin', 'agency', 'event.measures'),
+                         combined._eager)
+        self.assertEqual(combined._eager, (~combined)._eager)
+        self.assertEqual(filtering.EAGER_RELATIONSHIPS, (
+                filtering.C(scale='mb') | filtering.C(scale='MS'))._eager)
+
+        self.session.expire_all()
+        count = self.cat_db.statement_count()
+        self.assertEqual(errors, [m.standard_error for measure in combined
+                                  for m in measure.event.measures])
+        self.assertEqual(2, self.cat_db.statement_count() - count)
+
+    def test_stream_the_measures(self):
+        criteria = filtering.WithMagnitudeScales(('MS', 'mb'))
+        measures = list(criteria.stream(batch_size=7))
+        self.assertEqual(sorted(measure.id for measure in criteria.all()),
+                         [measure.id for measure in measures])
+        for name in 'origin', 'agency', 'event':
+            self.assertTrue(name in measures[0].__dict__)
+
     def test_allows_filtering_of_measures_given_distance_from_point(self):
         distance = 700000  # distance is expressed in meters using srid 4326
         point = 'POINT(88.20 33.10)'
@@ -221,6 +346,114 @@ class ACriteriaShould(unittest.TestCase):
         measure = random.choice(result)
         self.assertTrue(result.predicate(measure))
 
+    def test_allows_negation(self):
+        bji = filtering.WithAgencies(['BJI'])
+        self.assertEqual(25, len(~bji))
+        for m in ~bji:
+            self.assertNotEqual('BJI', m.agency.source_key)
+        self.assertTrue((~bji).predicate(random.choice(~bji)))
+        self.assertEqual(30, len(~filtering.WithAgencies([])))
+        self.assertEqual(0, len(~filtering.C()))
+
+    def test_compile_combinations_into_a_single_query(self):
+        criteria = ((filtering.WithAgencies(['LDG', 'NEIC']) |
+                     filtering.WithAgencies(['BJI'])) &
+                    ~filtering.WithMagnitudeGreater(5))
+        sql = str(criteria.filter())
+        self.assertFalse('UNION' in sql)
+        self.assertEqual(1, sql.count('SELECT'))
+        self.assertEqual(
+            sorted(m.id for m in filtering.C(
+                    agency__in=['LDG', 'NEIC', 'BJI']) if m.value <= 5),
+            sorted(m.id for m in criteria))
+
+    def test_combine_the_criteria_overriding_filter_only(self):
+        greater, bji = FilterOnlyCriteria(), filtering.WithAgencies(['BJI'])
+        self.assertEqual(len(filtering.WithMagnitudeGreater(5)), len(greater))
+        self.assertEqual(2, len(greater & bji))
+        self.assertEqual(len(filtering.WithMagnitudeGreater(5) | bji),
+                         len(greater | bji))
+        self.assertEqual(len(~filtering.WithMagnitudeGreater(5)),
+                         len(~greater))
+        self.assertEqual(True, CustomCriteria().clause())
+
+    def test_fold_constant_criteria(self):
+        self.assertEqual(True, (filtering.C() | filtering.C(
+                    scale='mb')).clause())
+        self.assertEqual(False, (filtering.WithMagnitudeScales([]) &
+                                 filtering.C(scale='mb')).clause())
+        self.assertEqual(0, len(filtering.WithMagnitudeScales([])))
+
+    def test_cache_the_results(self):
+        self.session.commit()
+        cache = filtering.enable_cache()
+        try:
+            criteria = filtering.C(agency__in=['BJI'], magnitude__gt=5)
+            self.assertEqual(2, len(criteria))
+            self.assertEqual(2, len(filtering.WithMagnitudeGreater(5) &
+                                    filtering.WithAgencies(['BJI'])))
+            self.assertEqual(criteria.rows('id'), criteria.rows('id'))
+            arrays = criteria.to_arrays('value')
+            self.assertEqual(arrays['value'].tolist(),
+                             criteria.to_arrays('value')['value'].tolist())
+            self.assertFalse(arrays['value'].flags.writeable)
+            self.assertEqual({'hits': 3, 'misses': 3, 'evictions': 0,
+                              'entries': 3}, dict(
+                    (name, value) for name, value in cache.stats().items()
+                    if name != 'bytes'))
+
+            measure = criteria[0]
+            self.session.add(models.MagnitudeMeasure(
+                    agency=measure.agency, event=measure.event,
+                    origin=measure.origin, scale='ML', value=6.))
+            self.session.flush()
+            self.assertEqual(3, len(criteria))
+            self.assertEqual(1, len(cache))
+        finally:
+            filtering.disable_cache()
+
+    def test_cache_the_results_of_pending_changes(self):
+        self.session.commit()
+        filtering.enable_cache()
+        try:
+            criteria = filtering.C(agency__in=['BJI'], magnitude__gt=5)
+            self.assertEqual(2, len(criteria))
+
+            measure = criteria[0]
+            self.session.add(models.MagnitudeMeasure(
+                    agency=measure.agency, event=measure.event,
+                    origin=measure.origin, scale='ML', value=6.))
+            self.assertEqual(3, len(criteria))
+        finally:
+            filtering.disable_cache()
+
+    def test_limit_the_cache(self):
+        self.session.commit()
+        cache = filtering.enable_cache(max_entries=1)
+        try:
+            len(filtering.C(scale='mb'))
+            len(filtering.C(scale='MS'))
+            len(filtering.C(scale='mb'))
+            self.assertEqual(2, cache.evictions)
+            self.assertEqual(3, cache.misses)
+
+            cache = filtering.enable_cache(max_bytes=100)
+            filtering.C().rows('id', 'agency_key')
+            self.assertEqual(0, len(cache))
+        finally:
+            filtering.disable_cache()
+
+    def test_give_the_same_key_to_equivalent_criteria(self):
+        bji, mb = filtering.WithAgencies(['BJI']), filtering.C(scale='mb')
+        time_lb, time_ub = datetime(2001, 1, 1), datetime(2002, 1, 1)
+        self.assertEqual((bji & mb).key(), (mb & bji).key())
+        self.assertEqual(((bji | mb) | ~bji).key(), (bji | (~bji | mb)).key())
+        self.assertNotEqual((bji & mb).key(), (bji | mb).key())
+        self.assertEqual(
+            filtering.Between((time_lb, time_ub)).key(),
+            (filtering.Before(time_ub) & filtering.After(time_lb)).key())
+        self.assertEqual(None, (bji & CustomCriteria()).key())
+
     def test_default_predicate(self):
         measure = random.choice(filtering.C())
         self.assertTrue(filtering.C().predicate(measure))
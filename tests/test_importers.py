@@ -13,15 +13,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with eqcatalogueTool. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import bz2
+import gzip
+import shutil
+import tempfile
 import unittest
+from datetime import datetime
 from StringIO import StringIO
 
 
 from eqcatalogue.importers import (CsvEqCatalogueReader, Converter, Importer,
-    Iaspei, V1, isf_bulletin as isf)
+    CsvEqCatalogueImporter, Iaspei, V1, isf_bulletin as isf, isf_decoder,
+    store_events)
 
 from eqcatalogue.importers.reader_utils import (STR_TRANSF, INT_TRANSF,
-                                                FLOAT_TRANSF)
+                                                FLOAT_TRANSF, MappedFile,
+                                                open_stream, float_column,
+                                                datetime_column, column_values)
+from eqcatalogue.importers import base, writers
 from eqcatalogue.exceptions import InvalidMagnitudeSeq, ParsingFailure
 
 from eqcatalogue import models as catalogue
@@ -34,6 +44,9 @@ BROKEN_ISC = in_data_dir('broken_isc.txt')
 
 DATAFILE_IASPEI = in_data_dir('iaspei.csv')
 
+DATAFILE_CSV = in_data_dir('query_catalogue.csv')
+DATAFILE_MYANMAR = in_data_dir('myanmar_sample.csv')
+
 
 class ShouldImportFromISFBulletinV1(unittest.TestCase):
 
@@ -92,6 +105,270 @@ class ShouldImportFromISFBulletinV1(unittest.TestCase):
 
             self.assertEqual(isf.ERR_MSG % BROKEN_LINE_NUM, exp.message)
 
+    def test_bulk_load(self):
+        v1_importer = V1(self.f, self.cat)
+        summary = v1_importer.store(bulk=True, batch_size=100)
+
+        self.assertTrue(summary.pop(Importer.ROWS_PER_SECOND) > 0)
+        self.assertEqual(summary, {
+                    Importer.EVENT_SOURCE: 1,
+                    Importer.AGENCY: 17,
+                    Importer.EVENT: 18,
+                    Importer.ORIGIN: 128,
+                    Importer.MEASURE:  334,
+                    })
+
+        self.assertEqual(
+            self.cat.session.query(catalogue.Origin).count(), 128)
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 334)
+        self.assertEqual(
+            ['Near coast of central Chile'],
+            [e.name for e in self.cat.session.query(
+                catalogue.Event).filter_by(source_key='14342462')])
+
+    def test_bulk_load_twice(self):
+        V1(self.f, self.cat).store(bulk=True)
+
+        with open(DATAFILE_ISC) as stream:
+            summary = V1(stream, self.cat).store(bulk=True)
+
+        self.assertEqual(0, summary[Importer.EVENT])
+        self.assertEqual(0, summary[Importer.MEASURE])
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 334)
+
+    def test_bulk_load_looks_up_the_rows_by_chunk(self):
+        # far fewer statements than the 18 events and 128 origins
+        count = self.cat.statement_count()
+        V1(self.f, self.cat).store(bulk=True)
+        self.assertTrue(self.cat.statement_count() - count < 50)
+
+        count = self.cat.statement_count()
+        with open(DATAFILE_ISC) as stream:
+            V1(stream, self.cat).store(bulk=True)
+        self.assertTrue(self.cat.statement_count() - count < 50)
+
+    def test_bulk_load_raises_parsing_failure(self):
+        importer = V1(self.broken_isc, self.cat)
+        self.assertRaises(ParsingFailure, importer.store, bulk=True)
+
+    def _dump_measures(self):
+        return sorted(
+            (m.event.source_key, m.event.name, m.agency.source_key,
+             m.origin.source_key, m.origin.time, m.origin.depth,
+             m.scale, m.value, m.standard_error)
+            for m in self.cat.session.query(catalogue.MagnitudeMeasure))
+
+    def test_parallel_load(self):
+        serial_summary = V1(self.f, self.cat).store()
+        serial_measures = self._dump_measures()
+        self.cat.recreate()
+
+        with open(DATAFILE_ISC) as stream:
+            summary = V1(stream, self.cat).store(processes=2, chunk_size=50)
+
+        self.assertEqual(serial_summary, summary)
+        self.assertEqual(serial_measures, self._dump_measures())
+
+    def test_parallel_bulk_load(self):
+        summary = V1(self.f, self.cat).store(bulk=True, processes=2,
+                                             chunk_size=50)
+
+        self.assertEqual(334, summary[Importer.MEASURE])
+        self.assertEqual(
+            self.cat.session.query(catalogue.Origin).count(), 128)
+
+    def test_parallel_load_raises_parsing_failure(self):
+        importer = V1(self.broken_isc, self.cat)
+        self.assertRaises(ParsingFailure, importer.store, processes=2)
+
+    def test_split_events(self):
+        chunks = list(isf.split_events(self.f, chunk_size=50))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual((1, None), chunks[0][:2])
+        for start, eventsource, lines in chunks[1:]:
+            self.assertEqual('ISC Bulletin', eventsource)
+            self.assertTrue(isf.EventState.match(lines[0].strip()))
+
+    def test_replay_keeps_the_objects_of_the_last_event(self):
+        replayer = writers.Replayer(writers.BulkWriter(self.cat))
+        for chunk in isf.split_events(self.f, chunk_size=50):
+            records, error = isf.parse_chunk(chunk)
+            self.assertEqual(None, error)
+            for _, calls in records:
+                for method, args, placeholder, _ in calls:
+                    replayer.replay(method, args, placeholder)
+
+        kinds = [placeholder.kind for placeholder in replayer._objects]
+        self.assertEqual(1, kinds.count('eventsource'))
+        self.assertEqual(1, kinds.count('event'))
+
+    def test_resume_growing_bulletin(self):
+        content = self.f.read()
+        cut = content.index('Event ', len(content) / 2)
+        first_import = V1(StringIO(content[:cut] + 'STOP\n'), self.cat)
+        first_summary = first_import.store(checkpoint='isc.txt')
+
+        importer = V1(StringIO(content), self.cat)
+        summary = importer.store(checkpoint='isc.txt')
+
+        checkpoint = self.cat.session.query(
+            catalogue.ImportCheckpoint).filter_by(source='isc.txt').one()
+        self.assertEqual(content.index('STOP'), checkpoint.byte_offset)
+        self.assertEqual('999999', checkpoint.last_event)
+        self.assertEqual(0, summary[Importer.EVENT_SOURCE])
+        self.assertEqual(18, first_summary[Importer.EVENT] +
+                         summary[Importer.EVENT])
+        self.assertEqual(334, first_summary[Importer.MEASURE] +
+                         summary[Importer.MEASURE])
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 334)
+
+        summary = V1(StringIO(content), self.cat).store(checkpoint='isc.txt')
+        self.assertEqual(0, summary[Importer.EVENT])
+
+    def test_resume_hashes_by_chunks(self):
+        content = self.f.read()
+        cut = content.index('Event ', len(content) / 2)
+        V1(StringIO(content[:cut] + 'STOP\n'), self.cat).store(
+            checkpoint='isc.txt')
+
+        chunk_size = base.HASH_CHUNK_SIZE
+        base.HASH_CHUNK_SIZE = 100
+        try:
+            summary = V1(StringIO(content), self.cat).store(
+                checkpoint='isc.txt')
+        finally:
+            base.HASH_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(0, summary[Importer.EVENT_SOURCE])
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 334)
+
+    def test_resume_changed_bulletin(self):
+        V1(self.f, self.cat).store(checkpoint='isc.txt', bulk=True)
+
+        with open(DATAFILE_ISC) as stream:
+            content = stream.read().replace('Chile', 'Cile', 1)
+        V1(StringIO(content), self.cat).store(checkpoint='isc.txt',
+                                              bulk=True)
+
+        self.assertEqual(
+            self.cat.session.query(catalogue.Event).filter(
+                catalogue.Event.name.like('%Cile')).count(), 1)
+
+    def test_identity_cache(self):
+        v1_importer = V1(self.f, self.cat)
+        v1_importer.store()
+        misses = v1_importer.cache.misses
+
+        self.assertTrue(v1_importer.cache.hits > 0)
+
+        with open(DATAFILE_ISC) as stream:
+            second_importer = V1(stream, self.cat)
+            summary = second_importer.store()
+
+        # event sources and agencies are pre-warmed
+        self.assertEqual(0, summary[Importer.AGENCY])
+        self.assertTrue(second_importer.cache.misses < misses)
+        self.assertEqual(
+            self.cat.session.query(catalogue.Agency).count(), 17)
+
+
+class AnISFDecoderShould(unittest.TestCase):
+
+    def test_decode_origin(self):
+        record = isf_decoder.decode_origin(
+            '2010/02/28 00:00:47.42   0.27 1.057 -36.6246  -73.3679 9.480 '
+            '7.417  84  27.0f       852  845  36   4.66 177.69 m i se ISC  '
+            '     00198763')
+
+        self.assertEqual(datetime(2010, 2, 28, 0, 0, 47, 42), record.time)
+        self.assertEqual((-36.6246, -73.3679),
+                         (record.latitude, record.longitude))
+        self.assertEqual(27.0, record.depth)
+        self.assertEqual(None, record.depth_error)
+        self.assertEqual(36, record.azimuth_error)
+        self.assertEqual('ISC', record.agency)
+        self.assertEqual('00198763', record.source_key)
+        self.assertEqual('manual', record.analysis_type)
+        self.assertEqual('suspected earthquake', record.event_type)
+
+    def test_decode_measures(self):
+        self.assertEqual(
+            isf_decoder.MeasureRecord('mb', 5.3, 0.2, 162, 'ISC',
+                                      '00198763'),
+            isf_decoder.decode_measure(
+                'mb     5.3 0.2  162 ISC       00198763'))
+        self.assertEqual(
+            isf_decoder.MeasureRecord('Muk', 6.0, None, None, 'JMA',
+                                      '1234567'),
+            isf_decoder.decode_uk_measure('6.0          JMA  1234567'))
+
+    def test_decode_stream(self):
+        with open(DATAFILE_ISC) as stream:
+            records = list(isf_decoder.decode(stream))
+        line_types = [line_type for _, line_type, _ in records]
+
+        self.assertEqual(1, line_types.count('catalogue_header'))
+        self.assertEqual(18, line_types.count('event_header'))
+        self.assertTrue(all(isinstance(record, isf_decoder.OriginRecord)
+                            for _, line_type, record in records
+                            if line_type == 'origin_block'))
+        self.assertEqual(
+            isf_decoder.EventRecord('999999', 'Fake Event'),
+            [record for _, line_type, record in records
+             if line_type == 'event_header'][-1])
+
+
+class AnImporterShouldOpen(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cat = catalogue.CatalogueDatabase(memory=True, drop=True)
+        self.cat.recreate()
+        with open(DATAFILE_ISC) as stream:
+            self.content = stream.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, filename, opener):
+        path = os.path.join(self.tmpdir, filename)
+        stream = opener(path, 'wb')
+        stream.write(self.content)
+        stream.close()
+        return path
+
+    def _assert_imported(self, path):
+        summary = store_events(V1, path, self.cat)
+
+        self.assertEqual(18, summary[Importer.EVENT])
+        self.assertEqual(334, summary[Importer.MEASURE])
+
+    def test_plain_files(self):
+        self._assert_imported(self._write('isc.txt', open))
+
+    def test_gzip_files(self):
+        self._assert_imported(self._write('isc.txt.gz', gzip.GzipFile))
+
+    def test_bzip2_files(self):
+        self._assert_imported(self._write('isc.txt.bz2', bz2.BZ2File))
+
+    def test_mapped_files(self):
+        with open_stream(self._write('isc.txt', open)) as stream:
+            self.assertTrue(isinstance(stream, MappedFile))
+            self.assertEqual(self.content.splitlines(True), list(stream))
+            stream.seek(0)
+            self.assertEqual(self.content[:10], stream.read(10))
+            self.assertEqual(self.content[10:], stream.read())
+
+    def test_streams(self):
+        stream = StringIO()
+        self.assertTrue(stream is open_stream(stream))
+
 
 class AIaspeiImporterShould(unittest.TestCase):
 
@@ -121,7 +398,7 @@ class AIaspeiImporterShould(unittest.TestCase):
         importer = Iaspei(csv_file, self.cat)
         exp_num_entries = 2
         self.assertEqual(exp_num_entries, len(
-            importer._parse_csv(header=False)))
+            list(importer._parse_csv(header=False))))
 
     def test_import_csv_iaspei(self):
         self.csv_importer.store()
@@ -138,6 +415,41 @@ class AIaspeiImporterShould(unittest.TestCase):
         importer = Iaspei(self.file, self.cat)
         importer.store()
 
+    def test_import_again_with_a_small_key_cache(self):
+        cache_size = writers.DEFAULT_KEY_CACHE_SIZE
+        writers.DEFAULT_KEY_CACHE_SIZE = 3
+        try:
+            self.csv_importer.store(batch_size=10)
+            with open(DATAFILE_IASPEI) as stream:
+                summary = Iaspei(stream, self.cat).store(batch_size=10)
+        finally:
+            writers.DEFAULT_KEY_CACHE_SIZE = cache_size
+
+        self.assertEqual(0, summary[Importer.EVENT])
+        self.assertEqual(0, summary[Importer.ORIGIN])
+        self.assertEqual(0, summary[Importer.MEASURE])
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 61)
+
+    def test_import_csv_iaspei_times(self):
+        csv_file = StringIO(
+            '10525612,IASPEI,2008-02-09,07:12:06.09,32.4850,-115.2935, 20.6,,'
+            'IASPEI,MS,4.7,IASPEI,mb, 4.9\n')
+        Iaspei(csv_file, self.cat).store(header=False)
+
+        origin = self.cat.session.query(catalogue.Origin).one()
+        self.assertEqual(datetime(2008, 2, 9, 7, 12, 6, 90000), origin.time)
+        self.assertEqual(20.6, origin.depth)
+
+    def test_import_csv_iaspei_in_batches(self):
+        summary = self.csv_importer.store(batch_size=10)
+
+        self.assertEqual(61, summary[Importer.MEASURE])
+        self.assertEqual(
+            self.cat.session.query(catalogue.Origin).count(), 46)
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 61)
+
     def test_importing_once_the_same_csv(self):
 
         first_importer = Iaspei(self.file, self.cat)
@@ -159,6 +471,44 @@ class AIaspeiImporterShould(unittest.TestCase):
         self.assertEqual(measures.count(),  61)
 
 
+class ACsvImporterShould(unittest.TestCase):
+
+    def setUp(self):
+        self.cat = catalogue.CatalogueDatabase(memory=True, drop=True)
+        self.cat.recreate()
+
+    def test_import_csv(self):
+        summary = store_events(CsvEqCatalogueImporter, DATAFILE_CSV,
+                               self.cat, batch_size=10)
+
+        self.assertEqual(summary, {
+            Importer.EVENT_SOURCE: 1,
+            Importer.AGENCY: 9,
+            Importer.EVENT: 5,
+            Importer.ORIGIN: 21,
+            Importer.MEASURE: 30,
+        })
+        self.assertEqual(
+            self.cat.session.query(catalogue.MagnitudeMeasure).count(), 30)
+        self.assertEqual(
+            self.cat.session.query(catalogue.MeasureMetadata).count(), 115)
+
+    def test_importing_once_the_same_csv(self):
+        store_events(CsvEqCatalogueImporter, DATAFILE_CSV, self.cat)
+        summary = store_events(CsvEqCatalogueImporter, DATAFILE_CSV,
+                               self.cat)
+
+        self.assertEqual(0, sum(summary.values()))
+        self.assertEqual(
+            self.cat.session.query(catalogue.MeasureMetadata).count(), 115)
+
+    def test_raises_parsing_failure(self):
+        # the scale Msz is not a known scale
+        with self.assertRaises(ParsingFailure):
+            store_events(CsvEqCatalogueImporter, DATAFILE_MYANMAR,
+                         self.cat, header=True)
+
+
 class EqCatalogueReaderTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -201,6 +551,19 @@ class EqCatalogueReaderTestCase(unittest.TestCase):
         first_entry = self.reader_gen.next()
         self.assertEqual(self.fst_exp_entry, first_entry)
 
+    def test_read_columns(self):
+        blocks = list(self.reader.read_columns(size=2))
+
+        self.assertEqual(2, len(blocks))
+        first = blocks[0]
+        self.assertEqual(['1009476', '1009476'], first['eventKey'])
+        self.assertEqual([25.4812, 25.4812],
+                         column_values(first['Latitude']))
+        self.assertEqual([None, None], column_values(first['depthError']))
+        self.assertEqual([datetime(2002, 9, 3, 21, 37, 37, 110000)] * 2,
+                         column_values(first['time']))
+        self.assertEqual(['IDC'], blocks[1]['mag_agency'])
+
     def test_number_generated_entries(self):
         exp_num_gen_entries = 3
         num_entries = 0
@@ -231,3 +594,13 @@ class ConvertTestCase(unittest.TestCase):
         entry = {'b': '', 'c': '45.90'}
         exp_entry = {'b': None, 'c': 45.90}
         self.assertEqual(exp_entry, self.converter.convert(entry))
+
+    def test_conversion_of_columns(self):
+        self.assertEqual([45.9, None, None, -3.0], column_values(
+                float_column(['45.90', ' ', 'risk8', '-3'])))
+        self.assertEqual(
+            [datetime(2002, 12, 31, 23, 59, 59, 999999), None],
+            column_values(datetime_column(*[
+                        float_column(values) for values in (
+                            ['2002', '2002'], ['12', ''], ['31', '1'],
+                            ['23', '0'], ['59', '0'], ['59.999999', '0'])])))